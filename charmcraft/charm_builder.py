@@ -17,22 +17,81 @@
 """The charm package builder."""
 
 import argparse
+import ast
+import collections
+import concurrent.futures
+import contextlib
 import errno
+import hashlib
+import importlib.util
+import json
 import logging
 import os
 import pathlib
+import re
+import shlex
 import shutil
 import subprocess
-from typing import List
+import sys
+import sysconfig
+import tempfile
+import threading
+import time
+import zipfile
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # not available on all platforms, where files are never cloned
+    fcntl = None
 
 from charmcraft.cmdbase import CommandError
 from charmcraft.jujuignore import JujuIgnore, default_juju_ignore
-from charmcraft.utils import make_executable
+from charmcraft.utils import get_host_architecture, get_os_platform, make_executable
 
 
 # Some constants that are used through the code.
 WORK_DIRNAME = "work_dir"
 VENV_DIRNAME = "venv"
+IGNORE_CACHE_DIRNAME = "jujuignore"
+
+# The installed dependencies are cached in this directory (inside the cache one), keeping
+# it under this size (in bytes) by removing the least recently used ones
+VENV_CACHE_DIRNAME = "venvs"
+VENV_CACHE_MAX_SIZE = 2 * 1024 ** 3
+DEPENDENCIES_KEY_FORMAT = 1
+
+# The wheels built from sdists are cached in this directory (inside the cache one)
+WHEELS_CACHE_DIRNAME = "wheels"
+
+# The file extensions of the source distributions (sdists) that pip can download
+SDIST_EXTENSIONS = (".tar.gz", ".tar.bz2", ".zip")
+
+# The file, in the wheelhouse, that lists for which dependencies it has all the wheels
+WHEELHOUSE_STAMP_FILENAME = ".charmcraft-wheelhouse.json"
+
+# The ioctl to clone a file sharing its blocks (copy-on-write), from linux/fs.h
+FICLONE = 0x40049409
+
+# The errors that mean a copy strategy can't be used for a file (so the next one is tried)
+COPY_UNSUPPORTED_ERRNOS = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EXDEV,
+}
+
+# The most to copy in each kernel call
+COPY_CHUNK_SIZE = 2 ** 30
+
+# The requirements lock files are kept in a directory of the project, one for each
+# system the charm is built on (as the resolution depends on it); they record what they
+# were resolved from, to be resolved again when that changes
+REQUIREMENTS_LOCK_TEMPLATE = "requirements-{name}-{channel}-{arch}.lock"
+REQUIREMENTS_LOCK_HEADER = "# Generated by charmcraft, do not edit; inputs: {inputs}\n"
 
 # The file name and template for the dispatch script
 DISPATCH_FILENAME = "dispatch"
@@ -42,13 +101,78 @@ DISPATCH_FILENAME = "dispatch"
 # to be the value it would've otherwise been.
 DISPATCH_CONTENT = """#!/bin/sh
 
-JUJU_DISPATCH_PATH="${{JUJU_DISPATCH_PATH:-$0}}" PYTHONPATH=lib:venv ./{entrypoint_relative_path}
+JUJU_DISPATCH_PATH="${{JUJU_DISPATCH_PATH:-$0}}" PYTHONPATH={pypath} ./{entrypoint_relative_path}
+"""
+
+# The dispatch script for the fast launch mode: the shell is replaced by the Python
+# interpreter (instead of forking to run the entrypoint through its shebang), which
+# may be told to skip the site initialisation (see `CharmBuilder.dispatch_interpreter`)
+DISPATCH_MODES = ["classic", "fast"]
+DISPATCH_FAST_CONTENT = """#!/bin/sh
+
+JUJU_DISPATCH_PATH="${{JUJU_DISPATCH_PATH:-$0}}" PYTHONPATH={pypath} exec {python} ./{entrypoint}
+"""
+DEFAULT_INTERPRETER = "python3"
+
+# The directories with Python code for the charm, in the order they're searched on import;
+# each of them can be also packed (partially) in a zipimport archive next to it, named with
+# the suffix, which is searched right after the directory
+PYTHONPATH_DIRNAMES = ["lib", VENV_DIRNAME]
+ZIPIMPORT_SUFFIX = ".zip"
+# The oldest date the zip format can hold, 1980-01-01, in seconds since the epoch
+ZIP_MIN_EPOCH = 315532800
+
+# What is removed from the installed dependencies when pruning them (with the syntax
+# of .jujuignore, relative to the venv), as it's not needed at runtime
+VENV_PRUNE_PATTERNS = """
+# tests of the packages, only where they are kept apart from the code (the project can
+# remove more, like nested tests, docs, typing stubs or extension sources, with its own
+# patterns)
+/tests/
+/*/tests/
+# bytecode compiled by pip when installing (with timestamps that won't match those
+# of the unpacked charm; hash-based bytecode can be compiled after pruning)
+__pycache__/
+# distributions metadata only used by pip (the RECORD is kept, importlib.metadata
+# uses it to list the distribution files)
+/*.dist-info/INSTALLER
+/*.dist-info/REQUESTED
+/*.dist-info/direct_url.json
+""".split(
+    "\n"
+)
+
+# The script to byte-compile the charm, run by the Python of the base where the charm will
+# run; the bytecode is hash-based (no timestamps) with paths relative to the charm root,
+# so it's reproducible
+COMPILE_BYTECODE_SCRIPT = """\
+import compileall, py_compile, sys
+if sys.version_info < (3, 7):
+    sys.exit("hash-based bytecode needs Python 3.7 or newer")
+compileall.compile_dir(
+    sys.argv[1],
+    ddir="",
+    quiet=1,
+    workers=0,
+    invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH,
+)
 """
 
 # The minimum set of hooks to be provided for compatibility with old Juju
 MANDATORY_HOOK_NAMES = {"install", "start", "upgrade-charm"}
 HOOKS_DIR = "hooks"
 
+# The command line options that are paths (or lists of them), relative to the working directory
+PATH_OPTIONS = [
+    "charmdir",
+    "builddir",
+    "entrypoint",
+    "requirement",
+    "cache_dir",
+    "wheelhouse",
+    "lock_dir",
+]
+
 logger = logging.getLogger(__name__)
 
 
@@ -68,6 +192,27 @@ class CharmBuilder:
         allow_pip_binary: bool = None,
         python_packages: List[str] = None,
         requirements: List[str] = None,
+        explain_ignores: bool = False,
+        cache_dir: pathlib.Path = None,
+        link_workers: int = 1,
+        venv_cache: bool = False,
+        venv_cache_size: int = VENV_CACHE_MAX_SIZE,
+        wheels_cache: bool = False,
+        wheelhouse: pathlib.Path = None,
+        compile_bytecode: bool = False,
+        zipimport: List[str] = None,
+        prune_venv: bool = False,
+        prune_patterns: List[str] = None,
+        tree_shaking: str = None,
+        keep_packages: List[str] = None,
+        lock_dir: pathlib.Path = None,
+        relock: bool = False,
+        dispatch_mode: str = "classic",
+        dispatch_skip_site: bool = False,
+        concurrent_dependencies: bool = False,
+        source_date_epoch: int = None,
+        environment: Dict[str, str] = None,
+        work_dir: pathlib.Path = None,
     ):
         self.charmdir = charmdir
         self.buildpath = builddir
@@ -75,28 +220,165 @@ class CharmBuilder:
         self.allow_pip_binary = allow_pip_binary
         self.python_packages = python_packages
         self.requirement_paths = requirements
+        self.explain_ignores = explain_ignores
+        self.cache_dir = cache_dir
+        self.link_workers = link_workers
+        self.venv_cache = venv_cache
+        self.venv_cache_size = venv_cache_size
+        self.wheels_cache = wheels_cache
+        self.wheelhouse = wheelhouse
+        self.compile_bytecode = compile_bytecode
+        self.zipimport = zipimport or []
+        self.prune_venv = prune_venv
+        self.prune_patterns = prune_patterns or []
+        self.tree_shaking = tree_shaking
+        self.keep_packages = keep_packages or []
+        self.lock_dir = lock_dir
+        self.relock = relock
+        self.dispatch_mode = dispatch_mode
+        self.dispatch_skip_site = dispatch_skip_site
+        self.concurrent_dependencies = concurrent_dependencies
+        self.source_date_epoch = source_date_epoch
+
+        # the subprocesses (pip, the interpreter to compile bytecode) get the given
+        # environment and working directory, else those of the builder's process
+        if source_date_epoch is not None:
+            # pip (and the sdists builds) make what they generate reproducible with it
+            environment = dict(os.environ if environment is None else environment)
+            environment["SOURCE_DATE_EPOCH"] = str(source_date_epoch)
+        self._subprocess_kwargs = {}
+        if environment is not None:
+            self._subprocess_kwargs["env"] = environment
+        if work_dir is not None:
+            self._subprocess_kwargs["cwd"] = str(work_dir)
         self.ignore_rules = self._load_juju_ignore()
 
+        self.timings = {}
+
+        # if the project provides its own dispatch (known after handling the dispatcher)
+        self.project_dispatch = None
+
+        # how many files were linked or copied with each strategy
+        self.link_strategies = collections.Counter()
+        self._link_strategies_lock = threading.Lock()
+
     def build_charm(self) -> None:
-        """Build the charm."""
+        """Build the charm.
+
+        How long each phase took is kept in `timings`, in the order they were run.
+        """
         logger.debug("Building charm in %r", str(self.buildpath))
 
-        if self.buildpath.exists():
-            shutil.rmtree(str(self.buildpath))
-        self.buildpath.mkdir()
+        with self._timed_phase("setup"):
+            if self.buildpath.exists():
+                shutil.rmtree(str(self.buildpath))
+            self.buildpath.mkdir()
+
+        if self.concurrent_dependencies and self._can_link_during_dependencies():
+            linked_entrypoint = self._handle_paths_during_dependencies()
+        else:
+            with self._timed_phase("generic_paths"):
+                linked_entrypoint = self.handle_generic_paths()
+                if self.explain_ignores:
+                    self.show_ignores_report()
+            with self._timed_phase("dependencies"):
+                self.handle_dependencies()
+        if self.prune_venv:
+            with self._timed_phase("prune"):
+                self.handle_prune()
+        if self.tree_shaking is not None:
+            with self._timed_phase("tree_shaking"):
+                self.handle_tree_shaking(linked_entrypoint)
+        # after the dependencies are in place, as the fast dispatch depends on them
+        with self._timed_phase("dispatcher"):
+            self.handle_dispatcher(linked_entrypoint)
+        if self.compile_bytecode:
+            with self._timed_phase("bytecode"):
+                self.handle_bytecode()
+        with self._timed_phase("zipimport"):
+            self.handle_zipimport()
+
+        logger.debug(
+            "Charm build phases: %s",
+            ", ".join("{} {:.3f}s".format(phase, secs) for phase, secs in self.timings.items()),
+        )
+
+    def _can_link_during_dependencies(self) -> bool:
+        """Tell if the charm files can be linked while the dependencies are installed.
+
+        It's not possible if the project's own venv directory would be linked where the
+        dependencies are installed.
+        """
+        if not (self.charmdir / VENV_DIRNAME).exists():
+            return True
+        if self.ignore_rules.match("/" + VENV_DIRNAME, True):
+            return True
+        logger.debug("Not installing the dependencies concurrently, the project has a venv")
+        return False
+
+    def _handle_paths_during_dependencies(self) -> pathlib.Path:
+        """Link the charm files while the dependencies are installed in the background.
+
+        If both fail, the errors are reported together.
+        """
+        errors = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            dependencies = executor.submit(self._timed_dependencies)
+            try:
+                with self._timed_phase("generic_paths"):
+                    linked_entrypoint = self.handle_generic_paths()
+                    if self.explain_ignores:
+                        self.show_ignores_report()
+            except Exception as exc:
+                errors.append(("linking the charm files", exc))
+            try:
+                dependencies.result()
+            except Exception as exc:
+                errors.append(("installing the dependencies", exc))
+
+        if len(errors) == 1:
+            raise errors[0][1]
+        if errors:
+            raise CommandError(
+                "Problems building the charm: {}".format(
+                    "; ".join("{} ({})".format(what, exc) for what, exc in errors)
+                )
+            ) from errors[0][1]
+        return linked_entrypoint
+
+    def _timed_dependencies(self):
+        """Install the dependencies, measuring how long it takes."""
+        with self._timed_phase("dependencies"):
+            self.handle_dependencies()
 
-        linked_entrypoint = self.handle_generic_paths()
-        self.handle_dispatcher(linked_entrypoint)
-        self.handle_dependencies()
+    @contextlib.contextmanager
+    def _timed_phase(self, phase: str):
+        """Measure how long the phase of the build takes, keeping it in `timings`."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[phase] = time.monotonic() - start
+
+    def _run(self, cmd: List[str]) -> int:
+        """Run the external command, with the environment and working directory given."""
+        return _process_run(cmd, **self._subprocess_kwargs)
 
     def _load_juju_ignore(self):
-        ignore = JujuIgnore(default_juju_ignore)
+        cache_dir = None if self.cache_dir is None else self.cache_dir / IGNORE_CACHE_DIRNAME
+        ignore = JujuIgnore(default_juju_ignore, explain=self.explain_ignores, cache_dir=cache_dir)
         path = self.charmdir / ".jujuignore"
         if path.exists():
             with path.open("r", encoding="utf-8") as ignores:
                 ignore.extend_patterns(ignores)
         return ignore
 
+    def show_ignores_report(self):
+        """Show the stats of the ignore rules, the most expensive ones first."""
+        logger.info("Ignore rules, by time spent matching:")
+        for line in self.ignore_rules.explain_report():
+            logger.info("- %s", line)
+
     def create_symlink(self, src_path, dest_path):
         """Create a symlink in dest_path pointing relatively like src_path.
 
@@ -121,71 +403,136 @@ class CharmBuilder:
         - directories: created
         - symlinks: respected if are internal to the project
         - other types (blocks, mount points, etc): ignored
+
+        The directories skeleton is created while walking the tree, and the regular
+        files are linked (or copied) afterwards, see `link_files`.
         """
         logger.debug("Linking in generic paths")
 
-        for basedir, dirnames, filenames in os.walk(str(self.charmdir), followlinks=False):
-            abs_basedir = pathlib.Path(basedir)
-            rel_basedir = abs_basedir.relative_to(self.charmdir)
+        buildpath = str(self.buildpath)
+        to_link = []
+        for rel_basedir, dir_entries, file_entries in _walk(str(self.charmdir)):
+            # only the rules that may apply inside this directory are used (if none can
+            # ignore anything the whole subtree is accepted without matching each path),
+            # checking all the directory content at once
+            ignore_rules = self.ignore_rules.subtree(rel_basedir)
+            prefix = "/{}/".format(rel_basedir) if rel_basedir else "/"
+            ignored_dirnames = ignore_rules.match_many(
+                [prefix + entry.name for entry in dir_entries], [True] * len(dir_entries)
+            )
+            ignored_filenames = ignore_rules.match_many(
+                [prefix + entry.name for entry in file_entries], [False] * len(file_entries)
+            )
 
             # process the directories
             ignored = []
-            for pos, name in enumerate(dirnames):
-                rel_path = rel_basedir / name
-                abs_path = abs_basedir / name
+            for pos, (entry, is_ignored) in enumerate(zip(dir_entries, ignored_dirnames)):
+                rel_path = os.path.join(rel_basedir, entry.name)
 
-                if self.ignore_rules.match(str(rel_path), is_dir=True):
-                    logger.debug("Ignoring directory because of rules: %r", str(rel_path))
+                if is_ignored:
+                    logger.debug("Ignoring directory because of rules: %r", rel_path)
                     ignored.append(pos)
-                elif abs_path.is_symlink():
-                    dest_path = self.buildpath / rel_path
-                    self.create_symlink(abs_path, dest_path)
+                elif entry.is_symlink():
+                    self.create_symlink(pathlib.Path(entry.path), self.buildpath / rel_path)
                 else:
-                    dest_path = self.buildpath / rel_path
-                    dest_path.mkdir(mode=abs_path.stat().st_mode)
+                    os.mkdir(os.path.join(buildpath, rel_path), entry.stat().st_mode)
 
             # in the future don't go inside ignored directories
             for pos in reversed(ignored):
-                del dirnames[pos]
+                del dir_entries[pos]
 
             # process the files
-            for name in filenames:
-                rel_path = rel_basedir / name
-                abs_path = abs_basedir / name
-
-                if self.ignore_rules.match(str(rel_path), is_dir=False):
-                    logger.debug("Ignoring file because of rules: %r", str(rel_path))
-                elif abs_path.is_symlink():
-                    dest_path = self.buildpath / rel_path
-                    self.create_symlink(abs_path, dest_path)
-                elif abs_path.is_file():
-                    dest_path = self.buildpath / rel_path
-                    try:
-                        os.link(str(abs_path), str(dest_path))
-                    except PermissionError:
-                        # when not allowed to create hard links
-                        shutil.copy2(str(abs_path), str(dest_path))
-                    except OSError as e:
-                        if e.errno != errno.EXDEV:
-                            raise
-                        shutil.copy2(str(abs_path), str(dest_path))
+            for entry, is_ignored in zip(file_entries, ignored_filenames):
+                rel_path = os.path.join(rel_basedir, entry.name)
+
+                if is_ignored:
+                    logger.debug("Ignoring file because of rules: %r", rel_path)
+                elif entry.is_symlink():
+                    self.create_symlink(pathlib.Path(entry.path), self.buildpath / rel_path)
+                elif entry.is_file():
+                    to_link.append((entry.path, os.path.join(buildpath, rel_path)))
                 else:
-                    logger.debug("Ignoring file because of type: %r", str(rel_path))
+                    logger.debug("Ignoring file because of type: %r", rel_path)
+
+        self.link_files(to_link)
 
         # the linked entrypoint is calculated here because it's when it's really in the build dir
         linked_entrypoint = self.buildpath / self.entrypoint.relative_to(self.charmdir)
 
         return linked_entrypoint
 
+    def link_files(self, to_link):
+        """Hard link (or copy, if not possible) the files, as (source, destination) pairs.
+
+        If more than one worker is configured the files are processed concurrently; in
+        any case if several fail the error raised is the one from the first in the list.
+
+        How many files were linked or copied with each strategy is kept in
+        `link_strategies`.
+        """
+        if self.link_workers <= 1 or len(to_link) <= 1:
+            self._update_link_strategies(_link_or_copy_many(to_link))
+        else:
+            self._link_files_concurrently(to_link)
+
+        with self._link_strategies_lock:
+            link_strategies = self.link_strategies.most_common()
+        if link_strategies:
+            logger.debug(
+                "Files linked or copied: %s",
+                ", ".join(
+                    "{} by {}".format(count, strategy) for strategy, count in link_strategies
+                ),
+            )
+
+    def _update_link_strategies(self, strategies):
+        """Count the files linked or copied with each strategy, from any thread."""
+        with self._link_strategies_lock:
+            self.link_strategies.update(strategies)
+
+    def _link_files_concurrently(self, to_link):
+        """Link or copy the files in several workers."""
+        logger.debug("Linking %d files using %d workers", len(to_link), self.link_workers)
+
+        # split the work in a few chunks per worker, to not pay the overhead of handling
+        # each file as a separate task
+        chunk_size = -(-len(to_link) // (self.link_workers * 4))
+        chunks = [to_link[i : i + chunk_size] for i in range(0, len(to_link), chunk_size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.link_workers) as executor:
+            futures = [executor.submit(_link_or_copy_many, chunk) for chunk in chunks]
+            try:
+                for future in futures:
+                    self._update_link_strategies(future.result())
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+
     def handle_dispatcher(self, linked_entrypoint):
         """Handle modern and classic dispatch mechanisms."""
         # dispatch mechanism, create one if wasn't provided by the project
         dispatch_path = self.buildpath / DISPATCH_FILENAME
-        if not dispatch_path.exists():
+        self.project_dispatch = dispatch_path.exists()
+        if not self.project_dispatch:
             logger.debug("Creating the dispatch mechanism")
-            dispatch_content = DISPATCH_CONTENT.format(
-                entrypoint_relative_path=linked_entrypoint.relative_to(self.buildpath)
-            )
+            pythonpath = []
+            for dirname in PYTHONPATH_DIRNAMES:
+                pythonpath.append(dirname)
+                if dirname in self._zipimport_dirnames():
+                    pythonpath.append(dirname + ZIPIMPORT_SUFFIX)
+            entrypoint_relative_path = linked_entrypoint.relative_to(self.buildpath)
+            if self.dispatch_mode == "fast":
+                interpreter = self.dispatch_interpreter(linked_entrypoint)
+                dispatch_content = DISPATCH_FAST_CONTENT.format(
+                    pypath=":".join(pythonpath),
+                    python=" ".join(shlex.quote(arg) for arg in interpreter),
+                    entrypoint=entrypoint_relative_path,
+                )
+            else:
+                dispatch_content = DISPATCH_CONTENT.format(
+                    pypath=":".join(pythonpath),
+                    entrypoint_relative_path=entrypoint_relative_path,
+                )
             with dispatch_path.open("wt", encoding="utf8") as fh:
                 fh.write(dispatch_content)
                 make_executable(fh)
@@ -218,33 +565,1025 @@ class CharmBuilder:
                 relative_link = relativise(dest_hook, dispatch_path)
                 dest_hook.symlink_to(relative_link)
 
+    def dispatch_interpreter(self, linked_entrypoint: pathlib.Path) -> List[str]:
+        """Get the interpreter command (with its flags) to run the entrypoint in the fast dispatch.
+
+        The interpreter is the one in the entrypoint's shebang (without going through
+        `env`). If requested, the site initialisation is skipped (so no site-packages
+        directories are scanned nor their .pth files processed), unless the charm's code
+        imports modules that are not in the charm nor in the standard library, which may
+        then be provided by the system. The imports done by the installed packages are not
+        checked (they may import optional modules, only when available), so skipping it is
+        left to the project.
+        """
+        interpreter = _shebang_interpreter(str(linked_entrypoint))
+        if not self.dispatch_skip_site or "-S" in interpreter[1:]:
+            return interpreter
+
+        code_dirs = [str(linked_entrypoint.parent), str(self.buildpath / "lib")]
+        venvpath = self.buildpath / VENV_DIRNAME
+        installed = _installed_packages(str(venvpath)) if venvpath.is_dir() else {}
+        external = _external_imports(str(linked_entrypoint), code_dirs, installed)
+        if external:
+            logger.info(
+                "Not skipping the site initialisation in the dispatch, the charm imports "
+                "modules it doesn't include: %s",
+                ", ".join(sorted(external)),
+            )
+            return interpreter
+        return interpreter + ["-S"]
+
     def handle_dependencies(self):
         """Handle from-directory and virtualenv dependencies."""
         logger.debug("Installing dependencies")
 
         # virtualenv with other dependencies (if any)
-        if self.requirement_paths:
-            retcode = _process_run(["pip3", "--version"])
+        if self.requirement_paths or self.python_packages:
+            retcode = self._run(["pip3", "--version"])
             if retcode:
                 raise CommandError("problems using pip")
 
             venvpath = self.buildpath / VENV_DIRNAME
+
+            downloads_dir = None
+            if self.lock_dir is not None and (self.relock or not self._lock_is_current()):
+                downloads_dir = pathlib.Path(tempfile.mkdtemp(prefix="charmcraft-downloads-"))
+                try:
+                    self.write_lock(downloads_dir)
+                except Exception:
+                    shutil.rmtree(str(downloads_dir), ignore_errors=True)
+                    raise
+
+            use_venv_cache = self.venv_cache and self.cache_dir is not None
+            dependencies_key = None
+            if use_venv_cache or self.wheelhouse is not None:
+                dependencies_key = self._dependencies_key()
+            cache_key = dependencies_key if use_venv_cache else None
+            if cache_key is not None and self._venv_from_cache(cache_key, venvpath):
+                if downloads_dir is not None:
+                    shutil.rmtree(str(downloads_dir), ignore_errors=True)
+                return
+
+            if self.lock_dir is not None:
+                # just resolved (so it's at hand) or fetched when installing
+                find_links = [] if downloads_dir is None else [downloads_dir]
+            elif self.wheelhouse is not None:
+                self._fill_wheelhouse(dependencies_key)
+                find_links = [self.wheelhouse]
+            elif self.wheels_cache and self.cache_dir is not None:
+                downloads_dir = pathlib.Path(tempfile.mkdtemp(prefix="charmcraft-downloads-"))
+                find_links = [self._build_wheels(downloads_dir), downloads_dir]
+            else:
+                find_links = []
+
             cmd = [
                 "pip3",
                 "install",  # base command
                 "--target={}".format(venvpath),  # put all the resulting files in that specific dir
             ]
-            if _pip_needs_system():
+            if _pip_needs_system(**self._subprocess_kwargs):
                 logger.debug("adding --system to work around pip3 defaulting to --user")
                 cmd.append("--system")
-            for reqspath in self.requirement_paths:
-                cmd.append("--requirement={}".format(reqspath))  # the dependencies file(s)
-            retcode = _process_run(cmd)
+            if self.source_date_epoch is not None:
+                # the bytecode compiled by pip holds the temporary directory where it
+                # installs first; the reproducible one is compiled with the rest of the charm
+                cmd.append("--no-compile")
+            if find_links and self.lock_dir is None:
+                # everything is already at hand (and respecting the binary policy), so
+                # installed without using the network
+                cmd.append("--no-index")
+                cmd.extend("--find-links={}".format(path) for path in find_links)
+            else:
+                # the just resolved distributions are used if at hand, but the index is
+                # still needed for the build requirements of the sdists among them
+                cmd.extend("--find-links={}".format(path) for path in find_links)
+                cmd.extend(self._binary_policy_args())
+            if self.lock_dir is not None:
+                # everything is pinned and hashed, nothing to resolve
+                cmd.extend(["--no-deps", "--require-hashes"])
+                cmd.append("--requirement={}".format(self.lock_path))
+            else:
+                cmd.extend(self._dependencies_args())
+            try:
+                retcode = self._run(cmd)
+            finally:
+                if downloads_dir is not None:
+                    shutil.rmtree(str(downloads_dir), ignore_errors=True)
             if retcode:
                 raise CommandError("problems installing dependencies")
 
+            if cache_key is not None:
+                self._venv_to_cache(cache_key, venvpath)
+
+    @property
+    def lock_path(self) -> pathlib.Path:
+        """Return the requirements lock file for the system where the charm is built."""
+        os_platform = get_os_platform()
+        filename = REQUIREMENTS_LOCK_TEMPLATE.format(
+            name=os_platform.system, channel=os_platform.release, arch=get_host_architecture()
+        )
+        return self.lock_dir / filename
+
+    def _lock_inputs(self) -> str:
+        """Build a key identifying what the requirements are resolved from."""
+        requirements = []
+        for reqspath in self.requirement_paths or []:
+            try:
+                with open(reqspath, "rb") as fh:
+                    requirements.append(hashlib.sha256(fh.read()).hexdigest())
+            except OSError as exc:
+                raise CommandError(
+                    "cannot read the requirements file {!r}".format(reqspath)
+                ) from exc
+        key_parts = [requirements, self.python_packages or [], self.allow_pip_binary is not False]
+        return hashlib.sha256(json.dumps(key_parts).encode("utf8")).hexdigest()
+
+    def _lock_is_current(self) -> bool:
+        """Tell if the requirements lock file exists and was resolved from current inputs."""
+        try:
+            with self.lock_path.open("rt", encoding="utf8") as fh:
+                header = fh.readline()
+        except OSError:
+            return False
+        return header == REQUIREMENTS_LOCK_HEADER.format(inputs=self._lock_inputs())
+
+    def write_lock(self, downloads_dir: pathlib.Path) -> None:
+        """Resolve the requirements and write the lock file, with exact versions and hashes.
+
+        The resolved distributions are left in the given directory.
+        """
+        logger.debug("Resolving the requirements to %r", str(self.lock_path))
+        cmd = ["pip3", "download", "--dest={}".format(downloads_dir)]
+        cmd.extend(self._binary_policy_args())
+        cmd.extend(self._dependencies_args())
+        retcode = self._run(cmd)
+        if retcode:
+            raise CommandError("problems resolving dependencies")
+
+        pinned = []
+        for path in downloads_dir.iterdir():
+            name_version = _sdist_name_version(path.name)
+            if name_version is None:
+                name_version = _wheel_name_version(path.name)
+            digest = hashlib.sha256(path.read_bytes()).hexdigest()
+            pinned.append("{}=={} --hash=sha256:{}\n".format(*name_version, digest))
+
+        lines = [REQUIREMENTS_LOCK_HEADER.format(inputs=self._lock_inputs())] + sorted(pinned)
+
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        self.lock_path.write_text("".join(lines), encoding="utf8")
+
+    def _dependencies_args(self) -> List[str]:
+        """Build the pip arguments for the requirements files and extra packages."""
+        args = []
+        for reqspath in self.requirement_paths or []:
+            args.append("--requirement={}".format(reqspath))  # the dependencies file(s)
+        args.extend(self.python_packages or [])
+        return args
+
+    def _binary_policy_args(self) -> List[str]:
+        """Build the pip arguments to respect if binary packages are allowed or not."""
+        if self.allow_pip_binary is False:
+            # everything is built from source
+            return ["--no-binary=:all:"]
+        return []
+
+    @property
+    def wheels_cache_path(self) -> pathlib.Path:
+        """Return the directory for the wheels built from sdists for current pip and system."""
+        key_parts = [self._pip_version(), list(get_os_platform())]
+        subdir = hashlib.sha256(json.dumps(key_parts).encode("utf8")).hexdigest()[:16]
+        return self.cache_dir / WHEELS_CACHE_DIRNAME / subdir
+
+    def _build_wheels(self, downloads_dir: pathlib.Path) -> pathlib.Path:
+        """Build the wheels for all the dependencies only available as sdists.
+
+        The dependencies are downloaded (respecting the binary policy), and those that
+        are sdists are built concurrently, unless their wheels are already in the cache,
+        where the built ones are stored. Return the cache directory.
+        """
+        cmd = ["pip3", "download", "--dest={}".format(downloads_dir)]
+        cmd.extend(self._binary_policy_args())
+        cmd.extend(self._dependencies_args())
+        retcode = self._run(cmd)
+        if retcode:
+            raise CommandError("problems downloading dependencies")
+
+        wheels_path = self.wheels_cache_path
+        try:
+            wheels_path.mkdir(parents=True, exist_ok=True)
+        except OSError as exc:
+            # the cache is an optimization, build them anyway
+            logger.debug("Cannot use the wheels cache: %r", exc)
+            wheels_path = downloads_dir
+        cached = {_wheel_name_version(path.name) for path in wheels_path.glob("*.whl")}
+
+        to_build = []
+        for path in sorted(downloads_dir.iterdir()):
+            name_version = _sdist_name_version(path.name)
+            if name_version is None:
+                continue
+            if name_version in cached:
+                logger.debug("Using cached wheel for %s %s", *name_version)
+            else:
+                to_build.append(path)
+        if not to_build:
+            return wheels_path
+
+        workers = os.cpu_count() or 1
+        logger.debug("Building %d wheels using %d workers", len(to_build), workers)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            cmds = [
+                ["pip3", "wheel", "--no-deps", "--wheel-dir={}".format(wheels_path), str(path)]
+                for path in to_build
+            ]
+            retcodes = list(executor.map(self._run, cmds))
+        for path, retcode in zip(to_build, retcodes):
+            if retcode:
+                raise CommandError("problems building the wheel for {!r}".format(path.name))
+        return wheels_path
+
+    def handle_prune(self):
+        """Remove from the installed dependencies what is not needed at runtime.
+
+        What is removed is defined by the default patterns and those of the project, which
+        can also bring back (with "!") what the default ones remove.
+        """
+        venvpath = self.buildpath / VENV_DIRNAME
+        if not venvpath.is_dir():
+            return
+        logger.debug("Pruning dependencies")
+        cache_dir = None if self.cache_dir is None else self.cache_dir / IGNORE_CACHE_DIRNAME
+        prune_rules = JujuIgnore(VENV_PRUNE_PATTERNS, cache_dir=cache_dir)
+        prune_rules.extend_patterns(self.prune_patterns)
+
+        size_before = pruned_size = pruned_count = 0
+        for rel_basedir, dir_entries, file_entries in _walk(str(venvpath)):
+            prefix = "/{}/".format(rel_basedir) if rel_basedir else "/"
+            pruned_dirnames = prune_rules.match_many(
+                [prefix + entry.name for entry in dir_entries], [True] * len(dir_entries)
+            )
+            pruned_filenames = prune_rules.match_many(
+                [prefix + entry.name for entry in file_entries], [False] * len(file_entries)
+            )
+
+            pruned = []
+            for pos, (entry, is_pruned) in enumerate(zip(dir_entries, pruned_dirnames)):
+                if is_pruned and not entry.is_symlink():
+                    pruned.append(pos)
+                    for _, _, subfile_entries in _walk(entry.path):
+                        for subentry in subfile_entries:
+                            size = subentry.stat(follow_symlinks=False).st_size
+                            size_before += size
+                            pruned_size += size
+                            pruned_count += 1
+                    shutil.rmtree(entry.path)
+            for pos in reversed(pruned):
+                del dir_entries[pos]
+
+            for entry, is_pruned in zip(file_entries, pruned_filenames):
+                size = entry.stat(follow_symlinks=False).st_size
+                size_before += size
+                if is_pruned:
+                    pruned_size += size
+                    pruned_count += 1
+                    os.unlink(entry.path)
+
+        logger.info(
+            "Pruned %d files from the dependencies: %.2f MiB to %.2f MiB",
+            pruned_count,
+            size_before / 2 ** 20,
+            (size_before - pruned_size) / 2 ** 20,
+        )
+
+    def handle_tree_shaking(self, linked_entrypoint: pathlib.Path):
+        """Report (and remove, if configured) the installed packages the charm never imports.
+
+        The imports are followed statically from the entrypoint, through the charm's code
+        and the installed packages it uses (all the modules of a package are considered
+        when it's imported); packages imported dynamically must be kept explicitly.
+        """
+        venvpath = self.buildpath / VENV_DIRNAME
+        if not venvpath.is_dir():
+            return
+        logger.debug("Finding the installed packages the charm never imports")
+        code_dirs = [str(linked_entrypoint.parent), str(self.buildpath / "lib")]
+        installed = _installed_packages(str(venvpath))
+        reachable = _reachable_packages(str(linked_entrypoint), code_dirs, installed)
+
+        unreachable = sorted(installed.keys() - reachable - set(self.keep_packages))
+        if not unreachable:
+            logger.info("All the installed packages are imported by the charm")
+            return
+        size = sum(_tree_size(path) for name in unreachable for path in installed[name])
+        if self.tree_shaking == "remove":
+            for name in unreachable:
+                for path in installed[name]:
+                    _remove_path(path)
+            message = "Removed installed packages never imported by the charm"
+        else:
+            message = "Installed packages never imported by the charm"
+        logger.info("%s (%.2f MiB): %s", message, size / 2 ** 20, ", ".join(unreachable))
+
+    def handle_bytecode(self):
+        """Byte-compile all the Python files in the charm, so they're not compiled on each hook.
+
+        Files that can't be compiled (e.g. written for Python 2) are just reported.
+        """
+        logger.debug("Compiling bytecode")
+        retcode = self._run(["python3", "-c", COMPILE_BYTECODE_SCRIPT, str(self.buildpath)])
+        if retcode:
+            raise CommandError("problems compiling the bytecode")
+
+    def _zipimport_dirnames(self) -> List[str]:
+        """Get the directories to pack in zipimport archives (those that will be in the charm)."""
+        dirnames = []
+        for dirname in self.zipimport:
+            if dirname == VENV_DIRNAME:
+                present = bool(self.requirement_paths or self.python_packages)
+            else:
+                present = (self.buildpath / dirname).is_dir()
+            if present:
+                dirnames.append(dirname)
+        return dirnames
+
+    def handle_zipimport(self):
+        """Pack the pure Python code of the configured directories in zipimport archives.
+
+        Only the top level packages and modules with nothing but Python source and bytecode
+        are packed (and removed from the directory); the rest (extension modules, packages
+        with data files, distributions metadata, scripts, etc.) stay as real files, as they
+        need to be loaded or read from the filesystem.
+
+        Nothing is packed if the project provides its own dispatch, as only the one created
+        here puts the archives in the PYTHONPATH.
+        """
+        dirnames = self._zipimport_dirnames()
+        if dirnames and self.project_dispatch:
+            logger.warning(
+                "Not packing %s in zipimport archives, the project's dispatch would not find them",
+                " and ".join(repr(dirname) for dirname in dirnames),
+            )
+            return
+        for dirname in dirnames:
+            dirpath = self.buildpath / dirname
+            zippath = self.buildpath / (dirname + ZIPIMPORT_SUFFIX)
+            logger.debug("Packing %r in a zipimport archive", dirname)
+            packed = _write_zipimport(str(dirpath), str(zippath), self.source_date_epoch)
+
+            for path in packed:
+                _remove_path(os.path.join(str(dirpath), path))
+
+    @property
+    def venv_cache_path(self) -> pathlib.Path:
+        """Return the directory where installed dependencies are cached."""
+        return self.cache_dir / VENV_CACHE_DIRNAME
+
+    def _fill_wheelhouse(self, dependencies_key: Optional[str]) -> None:
+        """Get in the wheelhouse the wheels for all the dependencies, if not there already."""
+        stamp_path = self.wheelhouse / WHEELHOUSE_STAMP_FILENAME
+        try:
+            ready = json.loads(stamp_path.read_text())["ready"]
+        except (OSError, ValueError, KeyError, TypeError):
+            ready = []
+        if dependencies_key is not None and dependencies_key in ready:
+            logger.debug("The wheelhouse already has all the dependencies")
+            return
+
+        logger.debug("Getting the dependencies into the wheelhouse %r", str(self.wheelhouse))
+        self.wheelhouse.mkdir(parents=True, exist_ok=True)
+        cmd = [
+            "pip3",
+            "wheel",
+            "--wheel-dir={}".format(self.wheelhouse),
+            "--find-links={}".format(self.wheelhouse),  # reuse what is already there
+        ]
+        cmd.extend(self._binary_policy_args())
+        cmd.extend(self._dependencies_args())
+        retcode = self._run(cmd)
+        if retcode:
+            raise CommandError("problems getting the dependencies into the wheelhouse")
+
+        if dependencies_key is not None:
+            ready.append(dependencies_key)
+            stamp_path.write_text(json.dumps({"ready": ready}))
+
+    def _dependencies_key(self) -> Optional[str]:
+        """Build a key identifying the dependencies to install, None if not possible.
+
+        It covers what determines the installed dependencies: the requirements files
+        content (and the lock file, if used), the extra packages, the binary policy, if pip
+        compiles the bytecode (not when building reproducibly), pip and its Python version,
+        the system and architecture.
+        """
+        try:
+            pip_version = self._pip_version()
+            requirements = []
+            for reqspath in self.requirement_paths or []:
+                with open(reqspath, "rb") as fh:
+                    requirements.append(hashlib.sha256(fh.read()).hexdigest())
+            if self.lock_dir is not None:
+                # the lock has what is really installed
+                requirements.append(hashlib.sha256(self.lock_path.read_bytes()).hexdigest())
+        except OSError as exc:
+            logger.debug("Cannot identify the dependencies: %r", exc)
+            return None
+
+        key_parts = [
+            DEPENDENCIES_KEY_FORMAT,
+            pip_version,
+            list(get_os_platform()),
+            requirements,
+            self.python_packages or [],
+            self.allow_pip_binary is not False,
+            self.source_date_epoch is None,
+        ]
+        return hashlib.sha256(json.dumps(key_parts).encode("utf8")).hexdigest()
+
+    def _pip_version(self) -> str:
+        """Get the pip version, which also informs the Python version it uses."""
+        proc = subprocess.run(
+            ["pip3", "--version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            **self._subprocess_kwargs,
+        )
+        return proc.stdout.strip()
+
+    def _venv_from_cache(self, cache_key: str, venvpath: pathlib.Path) -> bool:
+        """Link the cached dependencies in the venv path, if present."""
+        cached_path = self.venv_cache_path / cache_key
+        if not cached_path.is_dir():
+            logger.debug("Dependencies not found in cache")
+            return False
+        if venvpath.exists():
+            # something is already there, let pip deal with it
+            return False
+
+        logger.debug("Using dependencies from cache: %r", str(cached_path))
+        try:
+            # mark it as recently used
+            os.utime(str(cached_path.with_suffix(".json")))
+        except OSError:
+            pass
+        self.link_files(_prepare_tree(str(cached_path), str(venvpath)))
+        return True
+
+    def _venv_to_cache(self, cache_key: str, venvpath: pathlib.Path) -> None:
+        """Store the installed dependencies in the cache, removing the least used ones."""
+        cached_path = self.venv_cache_path / cache_key
+        temp_path = cached_path.with_suffix(".tmp-{}".format(os.getpid()))
+        try:
+            if temp_path.exists():
+                shutil.rmtree(str(temp_path))
+            self.venv_cache_path.mkdir(parents=True, exist_ok=True)
+            to_link = _prepare_tree(str(venvpath), str(temp_path))
+            self.link_files(to_link)
+            size = sum(os.stat(src).st_size for src, _ in to_link)
+            cached_path.with_suffix(".json").write_text(json.dumps({"size": size}))
+            temp_path.rename(cached_path)
+        except OSError as exc:
+            # the cache is an optimization, no reason to fail the build
+            logger.debug("Cannot store the dependencies in cache: %r", exc)
+            shutil.rmtree(str(temp_path), ignore_errors=True)
+            return
+
+        logger.debug("Stored dependencies in cache: %r", str(cached_path))
+        self._clean_venv_cache(keep=cache_key)
+
+    def _clean_venv_cache(self, keep: str) -> None:
+        """Remove the least recently used cached dependencies if the cache is too big."""
+        entries = []
+        for meta_path in self.venv_cache_path.glob("*.json"):
+            try:
+                size = json.loads(meta_path.read_text())["size"]
+                last_used = meta_path.stat().st_mtime
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            entries.append((last_used, size, meta_path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, meta_path in sorted(entries):
+            if total_size <= self.venv_cache_size:
+                break
+            if meta_path.stem == keep:
+                continue
+            logger.debug("Removing dependencies from cache: %r", meta_path.stem)
+            shutil.rmtree(str(meta_path.with_suffix("")), ignore_errors=True)
+            meta_path.unlink()
+            total_size -= size
+
+
+def _walk(top: str):
+    """Walk the tree from top, like os.walk without following symlinks, but giving entries.
+
+    For each directory (top-down) yield its path relative to top ("" for top itself) and the
+    lists of os.DirEntry for the directories and the rest of the nodes in it, so the type and
+    stat information they cache can be reused. As with os.walk, the caller can remove
+    entries from the directories list to not walk them.
+    """
+    pending = [""]
+    while pending:
+        rel_dirpath = pending.pop()
+        try:
+            with os.scandir(os.path.join(top, rel_dirpath)) as scanner:
+                entries = list(scanner)
+        except OSError:
+            # silently ignored, as os.walk does
+            continue
+
+        dir_entries = []
+        file_entries = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                dir_entries.append(entry)
+            else:
+                file_entries.append(entry)
+
+        yield rel_dirpath, dir_entries, file_entries
+
+        # walk the subdirectories in order, but never through symlinks
+        for entry in reversed(dir_entries):
+            if not entry.is_symlink():
+                pending.append(os.path.join(rel_dirpath, entry.name))
+
+
+def _prepare_tree(src_dir: str, dest_dir: str) -> List[Tuple[str, str]]:
+    """Replicate the directories and symlinks of a tree, to then link the files.
+
+    Return the files to link, as (source, destination) pairs.
+    """
+    to_link = []
+    os.mkdir(dest_dir)
+    for rel_basedir, dir_entries, file_entries in _walk(src_dir):
+        for entry in dir_entries + file_entries:
+            dest_path = os.path.join(dest_dir, rel_basedir, entry.name)
+            if entry.is_symlink():
+                os.symlink(os.readlink(entry.path), dest_path)
+            elif entry.is_dir():
+                os.mkdir(dest_path, entry.stat().st_mode)
+            elif entry.is_file():
+                to_link.append((entry.path, dest_path))
+    return to_link
+
+
+def _is_zipimportable(entry: os.DirEntry) -> bool:
+    """Tell if the top level node can be imported from a zipimport archive.
+
+    That is a Python module, or a (regular or namespace) package with only Python files
+    (and the "py.typed" marker) in it.
+    """
+    if entry.is_symlink():
+        return False
+    if not entry.is_dir():
+        return entry.name.endswith(".py")
+    if not entry.name.isidentifier() or entry.name == "__pycache__":
+        # not importable, e.g. distribution metadata
+        return False
+    for rel_dirpath, dir_entries, file_entries in _walk(entry.path):
+        if any(subentry.is_symlink() for subentry in dir_entries):
+            return False
+        for subentry in file_entries:
+            if subentry.is_symlink() or not (
+                subentry.name.endswith((".py", ".pyc")) or subentry.name == "py.typed"
+            ):
+                return False
+    return True
+
+
+def _bytecode_path(source_path: str) -> Optional[str]:
+    """Get the path of the bytecode of the source file in the "__pycache__" dir, if any."""
+    dirpath, filename = os.path.split(source_path)
+    pycache_dirpath = os.path.join(dirpath, "__pycache__")
+    prefix = filename[: -len(".py")] + "."
+    try:
+        names = os.listdir(pycache_dirpath)
+    except OSError:
+        return None
+    # only one bytecode can be in the archive, usually there is only the one from the
+    # Python that installed or compiled them; if it's not for the Python running the
+    # charm it's just ignored
+    candidates = sorted(n for n in names if n.startswith(prefix) and n.endswith(".pyc"))
+    if candidates:
+        return os.path.join(pycache_dirpath, candidates[-1])
+
+
+def _zip_write(
+    zf: zipfile.ZipFile, path: str, arcname: str, date_time: Optional[Tuple[int, ...]]
+) -> None:
+    """Write the file or directory in the archive.
+
+    If a date is given, the member gets it instead of the modification time, and the usual
+    permissions (respecting only if it's executable), so the archive is reproducible.
+    """
+    if date_time is None:
+        zf.write(path, arcname)
+        return
+    info = zipfile.ZipInfo.from_file(path, arcname)
+    info.date_time = date_time
+    info.compress_type = zf.compression
+    if info.is_dir():
+        info.external_attr = (0o40755 << 16) | 0x10
+        zf.writestr(info, b"")
+        return
+    filemode = info.external_attr >> 16
+    info.external_attr = (0o100755 if filemode & 0o111 else 0o100644) << 16
+    with open(path, "rb") as src, zf.open(info, "w") as dest:
+        shutil.copyfileobj(src, dest)
+
+
+def _zip_module(
+    zf: zipfile.ZipFile, path: str, arcname: str, date_time: Optional[Tuple[int, ...]] = None
+) -> Optional[str]:
+    """Write the file in the archive, with its bytecode next to it if it's a Python module.
+
+    Return the path of the bytecode written, if any.
+    """
+    _zip_write(zf, path, arcname, date_time)
+    if not path.endswith(".py") or os.path.exists(path + "c"):
+        return None
+    bytecode_path = _bytecode_path(path)
+    if bytecode_path is not None:
+        _zip_write(zf, bytecode_path, arcname + "c", date_time)
+    return bytecode_path
+
+
+def _write_zipimport(dirpath: str, zippath: str, source_date_epoch: int = None) -> List[str]:
+    """Write a zipimport archive with the top level nodes of the directory that support it.
+
+    The bytecode is stored next to its source, as zipimport does not use "__pycache__"
+    dirs. The members are compressed, as the archive is stored as it is in the charm (see
+    packing.DEFAULT_STORED_PATTERNS). If the date of the source is given (in seconds since
+    the epoch), all the members get it. Return the names of the nodes packed.
+    """
+    date_time = None
+    if source_date_epoch is not None:
+        # the zip format can't hold dates before 1980
+        date_time = time.gmtime(max(source_date_epoch, ZIP_MIN_EPOCH))[:6]
+    packed = []
+    with zipfile.ZipFile(zippath, "w", zipfile.ZIP_DEFLATED) as zf:
+        for entry in sorted(os.scandir(dirpath), key=lambda entry: entry.name):
+            if not _is_zipimportable(entry):
+                logger.debug("Not packing %r in the zipimport archive", entry.name)
+                continue
+            packed.append(entry.name)
+
+            if not entry.is_dir():
+                bytecode_path = _zip_module(zf, entry.path, entry.name, date_time)
+                if bytecode_path is not None:
+                    # the top level "__pycache__" dir is not removed, as it's shared
+                    os.unlink(bytecode_path)
+                continue
+
+            for rel_dirpath, dir_entries, file_entries in _walk(entry.path):
+                dir_entries[:] = sorted(
+                    (e for e in dir_entries if e.name != "__pycache__"), key=lambda e: e.name
+                )
+                # explicit directories, needed to find namespace packages
+                arc_dirpath = os.path.join(entry.name, rel_dirpath)
+                _zip_write(zf, os.path.join(entry.path, rel_dirpath), arc_dirpath, date_time)
+                for file_entry in sorted(file_entries, key=lambda e: e.name):
+                    _zip_module(
+                        zf, file_entry.path, os.path.join(arc_dirpath, file_entry.name), date_time
+                    )
+    return packed
+
+
+def _get_imports(filepath: str) -> Iterator[Tuple[int, List[str]]]:
+    """Parse a Python file and yield its imports, as the level and the names split by dots.
+
+    If the file cannot be read or parsed, nothing is yielded. For "from" imports the
+    imported names are also yielded after the module, as they may be submodules.
+    """
+    try:
+        with open(filepath, "rb") as fh:
+            parsed = ast.parse(fh.read())
+    except (OSError, SyntaxError, ValueError):
+        return
+
+    for node in ast.walk(parsed):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                yield 0, alias.name.split(".")
+        elif isinstance(node, ast.ImportFrom):
+            module_parts = node.module.split(".") if node.module else []
+            if module_parts:
+                yield node.level, module_parts
+            for alias in node.names:
+                if alias.name != "*":
+                    yield node.level, module_parts + [alias.name]
+
+
+def _module_files(base_dirs: List[str], parts: List[str]) -> List[str]:
+    """Get the files of the module and its parent packages, in the first dir they're found."""
+    for base_dir in base_dirs:
+        files = []
+        dirpath = base_dir
+        for part in parts:
+            module_path = os.path.join(dirpath, part)
+            if os.path.isfile(module_path + ".py"):
+                files.append(module_path + ".py")
+                break
+            if not os.path.isdir(module_path):
+                break
+            init_path = os.path.join(module_path, "__init__.py")
+            if os.path.isfile(init_path):
+                files.append(init_path)
+            dirpath = module_path
+        if files:
+            return files
+    return []
+
+
+def _python_files(path: str) -> List[str]:
+    """Get all the Python files in the path (a module or a package)."""
+    if not os.path.isdir(path):
+        return [path] if path.endswith(".py") else []
+    files = []
+    for rel_dirpath, _, file_entries in _walk(path):
+        files.extend(entry.path for entry in file_entries if entry.name.endswith(".py"))
+    return files
+
+
+def _installed_packages(venv_dir: str) -> Dict[str, List[str]]:
+    """Get the top level importable names in the venv, with the paths that provide them."""
+    installed = collections.defaultdict(list)
+    for entry in os.scandir(venv_dir):
+        if entry.is_dir():
+            # only packages (regular or namespace ones), not scripts or data dirs
+            if not any(
+                file_entry.name.endswith((".py", ".so"))
+                for _, _, file_entries in _walk(entry.path)
+                for file_entry in file_entries
+            ):
+                continue
+            name = entry.name
+        elif entry.name.endswith((".py", ".so")):
+            # modules, including extension ones like "name.cpython-38-x86_64-linux-gnu.so"
+            name = entry.name.split(".")[0]
+        else:
+            continue
+        if name.isidentifier() and name != "__pycache__":
+            installed[name].append(entry.path)
+    return installed
+
+
+def _reachable_packages(
+    entrypoint: str, code_dirs: List[str], installed: Dict[str, List[str]]
+) -> Set[str]:
+    """Follow the imports from the entrypoint and get the installed packages reached.
+
+    The imports are resolved first in the charm's code dirs (the only modules followed
+    there are those imported), then in the installed packages (all their modules are
+    followed once they are imported).
+    """
+    reachable = set()
+    pending = [entrypoint]
+    seen = set()
+    while pending:
+        filepath = pending.pop()
+        if filepath in seen:
+            continue
+        seen.add(filepath)
+        for level, parts in _get_imports(filepath):
+            if level:
+                # relative imports, resolved from the package of the importing module
+                base_dir = filepath
+                for _ in range(level):
+                    base_dir = os.path.dirname(base_dir)
+                pending.extend(_module_files([base_dir], parts))
+                continue
+            module_files = _module_files(code_dirs, parts)
+            if module_files:
+                pending.extend(module_files)
+            elif parts[0] in installed and parts[0] not in reachable:
+                reachable.add(parts[0])
+                for path in installed[parts[0]]:
+                    pending.extend(_python_files(path))
+    return reachable
+
+
+def _external_imports(
+    entrypoint: str, code_dirs: List[str], installed: Dict[str, List[str]]
+) -> Set[str]:
+    """Follow the imports from the entrypoint through the charm's code and get those external.
+
+    External imports are the top level names that are not resolved in the charm's code
+    dirs nor in the installed packages, and are not from the standard library.
+    """
+    external = set()
+    pending = [entrypoint]
+    seen = set()
+    while pending:
+        filepath = pending.pop()
+        if filepath in seen:
+            continue
+        seen.add(filepath)
+        for level, parts in _get_imports(filepath):
+            if level:
+                base_dir = filepath
+                for _ in range(level):
+                    base_dir = os.path.dirname(base_dir)
+                pending.extend(_module_files([base_dir], parts))
+                continue
+            module_files = _module_files(code_dirs, parts)
+            if module_files:
+                pending.extend(module_files)
+                continue
+            # namespace packages have no files of their own
+            in_code_dirs = any(
+                os.path.isdir(os.path.join(code_dir, parts[0])) for code_dir in code_dirs
+            )
+            if not in_code_dirs and parts[0] not in installed and not _is_stdlib_module(parts[0]):
+                external.add(parts[0])
+    return external
+
+
+def _is_stdlib_module(name: str) -> bool:
+    """Tell if the top level module is from the standard library of the running Python."""
+    if name in sys.builtin_module_names:
+        return True
+    stdlib_module_names = getattr(sys, "stdlib_module_names", None)  # Python >= 3.10
+    if stdlib_module_names is not None:
+        return name in stdlib_module_names
+
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return False
+    if spec is None:
+        return False
+    if spec.origin == "frozen":
+        return True
+    if spec.origin and spec.has_location:
+        path = spec.origin
+    elif spec.submodule_search_locations:
+        path = list(spec.submodule_search_locations)[0]
+    else:
+        return False
+    stdlib_dir = os.path.realpath(sysconfig.get_paths()["stdlib"])
+    path = os.path.realpath(path)
+    if not path.startswith(stdlib_dir + os.sep):
+        return False
+    # not from a site-packages (or dist-packages) dir inside the stdlib one
+    return not any(part.endswith("-packages") for part in path.split(os.sep))
+
+
+def _shebang_interpreter(filepath: str) -> List[str]:
+    """Get the interpreter command of the script from its shebang, skipping `env`.
 
-def _pip_needs_system():
+    If the script has no shebang (or it is not for Python) the default interpreter is used.
+    """
+    try:
+        with open(filepath, "rb") as fh:
+            first_line = fh.readline()
+    except OSError:
+        first_line = b""
+    if not first_line.startswith(b"#!"):
+        return [DEFAULT_INTERPRETER]
+
+    interpreter = first_line[2:].decode("utf8", errors="replace").split()
+    if interpreter and os.path.basename(interpreter[0]) == "env":
+        # the interpreter is searched in the PATH, like the shell does when running it
+        interpreter = interpreter[1:]
+        while interpreter and interpreter[0].startswith("-"):
+            interpreter = interpreter[1:]
+    if not interpreter or not os.path.basename(interpreter[0]).startswith("python"):
+        return [DEFAULT_INTERPRETER]
+    return interpreter
+
+
+def _tree_size(path: str) -> int:
+    """Get the total size of the files in the path (a file or a directory)."""
+    if not os.path.isdir(path):
+        return os.lstat(path).st_size
+    return sum(
+        entry.stat(follow_symlinks=False).st_size
+        for _, _, file_entries in _walk(path)
+        for entry in file_entries
+    )
+
+
+def _normalize_name(name: str) -> str:
+    """Normalize a distribution name as done for wheel file names."""
+    return re.sub(r"[-_.]+", "_", name).lower()
+
+
+def _wheel_name_version(filename: str) -> Tuple[str, str]:
+    """Get the normalized name and the version from a wheel file name."""
+    name, version = filename.split("-")[:2]
+    return _normalize_name(name), version
+
+
+def _sdist_name_version(filename: str) -> Optional[Tuple[str, str]]:
+    """Get the normalized name and the version from a sdist file name, None if not a sdist."""
+    for extension in SDIST_EXTENSIONS:
+        if filename.endswith(extension):
+            name, _, version = filename[: -len(extension)].rpartition("-")
+            return _normalize_name(name), version
+
+
+def _remove_path(path: str) -> None:
+    """Remove whatever is in the path (if anything), not following symlinks."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def _link_or_copy(src: str, dest: str) -> str:
+    """Hard link the file, copying it if that's not possible; return the strategy used."""
+    try:
+        os.link(src, dest)
+    except PermissionError:
+        # when not allowed to create hard links
+        return _copy_file(src, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        return _copy_file(src, dest)
+    return "hardlink"
+
+
+def _link_or_copy_many(to_link: List[Tuple[str, str]]) -> collections.Counter:
+    """Link or copy the (source, destination) pairs in order, stopping at the first error.
+
+    Return how many files were processed with each strategy.
+    """
+    strategies = collections.Counter()
+    for src, dest in to_link:
+        strategies[_link_or_copy(src, dest)] += 1
+    return strategies
+
+
+def _copy_file(src: str, dest: str) -> str:
+    """Copy the file content and metadata (like shutil.copy2) the cheapest possible way.
+
+    The content is cloned if the filesystem supports it (the files share their blocks
+    until modified), else copied inside the kernel, and only if none of that is
+    possible the data goes through user space. Return the strategy used.
+    """
+    with open(src, "rb") as src_fh, open(dest, "wb") as dest_fh:
+        src_fd = src_fh.fileno()
+        dest_fd = dest_fh.fileno()
+        size = os.fstat(src_fd).st_size
+
+        if fcntl is not None and _try_copy(lambda: fcntl.ioctl(dest_fd, FICLONE, src_fd)):
+            strategy = "reflink"
+        elif hasattr(os, "copy_file_range") and _try_copy_chunks(
+            lambda: os.copy_file_range(src_fd, dest_fd, COPY_CHUNK_SIZE), size
+        ):
+            strategy = "copy_file_range"
+        elif hasattr(os, "sendfile") and _try_copy_chunks(
+            lambda: os.sendfile(dest_fd, src_fd, None, COPY_CHUNK_SIZE), size
+        ):
+            strategy = "sendfile"
+        else:
+            shutil.copyfileobj(src_fh, dest_fh)
+            strategy = "buffered"
+
+    shutil.copystat(src, dest)
+    return strategy
+
+
+def _try_copy(copy_function) -> bool:
+    """Copy using the function, return False if the strategy is not supported."""
+    try:
+        copy_function()
+    except OSError as exc:
+        if exc.errno in COPY_UNSUPPORTED_ERRNOS:
+            return False
+        raise
+    return True
+
+
+def _try_copy_chunks(copy_function, size: int) -> bool:
+    """Copy calling the function until all is done, return False if not supported.
+
+    The strategy is considered not supported if it fails (or doesn't copy anything for
+    a non empty file) in the first call, so nothing was copied yet.
+    """
+    try:
+        copied = copy_function()
+    except OSError as exc:
+        if exc.errno in COPY_UNSUPPORTED_ERRNOS:
+            return False
+        raise
+    if not copied and size:
+        # some filesystems don't report the problem, just copy nothing
+        return False
+
+    while copied:
+        copied = copy_function()
+    return True
+
+
+def _pip_needs_system(**kwargs):
     """Determine whether pip3 defaults to --user, needing --system to turn it off."""
     cmd = [
         "python3",
@@ -254,11 +1593,11 @@ def _pip_needs_system():
             'assert InstallCommand().cmd_opts.get_option("--system") is not None'
         ),
     ]
-    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **kwargs)
     return proc.returncode == 0
 
 
-def _process_run(cmd) -> int:
+def _process_run(cmd, **kwargs) -> int:
     logger.debug("Running external command %s", cmd)
     try:
         proc = subprocess.Popen(
@@ -266,6 +1605,7 @@ def _process_run(cmd) -> int:
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             universal_newlines=True,
+            **kwargs,
         )
     except Exception as err:
         logger.error("Executing %s crashed with %r", cmd, err)
@@ -281,7 +1621,7 @@ def _process_run(cmd) -> int:
     return retcode
 
 
-def _parse_arguments() -> argparse.Namespace:
+def _parse_arguments(arguments: List[str] = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--entrypoint",
@@ -309,8 +1649,187 @@ def _parse_arguments() -> argparse.Namespace:
         default=None,
         help="Comma-separated list of requirements files.",
     )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="dirname",
+        default=None,
+        help="The directory to keep information reusable between builds.",
+    )
+    parser.add_argument(
+        "--explain-ignores",
+        action="store_true",
+        help="Report which ignore rule discarded each path and the time spent in each rule.",
+    )
+    parser.add_argument(
+        "--link-workers",
+        metavar="N",
+        type=int,
+        default=1,
+        help="How many files to link or copy concurrently. Default is 1.",
+    )
+    parser.add_argument(
+        "--venv-cache",
+        action="store_true",
+        help="Reuse the installed dependencies of previous builds, kept in the cache directory.",
+    )
+    parser.add_argument(
+        "--wheels-cache",
+        action="store_true",
+        help="Build the sdists dependencies into wheels kept in the cache directory.",
+    )
+    parser.add_argument(
+        "--wheelhouse",
+        metavar="dirname",
+        default=None,
+        help="Keep the dependencies wheels there, to install them without network access.",
+    )
+    parser.add_argument(
+        "-p",
+        "--python-package",
+        metavar="package",
+        action="append",
+        default=None,
+        help="Python package to install, besides those in the requirements files.",
+    )
+    parser.add_argument(
+        "--compile-bytecode",
+        action="store_true",
+        help="Include the compiled bytecode of all the Python files in the charm.",
+    )
+    parser.add_argument(
+        "--disallow-pip-binary",
+        action="store_true",
+        help="Build all the Python packages from source, instead of using binary ones.",
+    )
+    parser.add_argument(
+        "--prune-venv",
+        action="store_true",
+        help="Remove from the installed dependencies what is not needed at runtime.",
+    )
+    parser.add_argument(
+        "--prune-pattern",
+        metavar="pattern",
+        action="append",
+        default=None,
+        help="Extra .jujuignore-like pattern of what to remove (or keep, with '!') when pruning.",
+    )
+    parser.add_argument(
+        "--tree-shaking",
+        choices=["report", "remove"],
+        default=None,
+        help="Report (or remove) the installed packages the charm never imports.",
+    )
+    parser.add_argument(
+        "--keep-package",
+        metavar="name",
+        action="append",
+        default=None,
+        help="Installed package imported dynamically, to never be removed by tree shaking.",
+    )
+    parser.add_argument(
+        "--lock-dir",
+        metavar="dirname",
+        default=None,
+        help="Install the requirements from the lock file for this system kept there.",
+    )
+    parser.add_argument(
+        "--relock",
+        action="store_true",
+        help="Resolve the requirements again for the lock file, even if it's current.",
+    )
+    parser.add_argument(
+        "--concurrent-dependencies",
+        action="store_true",
+        help="Install the dependencies while the charm files are linked.",
+    )
+    parser.add_argument(
+        "--dispatch-mode",
+        choices=DISPATCH_MODES,
+        default="classic",
+        help="How the created dispatch script runs the entrypoint. Default is 'classic'.",
+    )
+    parser.add_argument(
+        "--dispatch-skip-site",
+        action="store_true",
+        help="Make the fast dispatch skip the site initialisation, if the charm allows it.",
+    )
+    parser.add_argument(
+        "--source-date-epoch",
+        metavar="seconds",
+        type=int,
+        default=None,
+        help="Build reproducibly, with this date (seconds since the epoch) for what is generated.",
+    )
+    parser.add_argument(
+        "--zipimport",
+        metavar="dirname",
+        action="append",
+        choices=PYTHONPATH_DIRNAMES,
+        default=None,
+        help="Pack the pure Python code in the directory in a zipimport archive.",
+    )
+
+    return parser.parse_args(arguments)
+
+
+def _get_builder(
+    options: argparse.Namespace,
+    environment: Dict[str, str] = None,
+    work_dir: pathlib.Path = None,
+) -> CharmBuilder:
+    """Create the charm builder for the parsed command line options."""
+    return CharmBuilder(
+        charmdir=pathlib.Path(options.charmdir),
+        builddir=pathlib.Path(options.builddir),
+        entrypoint=pathlib.Path(options.entrypoint),
+        requirements=options.requirement,
+        python_packages=options.python_package,
+        allow_pip_binary=not options.disallow_pip_binary,
+        compile_bytecode=options.compile_bytecode,
+        explain_ignores=options.explain_ignores,
+        cache_dir=pathlib.Path(options.cache_dir) if options.cache_dir else None,
+        link_workers=options.link_workers,
+        venv_cache=options.venv_cache,
+        wheels_cache=options.wheels_cache,
+        wheelhouse=pathlib.Path(options.wheelhouse) if options.wheelhouse else None,
+        zipimport=options.zipimport,
+        prune_venv=options.prune_venv,
+        prune_patterns=options.prune_pattern,
+        tree_shaking=options.tree_shaking,
+        keep_packages=options.keep_package,
+        lock_dir=pathlib.Path(options.lock_dir) if options.lock_dir else None,
+        relock=options.relock,
+        dispatch_mode=options.dispatch_mode,
+        dispatch_skip_site=options.dispatch_skip_site,
+        concurrent_dependencies=options.concurrent_dependencies,
+        source_date_epoch=options.source_date_epoch,
+        environment=environment,
+        work_dir=work_dir,
+    )
 
-    return parser.parse_args()
+
+def build_in_process(
+    arguments: List[str], environment: Dict[str, str], work_dir: pathlib.Path
+) -> Dict[str, float]:
+    """Build the charm in the calling process, as the command-line interface would.
+
+    The relative paths in the arguments are taken from the work dir, and the builder's
+    subprocesses (pip, the interpreter to compile bytecode) run there getting only the
+    given environment, as if the interface was run isolated with it. The process' own
+    environment and working directory are not touched.
+
+    :returns: How long each phase of the build took, in seconds.
+    """
+    options = _parse_arguments(arguments)
+    for name in PATH_OPTIONS:
+        value = getattr(options, name)
+        if isinstance(value, list):
+            setattr(options, name, [os.path.join(str(work_dir), path) for path in value])
+        elif value is not None:
+            setattr(options, name, os.path.join(str(work_dir), value))
+    builder = _get_builder(options, environment=environment, work_dir=work_dir)
+    builder.build_charm()
+    return builder.timings
 
 
 def main():
@@ -321,12 +1840,7 @@ def main():
 
     logger.debug("Starting charm builder")
 
-    builder = CharmBuilder(
-        charmdir=pathlib.Path(options.charmdir),
-        builddir=pathlib.Path(options.builddir),
-        entrypoint=pathlib.Path(options.entrypoint),
-        requirements=options.requirement,
-    )
+    builder = _get_builder(options)
     builder.build_charm()
 
 
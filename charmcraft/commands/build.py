@@ -16,14 +16,16 @@
 
 """Infrastructure for the 'build' command."""
 
+import calendar
+import datetime
 import logging
 import os
 import pathlib
 import subprocess
-import zipfile
+import tempfile
 from typing import List, Optional
 
-from charmcraft import linters, parts
+from charmcraft import charm_builder, linters, parts
 from charmcraft.bases import check_if_base_matches_host
 from charmcraft.cmdbase import BaseCommand, CommandError
 from charmcraft.config import Base, BasesConfiguration, Config
@@ -31,13 +33,16 @@ from charmcraft.deprecations import notify_deprecation
 from charmcraft.env import (
     get_managed_environment_home_path,
     get_managed_environment_project_path,
+    get_source_date_epoch,
     is_charmcraft_running_in_managed_mode,
 )
 from charmcraft.logsetup import message_handler
 from charmcraft.manifest import create_manifest
 from charmcraft.metadata import parse_metadata_yaml
+from charmcraft.packing import MIN_TIMESTAMP, CompressionPolicy, build_zip
 from charmcraft.parts import Step
 from charmcraft.providers import capture_logs_from_instance, get_provider
+from charmcraft.utils import get_host_architecture
 
 logger = logging.getLogger(__name__)
 
@@ -108,6 +113,36 @@ def format_charm_file_name(
     return "_".join([charm_name, _format_bases_config(bases_config)]) + ".charm"
 
 
+def get_compression_policy(config: Config) -> CompressionPolicy:
+    """Get the policy to compress the package files from the packing configuration."""
+    return CompressionPolicy(
+        level=config.packing.compression_level,
+        stored_patterns=config.packing.store,
+        store_incompressible=config.packing.store_incompressible,
+    )
+
+
+def get_started_at(config: Config) -> datetime.datetime:
+    """Get when the build started, which can be set through SOURCE_DATE_EPOCH.
+
+    :raises CommandError: if SOURCE_DATE_EPOCH is not a timestamp.
+    """
+    return get_source_date_epoch() or config.project.started_at
+
+
+def get_packing_timestamp(config: Config) -> Optional[datetime.datetime]:
+    """Get the timestamp for all the package content, if it must be reproducible.
+
+    It's when the build started if it was set through SOURCE_DATE_EPOCH, else the oldest
+    date the package format can hold. It's None if the package is not reproducible.
+
+    :raises CommandError: if SOURCE_DATE_EPOCH is not a timestamp.
+    """
+    if not config.packing.reproducible:
+        return None
+    return get_source_date_epoch() or MIN_TIMESTAMP
+
+
 def polite_exec(cmd):
     """Execute a command, only showing output if error."""
     logger.debug("Running external command %s", cmd)
@@ -144,6 +179,7 @@ class Builder:
         self.entrypoint = args["entrypoint"]
         self.requirement_paths = args["requirement"]
         self.force_packing = args["force"]
+        self.explain_ignores = args["explain_ignores"]
 
         self.buildpath = self.charmdir / BUILD_DIRNAME
         self.config = config
@@ -208,6 +244,25 @@ class Builder:
         # add charm files to the prime filter
         self._set_prime_filter()
 
+        # let the charm builder report on the ignore rules
+        if self.explain_ignores:
+            self._charm_part["charm-explain-ignores"] = True
+
+        # the wheelhouse is kept in the project, to persist between builds
+        if self._charm_part.get("charm-wheelhouse"):
+            wheelhouse = self.charmdir / self._charm_part["charm-wheelhouse"]
+            self._charm_part["charm-wheelhouse"] = str(wheelhouse)
+
+        # also the requirements lock files
+        if self._charm_part.get("charm-lock-dir"):
+            lock_dir = self.charmdir / self._charm_part["charm-lock-dir"]
+            self._charm_part["charm-lock-dir"] = str(lock_dir)
+
+        # what the charm builder generates must be as reproducible as the package
+        timestamp = get_packing_timestamp(self.config)
+        if timestamp is not None:
+            self._charm_part["charm-source-date-epoch"] = calendar.timegm(timestamp.timetuple())
+
         # set source for buiding
         self._charm_part["source"] = str(self.charmdir)
 
@@ -219,6 +274,14 @@ class Builder:
             ignore_local_sources=["*.charm"],
         )
         lifecycle.run(Step.PRIME)
+        if lifecycle.charm_build_timings:
+            logger.debug(
+                "Charm built in-process: %s",
+                ", ".join(
+                    "{} {:.3f}s".format(phase, secs)
+                    for phase, secs in lifecycle.charm_build_timings.items()
+                ),
+            )
 
         # run linters and show the results
         linting_results = linters.analyze(self.config, lifecycle.prime_dir)
@@ -226,7 +289,7 @@ class Builder:
 
         create_manifest(
             lifecycle.prime_dir,
-            self.config.project.started_at,
+            get_packing_timestamp(self.config) or get_started_at(self.config),
             bases_config,
             linting_results,
         )
@@ -235,6 +298,37 @@ class Builder:
         logger.info("Created '%s'.", zipname)
         return zipname
 
+    def lock_requirements(self) -> str:
+        """Resolve the charm requirements for the current system and write the lock file.
+
+        :returns: Path of the lock file, relative to the project.
+        """
+        self._handle_deprecated_cli_arguments()
+        if not self._charm_part.get("charm-lock-dir"):
+            raise CommandError(
+                "The 'charm-lock-dir' property of the 'charm' part must be set "
+                "to lock the requirements."
+            )
+        requirements = self._charm_part["charm-requirements"]
+        python_packages = self._charm_part.get("charm-python-packages", [])
+        if not requirements and not python_packages:
+            raise CommandError("The charm has no requirements to lock.")
+
+        builder = charm_builder.CharmBuilder(
+            charmdir=self.charmdir,
+            builddir=self.buildpath,
+            entrypoint=self.charmdir / self._charm_part["charm-entrypoint"],
+            requirements=[str(self.charmdir / path) for path in requirements],
+            python_packages=python_packages,
+            allow_pip_binary=self._charm_part.get("charm-allow-pip-binary", True),
+            lock_dir=self.charmdir / self._charm_part["charm-lock-dir"],
+        )
+        with tempfile.TemporaryDirectory(prefix="charmcraft-downloads-") as downloads_dir:
+            builder.write_lock(pathlib.Path(downloads_dir))
+        lock_name = str(builder.lock_path.relative_to(self.charmdir))
+        logger.info("Locked the requirements in %r.", lock_name)
+        return lock_name
+
     def _handle_deprecated_cli_arguments(self):
         # verify if deprecated --requirement is used and update the plugin property
         if self._charm_part.get("charm-requirements"):
@@ -278,6 +372,7 @@ class Builder:
         - A set of mandatory charm files, including metadata.yaml, the
           dispatcher and the hooks directory.
         - A set of optional charm files.
+        - The zipimport archives of the venv and lib directories, if configured.
         """
         # add entrypoint
         entrypoint = pathlib.Path(self._charm_part["charm-entrypoint"])
@@ -288,9 +383,12 @@ class Builder:
             # the entry point is in a subdir, include the whole subtree
             self._prime.append(str(entrypoint.parts[0]))
 
-        # add venv if there are requirements
-        if self._charm_part["charm-requirements"]:
+        # add venv if there are requirements or packages
+        zipimport = self._charm_part.get("charm-zipimport", [])
+        if self._charm_part["charm-requirements"] or self._charm_part.get("charm-python-packages"):
             self._prime.append(VENV_DIRNAME)
+            if VENV_DIRNAME in zipimport:
+                self._prime.append(VENV_DIRNAME + charm_builder.ZIPIMPORT_SUFFIX)
 
         # add mandatory and optional charm files
         self._prime.extend(CHARM_FILES)
@@ -298,9 +396,14 @@ class Builder:
             path = self.charmdir / fn
             if path.exists():
                 self._prime.append(fn)
+                if fn in zipimport:
+                    self._prime.append(fn + charm_builder.ZIPIMPORT_SUFFIX)
 
     def run(
-        self, bases_indices: Optional[List[int]] = None, destructive_mode: bool = False
+        self,
+        bases_indices: Optional[List[int]] = None,
+        destructive_mode: bool = False,
+        lock: bool = False,
     ) -> List[str]:
         """Run build process.
 
@@ -309,7 +412,9 @@ class Builder:
         each base configuration that is incompatible.  Error if unable to
         produce any builds for any bases configuration.
 
-        :returns: List of charm files created.
+        If `lock` is True the charm is not built, but its requirements locked.
+
+        :returns: List of charm files created (or lock files written).
         """
         charms: List[str] = []
 
@@ -347,12 +452,16 @@ class Builder:
                         build_on_index,
                     )
                     if managed_mode or destructive_mode:
-                        charm_name = self.build_charm(bases_config)
+                        if lock:
+                            charm_name = self.lock_requirements()
+                        else:
+                            charm_name = self.build_charm(bases_config)
                     else:
                         charm_name = self.pack_charm_in_instance(
                             bases_index=bases_index,
                             build_on=build_on,
                             build_on_index=build_on_index,
+                            lock=lock,
                         )
 
                     charms.append(charm_name)
@@ -378,10 +487,18 @@ class Builder:
         return charms
 
     def pack_charm_in_instance(
-        self, *, bases_index: int, build_on: Base, build_on_index: int
+        self, *, bases_index: int, build_on: Base, build_on_index: int, lock: bool = False
     ) -> str:
-        """Pack instance in Charm."""
-        charm_name = format_charm_file_name(self.metadata.name, self.config.bases[bases_index])
+        """Pack instance in Charm (or lock its requirements, written in the project)."""
+        if lock:
+            charm_name = str(
+                pathlib.Path(self._charm_part.get("charm-lock-dir", ""))
+                / charm_builder.REQUIREMENTS_LOCK_TEMPLATE.format(
+                    name=build_on.name, channel=build_on.channel, arch=get_host_architecture()
+                )
+            )
+        else:
+            charm_name = format_charm_file_name(self.metadata.name, self.config.bases[bases_index])
 
         # If building in project directory, use the project path as the working
         # directory. The output charms will be placed in the correct directory
@@ -396,14 +513,20 @@ class Builder:
             instance_output_dir = get_managed_environment_home_path()
             pull_charm = True
 
-        cmd = ["charmcraft", "pack", "--bases-index", str(bases_index)]
+        cmd = ["charmcraft", "lock" if lock else "pack", "--bases-index", str(bases_index)]
 
         if message_handler.mode == message_handler.VERBOSE:
             cmd.append("--verbose")
         elif message_handler.mode == message_handler.QUIET:
             cmd.append("--quiet")
 
-        logger.info(f"Packing charm {charm_name!r}...")
+        if self.explain_ignores and not lock:
+            cmd.append("--explain-ignores")
+
+        if lock:
+            logger.info(f"Locking requirements in {charm_name!r}...")
+        else:
+            logger.info(f"Packing charm {charm_name!r}...")
         with self.provider.launched_environment(
             charm_name=self.metadata.name,
             project_path=self.charmdir,
@@ -423,7 +546,8 @@ class Builder:
                     f"Failed to build charm for bases index '{bases_index}'."
                 ) from error
 
-            if pull_charm:
+            # the lock file is written directly in the project
+            if pull_charm and not lock:
                 try:
                     instance.pull_file(
                         source=instance_output_dir / charm_name,
@@ -440,14 +564,13 @@ class Builder:
         """Handle the final package creation."""
         logger.debug("Creating the package itself")
         zipname = format_charm_file_name(self.metadata.name, bases_config)
-        zipfh = zipfile.ZipFile(zipname, "w", zipfile.ZIP_DEFLATED)
-        for dirpath, dirnames, filenames in os.walk(prime_dir, followlinks=True):
-            dirpath = pathlib.Path(dirpath)
-            for filename in filenames:
-                filepath = dirpath / filename
-                zipfh.write(str(filepath), str(filepath.relative_to(prime_dir)))
-
-        zipfh.close()
+        build_zip(
+            zipname,
+            prime_dir,
+            policy=get_compression_policy(self.config),
+            timestamp=get_packing_timestamp(self.config),
+            incremental=self.config.packing.incremental,
+        )
         return zipname
 
 
@@ -461,6 +584,7 @@ class Validator:
         "requirement",
         "bases_indices",
         "force",
+        "explain_ignores",
     ]
 
     def __init__(self, config: Config):
@@ -553,6 +677,10 @@ class Validator:
         """Validate the value (just convert to bool to make None explicit)."""
         return bool(value)
 
+    def validate_explain_ignores(self, value):
+        """Validate the value (just convert to bool to make None explicit)."""
+        return bool(value)
+
 
 _overview = """
 Build a charm operator package.
@@ -599,6 +727,12 @@ class BuildCommand(BaseCommand):
             help="File(s) listing needed PyPI dependencies (can be used multiple "
             "times); defaults to 'requirements.txt'",
         )
+        parser.add_argument(
+            "--explain-ignores",
+            action="store_true",
+            help="Report which .jujuignore rule excluded each path and the time spent "
+            "on each rule",
+        )
 
     def run(self, parsed_args):
         """Run the command."""
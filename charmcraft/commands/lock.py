@@ -0,0 +1,91 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For further info, check https://github.com/canonical/charmcraft
+
+"""Infrastructure for the 'lock' command."""
+
+import logging
+from argparse import Namespace
+
+from charmcraft.cmdbase import BaseCommand, CommandError
+from charmcraft.commands import build
+
+logger = logging.getLogger(__name__)
+
+_overview = """
+Lock the charm requirements, with exact versions and hashes.
+
+The requirements (those in `charm-requirements` and `charm-python-packages`)
+are resolved for each base the charm is built on, and written in a lock
+file for it in the directory set by the `charm-lock-dir` property of the
+`charm` part; the charm is then built installing exactly what is there,
+without resolving the requirements again.
+
+The lock files are also written on the first build and when the
+requirements change; use this command to refresh them, for example to
+get newer versions of the dependencies.
+"""
+
+
+class LockCommand(BaseCommand):
+    """Lock the charm requirements for each base."""
+
+    name = "lock"
+    help_msg = "Lock the charm requirements for each base"
+    overview = _overview
+    needs_config = True
+
+    def fill_parser(self, parser):
+        """Add own parameters to the general parser."""
+        parser.add_argument(
+            "--destructive-mode",
+            action="store_true",
+            help=(
+                "Lock the requirements using current host which may result in breaking "
+                "changes to system configuration"
+            ),
+        )
+        parser.add_argument(
+            "--bases-index",
+            action="append",
+            type=int,
+            help="Index of 'bases' configuration to lock the requirements for (can be used "
+            "multiple times); defaults to all",
+        )
+
+    def run(self, parsed_args):
+        """Run the command."""
+        if self.config.type != "charm":
+            raise CommandError("Only the requirements of a charm can be locked.")
+
+        # adapt arguments to use the build infrastructure
+        build_args = Namespace(
+            **{
+                "destructive_mode": parsed_args.destructive_mode,
+                "from": self.config.project.dirpath,
+                "entrypoint": None,
+                "requirement": None,
+                "bases_indices": parsed_args.bases_index,
+                "force": False,
+                "explain_ignores": False,
+            }
+        )
+        validator = build.Validator(self.config)
+        args = validator.process(build_args)
+        logger.debug("Working arguments: %s", args)
+        builder = build.Builder(args, self.config)
+        builder.run(
+            parsed_args.bases_index, destructive_mode=build_args.destructive_mode, lock=True
+        )
@@ -17,15 +17,13 @@
 """Infrastructure for the 'pack' command."""
 
 import logging
-import os
-import pathlib
-import zipfile
 from argparse import Namespace
 
 from charmcraft import parts
 from charmcraft.cmdbase import BaseCommand, CommandError
 from charmcraft.commands import build
 from charmcraft.manifest import create_manifest
+from charmcraft.packing import build_zip
 from charmcraft.parts import Step
 from charmcraft.utils import SingleOptionEnsurer, load_yaml, useful_filepath
 
@@ -35,18 +33,6 @@ logger = logging.getLogger(__name__)
 MANDATORY_FILES = {"bundle.yaml", "README.md"}
 
 
-def build_zip(zippath, prime_dir):
-    """Build the final file."""
-    zipfh = zipfile.ZipFile(zippath, "w", zipfile.ZIP_DEFLATED)
-    for dirpath, dirnames, filenames in os.walk(prime_dir, followlinks=True):
-        dirpath = pathlib.Path(dirpath)
-        for filename in filenames:
-            filepath = dirpath / filename
-            zipfh.write(str(filepath), str(filepath.relative_to(prime_dir)))
-
-    zipfh.close()
-
-
 _overview = """
 Build and pack a charm operator package or a bundle.
 
@@ -116,6 +102,12 @@ class PackCommand(BaseCommand):
             action="store_true",
             help="Force packing even after finding lint errors",
         )
+        parser.add_argument(
+            "--explain-ignores",
+            action="store_true",
+            help="Report which .jujuignore rule excluded each path and the time spent "
+            "on each rule",
+        )
 
     def run(self, parsed_args):
         """Run the command."""
@@ -129,6 +121,10 @@ class PackCommand(BaseCommand):
                 raise CommandError(
                     "The -r/--requirement option is valid only when packing a charm"
                 )
+            if parsed_args.explain_ignores:
+                raise CommandError(
+                    "The --explain-ignores option is valid only when packing a charm"
+                )
             self._pack_bundle()
         else:
             raise CommandError("Unknown type {!r} in charmcraft.yaml".format(self.config.type))
@@ -144,6 +140,7 @@ class PackCommand(BaseCommand):
                 "requirement": parsed_args.requirement,
                 "bases_indices": parsed_args.bases_index,
                 "force": parsed_args.force,
+                "explain_ignores": parsed_args.explain_ignores,
             }
         )
 
@@ -195,8 +192,16 @@ class PackCommand(BaseCommand):
         lifecycle.run(Step.PRIME)
 
         # pack everything
-        create_manifest(lifecycle.prime_dir, project.started_at, None, [])
+        timestamp = build.get_packing_timestamp(self.config)
+        started_at = timestamp or build.get_started_at(self.config)
+        create_manifest(lifecycle.prime_dir, started_at, None, [])
         zipname = project.dirpath / (bundle_name + ".zip")
-        build_zip(zipname, lifecycle.prime_dir)
+        build_zip(
+            zipname,
+            lifecycle.prime_dir,
+            policy=build.get_compression_policy(self.config),
+            timestamp=timestamp,
+            incremental=self.config.packing.incremental,
+        )
 
         logger.info("Created %r.", str(zipname))
@@ -45,6 +45,19 @@ analysis:
     attributes: [list of attribute names to ignore]
     linting: [list of linter names to ignore]
 
+packing:
+  compression-level: [integer] optional, from 0 (no compression) to 9, defaults to 6
+  store: [list of strings] optional, shell-style patterns of the files to put in the
+         package without compressing them, defaults to usual compressed formats
+  store-incompressible: [boolean] optional, also put without compressing them the files
+                        that would barely shrink, defaults to true
+  reproducible: [boolean] optional, make the package depend only on the content of the
+                files (not their times or permissions, nor when the build started);
+                the dependencies are then installed without compiling their bytecode
+                (see the charm-compile-bytecode part property), defaults to false
+  incremental: [boolean] optional, reuse the compressed content of the files that didn't
+               change from the package built before, defaults to false
+
 
 Object Definitions
 ==================
@@ -78,6 +91,7 @@ from charmcraft.env import (
     get_managed_environment_project_path,
     is_charmcraft_running_in_managed_mode,
 )
+from charmcraft.packing import DEFAULT_COMPRESSION_LEVEL, DEFAULT_STORED_PATTERNS
 from charmcraft.parts import validate_part
 from charmcraft.utils import get_host_architecture, load_yaml
 
@@ -296,6 +310,19 @@ class AnalysisConfig(ModelConfigDefaults, allow_population_by_field_name=True):
     ignore: Ignore = Ignore()
 
 
+class PackingConfig(
+    ModelConfigDefaults,
+    alias_generator=lambda s: s.replace("_", "-"),
+):
+    """Definition of `packing` configuration."""
+
+    compression_level: pydantic.conint(strict=True, ge=0, le=9) = DEFAULT_COMPRESSION_LEVEL
+    store: List[pydantic.StrictStr] = list(DEFAULT_STORED_PATTERNS)
+    store_incompressible: pydantic.StrictBool = True
+    reproducible: pydantic.StrictBool = False
+    incremental: pydantic.StrictBool = False
+
+
 class Config(ModelConfigDefaults, validate_all=False):
     """Definition of charmcraft.yaml configuration."""
 
@@ -311,6 +338,7 @@ class Config(ModelConfigDefaults, validate_all=False):
         )
     ]
     analysis: AnalysisConfig = AnalysisConfig()
+    packing: PackingConfig = PackingConfig()
 
     project: Project
 
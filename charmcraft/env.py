@@ -17,10 +17,12 @@
 """Charmcraft environment utilities."""
 
 
+import datetime
 import distutils.util
 import os
 import pathlib
 import sys
+from typing import Optional
 
 from charmcraft.cmdbase import CommandError
 
@@ -40,6 +42,23 @@ def get_managed_environment_project_path():
     return get_managed_environment_home_path() / "project"
 
 
+def get_source_date_epoch() -> Optional[datetime.datetime]:
+    """Get the date (in UTC) set in SOURCE_DATE_EPOCH to use instead of the current one.
+
+    :raises CommandError: if the value is not a timestamp.
+    """
+    value = os.getenv("SOURCE_DATE_EPOCH")
+    if not value:
+        return None
+    try:
+        timestamp = int(value)
+    except ValueError:
+        raise CommandError(
+            f"Invalid SOURCE_DATE_EPOCH {value!r}, it must be a number of seconds since the epoch."
+        )
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+
 def is_charmcraft_running_from_snap():
     """Check if charmcraft is running from the snap."""
     return os.getenv("SNAP_NAME") == "charmcraft" and os.getenv("SNAP") is not None
@@ -16,16 +16,39 @@
 
 """Indicate which files are ignored by Juju."""
 
+import hashlib
+import json
 import logging
+import os
+import pathlib
 import re
+import time
 import typing
 
+from charmcraft import __version__
+
 logger = logging.getLogger(__name__)
 
 KEEP = "keep"
 SKIP = "skip"
 FORCEKEEP = "forcekeep"
 
+# the version of the format of the translated rules stored in the cache
+_CACHE_FORMAT = 1
+
+# the attributes of each translated rule, with their types
+_TRANSLATED_TYPES = dict(
+    line_num=int,
+    orig_rule=str,
+    invert=bool,
+    only_dirs=bool,
+    regex=str,
+    rule=str,
+)
+
+# characters that make a rule not literal
+_WILDCARDS = re.compile(r"[*?[]")
+
 _unescapes = {
     r"\!": "!",
     r"\ ": " ",
@@ -118,6 +141,90 @@ def _rule_to_regex(rule):
     return res
 
 
+def _translate(patterns: typing.List[str]) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Translate the patterns to the attributes of the matchers to build."""
+    translated = []
+    for line_num, rule in enumerate(patterns, 1):
+        orig_rule = rule
+        rule = rule.lstrip().rstrip("\r\n")
+        if not rule or rule.startswith("#"):
+            continue
+        invert = False
+        if rule.startswith("!"):
+            invert = True
+            rule = rule.lstrip("!")
+        rule = _unescape_rule(rule)
+        only_dirs = False
+        if rule.endswith("/"):
+            only_dirs = True
+            rule = rule.rstrip("/")
+        if not rule.startswith("/"):
+            # A rule that doesn't start with '/' means to match any
+            # subdirectory
+            rule = "**/" + rule
+        regex = _rule_to_regex(rule)
+        translated.append(
+            dict(
+                line_num=line_num,
+                orig_rule=orig_rule,
+                invert=invert,
+                only_dirs=only_dirs,
+                regex=regex,
+                rule=rule,
+            )
+        )
+        logger.debug('Translated .jujuignore %d "%s" => "%s"', line_num, orig_rule, regex)
+    return translated
+
+
+def _cache_key(patterns: typing.List[str]) -> str:
+    """Build the key for the translated patterns from their content."""
+    content = json.dumps([_CACHE_FORMAT, __version__, patterns])
+    return hashlib.sha256(content.encode("utf8")).hexdigest()
+
+
+def _is_valid_translated(translated: typing.Any) -> bool:
+    """Check that the translated patterns have the structure that the matchers need."""
+    if not isinstance(translated, list):
+        return False
+    for attributes in translated:
+        if not isinstance(attributes, dict) or attributes.keys() != _TRANSLATED_TYPES.keys():
+            return False
+        for name, value_type in _TRANSLATED_TYPES.items():
+            if not isinstance(attributes[name], value_type):
+                return False
+    return True
+
+
+def _load_translated(cache_path: pathlib.Path) -> typing.Optional[typing.List]:
+    """Load the translated patterns from the cache, if there."""
+    try:
+        with cache_path.open("rt", encoding="utf8") as fh:
+            translated = json.load(fh)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        logger.debug("Ignoring broken cache of .jujuignore rules %r: %r", str(cache_path), exc)
+        return None
+    if not _is_valid_translated(translated):
+        logger.debug("Ignoring invalid cache of .jujuignore rules %r", str(cache_path))
+        return None
+    logger.debug("Using cached .jujuignore rules from %r", str(cache_path))
+    return translated
+
+
+def _save_translated(cache_path: pathlib.Path, translated: typing.List) -> None:
+    """Save the translated patterns in the cache, not failing if not possible."""
+    temp_path = cache_path.with_suffix(".{}.tmp".format(os.getpid()))
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with temp_path.open("wt", encoding="utf8") as fh:
+            json.dump(translated, fh)
+        temp_path.replace(cache_path)
+    except OSError as exc:
+        logger.debug("Cannot cache .jujuignore rules in %r: %r", str(cache_path), exc)
+
+
 class _Matcher:
     """Couple a regex with other metadata for how we should match a given pattern."""
 
@@ -128,12 +235,76 @@ class _Matcher:
         invert: bool,
         only_dirs: bool,
         regex: typing.Pattern,
+        rule: str = "**",
     ):
         self.line_num = line_num
         self.orig_rule = orig_rule
         self.invert = invert
         self.only_dirs = only_dirs
-        self.compiled = re.compile(regex, re.DOTALL)
+        self.regex = regex
+        self.rule = rule
+        self._compiled = None
+        self._leading = None
+        self._depth = None
+
+        # stats, only recorded when explaining the rules
+        self.evaluations = 0
+        self.matches = 0
+        self.elapsed = 0.0
+
+        # literal rules (no wildcards) can be checked with a simple comparison: against
+        # the basename if they apply to any directory, or against the whole path if anchored
+        self.basename = None
+        self.path = None
+        if rule.startswith("**/"):
+            if not _WILDCARDS.search(rule[3:]) and "/" not in rule[3:]:
+                self.basename = rule[3:]
+        elif not _WILDCARDS.search(rule):
+            self.path = rule
+
+    @property
+    def compiled(self) -> typing.Pattern:
+        """Return the compiled regex of the rule (only needed when checking it alone)."""
+        if self._compiled is None:
+            self._compiled = re.compile(self.regex, re.DOTALL)
+        return self._compiled
+
+    def _analyze_components(self) -> None:
+        """Get the patterns for the leading components and the total depth of the rule.
+
+        These are the patterns that a directory must match for the rule to apply to its
+        content, and the rule's total depth; both up to a '**' (or a bracket that may hold
+        a slash) as after that anything can follow. The component before a '/**/' only
+        needs to match at the start of the directory, as that is translated to '.*/'.
+        """
+        rule = self.rule
+        self._leading = []
+        components = rule[1:].split("/") if rule.startswith("/") else rule.split("/")
+        for index, component in enumerate(components):
+            if "**" in component or component.count("[") != component.count("]"):
+                break
+            regex = _rule_to_regex(component)
+            if components[index + 1 : index + 2] == ["**"] and index + 2 < len(components):
+                self._leading.append(re.compile(regex[: -len(r"\Z")], re.DOTALL))
+                break
+            self._leading.append(re.compile(regex, re.DOTALL))
+        else:
+            self._depth = len(components)
+
+    def can_match_below(self, dir_parts: typing.Sequence[str]) -> bool:
+        """Tell if the rule may match something inside the directory with the given parts.
+
+        This is conservative: it can answer True for a directory where nothing below would
+        finally match, but never False if something may match.
+        """
+        if self._leading is None:
+            self._analyze_components()
+        if self._depth is not None and len(dir_parts) >= self._depth:
+            return False
+        for pattern, part in zip(self._leading, dir_parts):
+            if not pattern.match(part):
+                return False
+        return True
 
     def match(self, path: str, is_dir: bool) -> str:
         """Check if a path matches.
@@ -150,11 +321,150 @@ class _Matcher:
         return KEEP
 
 
+class _RuleGroup:
+    """A group of rules checked together.
+
+    Literal rules (without wildcards) are indexed to be checked by a simple lookup: those
+    that apply to any directory by the path's basename, and the anchored ones by the whole
+    path. The rest of the rules are merged in a single regex.
+    """
+
+    def __init__(self, matchers: typing.List[_Matcher]):
+        self.basenames = {m.basename for m in matchers if m.basename is not None}
+        self.paths = {m.path for m in matchers if m.path is not None}
+        self.globs = [m for m in matchers if m.basename is None and m.path is None]
+        if self.globs:
+            combined = "|".join("(?:{})".format(m.regex) for m in self.globs)
+            self.regex = re.compile(combined, re.DOTALL)
+        else:
+            self.regex = None
+        self.empty = not matchers
+
+    def match(self, path: str, basename: str) -> bool:
+        """Check if any rule of the group matches the path (with the given basename)."""
+        if basename in self.basenames or path in self.paths:
+            return True
+        return self.regex is not None and self.regex.match(path) is not None
+
+
+class _CompiledRules:
+    """All the rules merged in a few groups, to check them in one pass.
+
+    A FORCEKEEP from any rule always wins over SKIPs from other rules, no matter their
+    order, so a path is ignored if any regular rule matches it and no inverted rule does.
+    """
+
+    def __init__(self, matchers: typing.List[_Matcher]):
+        self.matchers = matchers
+        self.skip_any = _RuleGroup([m for m in matchers if not m.invert and not m.only_dirs])
+        self.skip_dirs = _RuleGroup([m for m in matchers if not m.invert and m.only_dirs])
+        self.keep_any = _RuleGroup([m for m in matchers if m.invert and not m.only_dirs])
+        self.keep_dirs = _RuleGroup([m for m in matchers if m.invert and m.only_dirs])
+
+        # if no regular rule is included nothing can be ignored (whatever the inverted ones)
+        self.can_skip = not (self.skip_any.empty and self.skip_dirs.empty)
+
+    def match(self, path: str, is_dir: bool) -> bool:
+        """Check if the path is ignored by the rules."""
+        return self.match_many([path], [is_dir])[0]
+
+    def match_many(
+        self, paths: typing.Sequence[str], is_dir_flags: typing.Iterable[bool]
+    ) -> typing.List[bool]:
+        """Check which of the paths are ignored by the rules."""
+        if not self.can_skip:
+            return [False] * len(paths)
+
+        skip_any = self.skip_any.match
+        skip_dirs = self.skip_dirs.match
+        keep_any = self.keep_any.match
+        keep_dirs = self.keep_dirs.match
+        results = []
+        for path, is_dir in zip(paths, is_dir_flags):
+            if path[:1] != "/":
+                path = "/" + path
+            basename = path[path.rfind("/") + 1 :]
+            skipped = skip_any(path, basename) or (is_dir and skip_dirs(path, basename))
+            if skipped:
+                kept = keep_any(path, basename) or (is_dir and keep_dirs(path, basename))
+                results.append(not kept)
+            else:
+                results.append(False)
+        return results
+
+
+class _ExplainedRules:
+    """All the rules checked one by one, recording stats in each matcher.
+
+    This is the slow path, only useful to explain which rule ignored each path and how
+    expensive is each rule.
+    """
+
+    def __init__(self, matchers: typing.List[_Matcher]):
+        self.matchers = matchers
+        self.can_skip = any(not m.invert for m in matchers)
+
+    def match(self, path: str, is_dir: bool) -> bool:
+        """Check if the path is ignored by the rules."""
+        return self.match_many([path], [is_dir])[0]
+
+    def match_many(
+        self, paths: typing.Sequence[str], is_dir_flags: typing.Iterable[bool]
+    ) -> typing.List[bool]:
+        """Check which of the paths are ignored by the rules."""
+        results = []
+        for path, is_dir in zip(paths, is_dir_flags):
+            if path[:1] != "/":
+                path = "/" + path
+            keep = True
+            responsible = None
+            for matcher in self.matchers:
+                start = time.perf_counter()
+                result = matcher.match(path, is_dir)
+                matcher.elapsed += time.perf_counter() - start
+                matcher.evaluations += 1
+                if result == KEEP:
+                    continue
+                matcher.matches += 1
+                if result == SKIP:
+                    keep = False
+                    responsible = matcher
+                elif result == FORCEKEEP:
+                    keep = True
+                    break
+            if not keep:
+                logger.debug(
+                    "Path %r ignored because of .jujuignore line %d: %r",
+                    path,
+                    responsible.line_num,
+                    responsible.orig_rule.rstrip("\r\n"),
+                )
+            results.append(not keep)
+        return results
+
+
 class JujuIgnore:
-    """Track a set of ignore patterns from a .jujuignore file."""
+    """Track a set of ignore patterns from a .jujuignore file.
+
+    If `explain` is True each rule is checked separately recording how many times it was
+    evaluated, how many times it matched, and the time spent on it (see `explain_report`);
+    this is way slower, use it only to debug the rules.
 
-    def __init__(self, patterns: typing.Iterable[str]):
+    If a `cache_dir` is given the translation of the rules is stored there, keyed by the
+    content of the patterns, to be reused by later instances with the same patterns.
+    """
+
+    def __init__(
+        self,
+        patterns: typing.Iterable[str],
+        explain: bool = False,
+        cache_dir: typing.Optional[pathlib.Path] = None,
+    ):
+        self._rules_class = _ExplainedRules if explain else _CompiledRules
+        self._cache_dir = cache_dir
         self._matchers = []
+        self._subtrees = {}
+        self._rulesets = {}
         self._compile_from(patterns)
 
     def extend_patterns(self, patterns: typing.Iterable[str]) -> None:
@@ -162,34 +472,87 @@ class JujuIgnore:
         self._compile_from(patterns)
 
     def _compile_from(self, patterns: typing.Iterable[str]):
-        for line_num, rule in enumerate(patterns, 1):
-            orig_rule = rule
-            rule = rule.lstrip().rstrip("\r\n")
-            if not rule or rule.startswith("#"):
-                continue
-            invert = False
-            if rule.startswith("!"):
-                invert = True
-                rule = rule.lstrip("!")
-            rule = _unescape_rule(rule)
-            only_dirs = False
-            if rule.endswith("/"):
-                only_dirs = True
-                rule = rule.rstrip("/")
-            if not rule.startswith("/"):
-                # A rule that doesn't start with '/' means to match any
-                # subdirectory
-                rule = "**/" + rule
-            regex = _rule_to_regex(rule)
-            m = _Matcher(
-                line_num=line_num,
-                orig_rule=orig_rule,
-                invert=invert,
-                only_dirs=only_dirs,
-                regex=regex,
+        patterns = list(patterns)
+        translated = None
+        if self._cache_dir is not None:
+            cache_path = self._cache_dir / "{}.json".format(_cache_key(patterns))
+            translated = _load_translated(cache_path)
+        if translated is None:
+            translated = _translate(patterns)
+            if self._cache_dir is not None:
+                _save_translated(cache_path, translated)
+
+        for attributes in translated:
+            self._matchers.append(_Matcher(**attributes))
+        self._compiled = self._rules_class(self._matchers)
+        self._subtrees = {(): self._compiled}
+        logger.debug(
+            "Indexed .jujuignore rules: %(basenames)d by basename, %(paths)d by path, "
+            "%(globs)d as globs",
+            self.index_stats(),
+        )
+        self._rulesets = {tuple(map(id, self._matchers)): self._compiled}
+
+    def index_stats(self) -> typing.Dict[str, int]:
+        """Return how many rules are checked by basename lookup, by path lookup, or as globs."""
+        stats = dict(basenames=0, paths=0, globs=0)
+        for matcher in self._matchers:
+            if matcher.basename is not None:
+                stats["basenames"] += 1
+            elif matcher.path is not None:
+                stats["paths"] += 1
+            else:
+                stats["globs"] += 1
+        return stats
+
+    def explain_report(self) -> typing.List[str]:
+        """Return a report of the rules' stats, the most expensive ones first."""
+        report = []
+        for matcher in sorted(self._matchers, key=lambda m: m.elapsed, reverse=True):
+            report.append(
+                "line {:d} {!r}: {:d} evaluations, {:d} matches, {:.3f} ms".format(
+                    matcher.line_num,
+                    matcher.orig_rule.rstrip("\r\n"),
+                    matcher.evaluations,
+                    matcher.matches,
+                    matcher.elapsed * 1000,
+                )
             )
-            self._matchers.append(m)
-            logger.debug('Translated .jujuignore %d "%s" => "%s"', line_num, orig_rule, regex)
+        return report
+
+    def subtree(self, dirpath: str) -> typing.Union[_CompiledRules, _ExplainedRules]:
+        """Get the rules that may apply to the content of the given directory.
+
+        Args:
+            dirpath: A local path (eg /foo/bar, foo/bar, or . for the root) of a directory
+            from the root directory of the project.
+        Return:
+            An object with `match(path, is_dir)` and `match_many(paths, is_dir_flags)`
+            methods equivalent to those of this class for any path inside the directory, and
+            a `can_skip` attribute that is False when nothing inside the directory (at any
+            depth) can be ignored, so the whole subtree can be accepted without matching.
+
+        Note that when the directory itself is ignored it should not be walked at all, as no
+        rule can bring back its content.
+        """
+        dir_parts = tuple(part for part in dirpath.split("/") if part and part != ".")
+        try:
+            return self._subtrees[dir_parts]
+        except KeyError:
+            pass
+
+        # rules relevant in a directory are a subset of those relevant in its parent
+        parent = self.subtree("/".join(dir_parts[:-1]))
+        matchers = [m for m in parent.matchers if m.can_match_below(dir_parts)]
+        if len(matchers) == len(parent.matchers):
+            rules = parent
+        else:
+            key = tuple(map(id, matchers))
+            rules = self._rulesets.get(key)
+            if rules is None:
+                rules = self._rulesets[key] = self._rules_class(matchers)
+        self._subtrees[dir_parts] = rules
+        return rules
 
     def match(self, path: str, is_dir: bool) -> bool:
         """Check if the given path should be ignored.
@@ -202,17 +565,22 @@ class JujuIgnore:
             A boolean indicating whether the ignore rules matched the given path (thus the path
             should be ignored).
         """
-        if not path.startswith("/"):
-            path = "/" + path
-        keep = True
-        for matcher in self._matchers:
-            matchRes = matcher.match(path, is_dir)
-            if matchRes == SKIP:
-                keep = False
-            elif matchRes == FORCEKEEP:
-                keep = True
-                break
-        return not keep
+        return self._compiled.match(path, is_dir)
+
+    def match_many(
+        self, paths: typing.Sequence[str], is_dir_flags: typing.Iterable[bool]
+    ) -> typing.List[bool]:
+        """Check which of the given paths should be ignored, all in one call.
+
+        Args:
+            paths: The local paths (eg /foo/bar or foo/bar) from the root directory of the
+            project, typically the content of a directory.
+            is_dir_flags: Indicate whether each of the given paths is a directory.
+        Return:
+            A list of booleans, one for each path, indicating whether the ignore rules matched
+            it (thus the path should be ignored).
+        """
+        return self._compiled.match_many(paths, is_dir_flags)
 
 
 # default_juju_ignore is the initial set of ignores.
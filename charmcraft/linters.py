@@ -20,6 +20,7 @@ import ast
 import os
 import pathlib
 import shlex
+import zipfile
 from collections import namedtuple
 from typing import List, Generator, Union
 
@@ -96,7 +97,7 @@ class Framework:
     Currently it detects if the Operator Framework is used, if...
 
     - the language attribute is set to python
-    - the charm contains venv/ops
+    - the charm contains venv/ops (maybe packed in venv.zip)
     - the charm imports ops in the entry point.
 
     ...or the Reactive Framework is used, if the charm...
@@ -152,6 +153,14 @@ class Framework:
             elif isinstance(node, ast.ImportFrom):
                 yield node.module.split(".")
 
+    def _zipimport_has_package(self, zippath: pathlib.Path, package: str) -> bool:
+        """Tell if the package is in the zipimport archive (if it exists)."""
+        try:
+            with zipfile.ZipFile(str(zippath)) as zf:
+                return package + "/" in zf.namelist()
+        except (OSError, zipfile.BadZipFile):
+            return False
+
     def _check_operator(self, basedir: pathlib.Path) -> bool:
         """Detect if the Operator Framework is used."""
         python_entrypoint = check_dispatch_with_python_entrypoint(basedir)
@@ -159,7 +168,7 @@ class Framework:
             return False
 
         opsdir = basedir / "venv" / "ops"
-        if not opsdir.exists() or not opsdir.is_dir():
+        if not opsdir.is_dir() and not self._zipimport_has_package(basedir / "venv.zip", "ops"):
             return False
 
         for import_parts in self._get_imports(python_entrypoint):
@@ -23,7 +23,7 @@ from collections import namedtuple
 
 from charmcraft import config, env, helptexts
 from charmcraft.cmdbase import BaseCommand, CommandError
-from charmcraft.commands import build, clean, init, pack, store, version, analyze
+from charmcraft.commands import build, clean, init, lock, pack, store, version, analyze
 from charmcraft.logsetup import message_handler
 from charmcraft.parts import setup_parts
 
@@ -94,6 +94,7 @@ COMMAND_GROUPS = [
             build.BuildCommand,
             clean.CleanCommand,
             pack.PackCommand,
+            lock.LockCommand,
             init.InitCommand,
             version.VersionCommand,
         ],
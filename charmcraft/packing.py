@@ -0,0 +1,637 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For further info, check https://github.com/canonical/charmcraft
+
+"""Write the zip files of charms and bundles, compressing their members concurrently."""
+
+import collections
+import concurrent.futures
+import datetime
+import fnmatch
+import hashlib
+import io
+import logging
+import os
+import pathlib
+import stat
+import struct
+import time
+import zipfile
+import zlib
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# files bigger than this are compressed while written (not in the workers) so they
+# are never fully held in memory
+STREAMED_MIN_SIZE = 32 * 2 ** 20
+
+# how many members (per worker) can be compressed ahead of the one being written
+PENDING_PER_WORKER = 4
+
+# the compression methods supported, with their ids in the zip format
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# the zlib level used to deflate the members if not configured
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# files in formats that are already compressed, stored as they are if not configured
+DEFAULT_STORED_PATTERNS = (
+    "*.7z",
+    "*.bz2",
+    "*.charm",
+    "*.gif",
+    "*.gz",
+    "*.jar",
+    "*.jpeg",
+    "*.jpg",
+    "*.png",
+    "*.tgz",
+    "*.webp",
+    "*.whl",
+    "*.woff",
+    "*.woff2",
+    "*.xz",
+    "*.zip",
+    "*.zst",
+)
+
+# how much of the bigger files is deflated to measure their compressibility, and the
+# ratio (deflated to original size) from which the files are stored as they are
+SAMPLE_SIZE = 64 * 2 ** 10
+INCOMPRESSIBLE_RATIO = 0.95
+
+# the oldest date the zip format can hold
+MIN_TIMESTAMP = datetime.datetime(1980, 1, 1)
+
+# beyond these limits the ZIP64 extensions are needed
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_LOCAL_HEADER_SIGNATURE = 0x04034B50
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_CENTRAL_HEADER_SIGNATURE = 0x02014B50
+_END_RECORD = struct.Struct("<IHHHHIIH")
+_END_RECORD_SIGNATURE = 0x06054B50
+_ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+_ZIP64_END_RECORD_SIGNATURE = 0x06064B50
+_ZIP64_END_LOCATOR = struct.Struct("<IIQI")
+_ZIP64_END_LOCATOR_SIGNATURE = 0x07064B50
+_ZIP64_EXTRA_ID = 0x0001
+
+# the zip comment identifies how the members were compressed, so they are only reused
+# when packing again with the same settings
+_COMMENT_PREFIX = b"charmcraft-packing:"
+
+# the versions of the format needed to extract the members
+_VERSION_DEFAULT = 20
+_VERSION_ZIP64 = 45
+# the members are made in Unix (so their permissions are kept when extracted)
+_CREATE_SYSTEM_UNIX = 3
+# the member name is encoded in UTF-8
+_FLAG_UTF8 = 0x800
+
+
+class Member:
+    """A file to be included in the zip, and how it is stored there.
+
+    The CRC, data and sizes are filled when the member is compressed (the data is
+    left as None if the member is compressed while written, or copied from the member
+    with the same content in the previous zip), and the offset when it's written.
+    """
+
+    def __init__(self, path: str, name: str, date_time: Tuple[int, ...], mode: int, size: int):
+        self.path = path
+        self.name = name
+        self.date_time = date_time
+        self.mode = mode
+        self.method = ZIP_DEFLATED
+        self.file_size = size
+        self.compress_size = 0
+        self.crc = 0
+        self.data: Optional[bytes] = None
+        self.previous: Optional[zipfile.ZipInfo] = None
+        self.offset = 0
+
+
+class CompressionPolicy:
+    """Decide which members are stored as they are, and how the rest are deflated.
+
+    The members matching any of the stored patterns (shell-style, against the member's
+    name) are stored as they are. If `store_incompressible` is set, also the members
+    that deflating them barely shrinks, which for the bigger files is measured on a
+    sample of their beginning so they are not deflated in vain.
+    """
+
+    def __init__(
+        self,
+        level: int = DEFAULT_COMPRESSION_LEVEL,
+        stored_patterns: Iterable[str] = DEFAULT_STORED_PATTERNS,
+        store_incompressible: bool = True,
+    ):
+        self.level = level
+        self.stored_patterns = list(stored_patterns)
+        self.store_incompressible = store_incompressible
+
+    def get_signature(self) -> bytes:
+        """Get an identifier of how the data is compressed following this policy."""
+        settings = (
+            self.level,
+            self.stored_patterns,
+            self.store_incompressible,
+            SAMPLE_SIZE,
+            INCOMPRESSIBLE_RATIO,
+            zlib.ZLIB_RUNTIME_VERSION,
+        )
+        return hashlib.sha256(repr(settings).encode("utf8")).hexdigest()[:32].encode("ascii")
+
+    def get_method(self, name: str) -> int:
+        """Get the compression method for the member by its name."""
+        if any(fnmatch.fnmatchcase(name, pattern) for pattern in self.stored_patterns):
+            return ZIP_STORED
+        return ZIP_DEFLATED
+
+    def get_compressor(self):
+        """Get a compressor producing the raw deflate stream the zip format uses."""
+        return zlib.compressobj(self.level, zlib.DEFLATED, -15)
+
+    def deflate(self, data: bytes) -> Optional[bytes]:
+        """Deflate the data, or return None if it should be stored as it is."""
+        if self.store_incompressible and len(data) > SAMPLE_SIZE:
+            # the fastest level is enough to tell if the data has redundancy
+            sample = zlib.compressobj(1, zlib.DEFLATED, -15)
+            sampled = sample.compress(data[:SAMPLE_SIZE]) + sample.flush()
+            if len(sampled) >= SAMPLE_SIZE * INCOMPRESSIBLE_RATIO:
+                return None
+        compressor = self.get_compressor()
+        deflated = compressor.compress(data) + compressor.flush()
+        if self.store_incompressible and len(deflated) >= len(data) * INCOMPRESSIBLE_RATIO:
+            return None
+        return deflated
+
+
+def _walk_members(
+    basedir: pathlib.Path, timestamp: Optional[datetime.datetime] = None
+) -> Iterator[Member]:
+    """Get all the files in the directory (following symlinks) as zip members, in order.
+
+    If a timestamp is given, all the members get it as their date, and the usual file
+    permissions (respecting only if they are executable).
+    """
+    if timestamp is not None:
+        timestamp = max(timestamp, MIN_TIMESTAMP)
+    for dirpath, dirnames, filenames in os.walk(basedir, followlinks=True):
+        dirnames.sort()
+        dirpath = pathlib.Path(dirpath)
+        for filename in sorted(filenames):
+            filepath = dirpath / filename
+            filestat = filepath.stat()
+            if timestamp is None:
+                # the zip format can't hold timestamps before 1980
+                date_time = time.localtime(max(filestat.st_mtime, 315532800))[:6]
+                mode = filestat.st_mode
+            else:
+                date_time = timestamp.timetuple()[:6]
+                mode = 0o755 if filestat.st_mode & 0o111 else 0o644
+                mode |= stat.S_IFREG
+            yield Member(
+                path=str(filepath),
+                name=filepath.relative_to(basedir).as_posix(),
+                date_time=date_time,
+                mode=mode,
+                size=filestat.st_size,
+            )
+
+
+class _PreviousZip:
+    """A zip built before, whose compressed members can be copied in the new one.
+
+    Its members are only considered if it was built with the same compression policy.
+    The data is read with `os.pread`, so it can be done from several threads at once.
+
+    If `verify_content` is set, the members' content must be compared with the files
+    before reusing them, as their dates don't tell if the files changed.
+    """
+
+    def __init__(
+        self, zippath: pathlib.Path, policy: CompressionPolicy, verify_content: bool = False
+    ):
+        self._fd = os.open(str(zippath), os.O_RDONLY)
+        self._zipfile = None
+        self.verify_content = verify_content
+        self.members = {}
+        try:
+            zf = zipfile.ZipFile(str(zippath))
+        except (OSError, zipfile.BadZipFile) as exc:
+            logger.debug("Not reusing %s, it can't be read: %r", zippath, exc)
+            return
+        if zf.comment == _COMMENT_PREFIX + policy.get_signature():
+            self.members = {info.filename: info for info in zf.infolist()}
+            # kept open to read the content to verify (which it allows from several threads)
+            self._zipfile = zf
+        else:
+            logger.debug("Not reusing %s, it was packed with other settings", zippath)
+            zf.close()
+
+    def find(self, member: Member) -> Optional[zipfile.ZipInfo]:
+        """Find the previous member with the same name, size and date as the given one."""
+        info = self.members.get(member.name)
+        if (
+            info is not None
+            and info.file_size == member.file_size
+            and _dos_date_time(info.date_time) == _dos_date_time(member.date_time)
+        ):
+            return info
+        return None
+
+    def has_content(self, info: zipfile.ZipInfo, fh: BinaryIO) -> bool:
+        """Tell if the member has the content of the file, comparing them byte by byte."""
+        with self._zipfile.open(info) as previous_fh:
+            while True:
+                chunk = fh.read(2 ** 20)
+                if previous_fh.read(2 ** 20) != chunk:
+                    return False
+                if not chunk:
+                    return True
+
+    def _data_offset(self, info: zipfile.ZipInfo) -> int:
+        """Get where the member's data starts, after its local header."""
+        header = os.pread(self._fd, _LOCAL_HEADER.size, info.header_offset)
+        fields = _LOCAL_HEADER.unpack(header)
+        name_size, extra_size = fields[-2:]
+        return info.header_offset + _LOCAL_HEADER.size + name_size + extra_size
+
+    def read(self, info: zipfile.ZipInfo) -> bytes:
+        """Read the compressed data of the member."""
+        return os.pread(self._fd, info.compress_size, self._data_offset(info))
+
+    def copy(self, info: zipfile.ZipInfo, fh: BinaryIO) -> None:
+        """Copy the compressed data of the member to the file, in chunks."""
+        offset = self._data_offset(info)
+        remaining = info.compress_size
+        while remaining:
+            chunk = os.pread(self._fd, min(remaining, 2 ** 20), offset)
+            if not chunk:
+                raise EOFError(f"The previous zip is truncated in member {info.filename!r}")
+            fh.write(chunk)
+            offset += len(chunk)
+            remaining -= len(chunk)
+
+    def close(self) -> None:
+        """Close the zip file."""
+        if self._zipfile is not None:
+            self._zipfile.close()
+        os.close(self._fd)
+
+
+def _file_crc(path: str) -> int:
+    """Get the CRC of the file content, reading it in chunks."""
+    crc = 0
+    with open(path, "rb") as fh:
+        while True:
+            chunk = fh.read(2 ** 20)
+            if not chunk:
+                return crc
+            crc = zlib.crc32(chunk, crc)
+
+
+def _reuse(member: Member, info: zipfile.ZipInfo) -> None:
+    """Take the compression details from the member with the same content in the previous zip."""
+    member.method = info.compress_type
+    member.crc = info.CRC
+    member.compress_size = info.compress_size
+    member.previous = info
+
+
+def _compress(
+    member: Member, policy: CompressionPolicy, previous: Optional[_PreviousZip] = None
+) -> Member:
+    """Compress the member content following the policy.
+
+    If the previous zip has a member with the same name and content, its compressed data is
+    used instead. The content is the same if the size, the date (the file's modification
+    time) and the CRC are; if the dates don't tell (all the members get the same one), it's
+    also compared byte by byte, as the CRC alone can match by chance.
+
+    The content of the big members is not read here but compressed while written; if
+    they may be stored as they are, only a sample is read to decide it.
+    """
+    member.method = policy.get_method(member.name)
+    previous_info = None if previous is None else previous.find(member)
+    if member.file_size >= STREAMED_MIN_SIZE:
+        if previous_info is not None and _file_crc(member.path) == previous_info.CRC:
+            with open(member.path, "rb") as fh:
+                same = not previous.verify_content or previous.has_content(previous_info, fh)
+            if same:
+                _reuse(member, previous_info)
+                return member
+        if member.method == ZIP_DEFLATED and policy.store_incompressible:
+            with open(member.path, "rb") as fh:
+                sample = fh.read(SAMPLE_SIZE + 1)
+            if policy.deflate(sample) is None:
+                member.method = ZIP_STORED
+        return member
+
+    with open(member.path, "rb") as fh:
+        data = fh.read()
+    member.file_size = len(data)
+    member.crc = zlib.crc32(data)
+    if (
+        previous_info is not None
+        and previous_info.file_size == member.file_size
+        and previous_info.CRC == member.crc
+        and (not previous.verify_content or previous.has_content(previous_info, io.BytesIO(data)))
+    ):
+        _reuse(member, previous_info)
+        member.data = previous.read(previous_info)
+        return member
+
+    if member.method == ZIP_DEFLATED:
+        deflated = policy.deflate(data)
+        if deflated is None:
+            member.method = ZIP_STORED
+        else:
+            data = deflated
+    member.data = data
+    member.compress_size = len(data)
+    return member
+
+
+def _compressed_in_order(
+    members: List[Member],
+    workers: int,
+    policy: CompressionPolicy,
+    previous: Optional[_PreviousZip] = None,
+) -> Iterator[Member]:
+    """Compress the members in the workers, yielding them in their original order.
+
+    Only a few members per worker are compressed ahead of the one being yielded, to
+    not hold the whole content in memory.
+    """
+    if workers <= 1:
+        for member in members:
+            yield _compress(member, policy, previous)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        members_iter = iter(members)
+        try:
+            for member in members_iter:
+                pending.append(executor.submit(_compress, member, policy, previous))
+                if len(pending) >= workers * PENDING_PER_WORKER:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class _ZipWriter:
+    """Write the members (compressed beforehand or not) in a zip file."""
+
+    def __init__(
+        self, fh: BinaryIO, policy: CompressionPolicy, previous: Optional[_PreviousZip] = None
+    ):
+        self._fh = fh
+        self._policy = policy
+        self._previous = previous
+        self._members = []
+        self.reused = 0
+
+    def write(self, member: Member) -> None:
+        """Write the member's local header and data."""
+        member.offset = self._fh.tell()
+        if member.data is None and member.previous is None:
+            # the sizes are only known after compressing the data while writing it, so
+            # the header is written again then (using ZIP64 if the sizes may need it)
+            zip64 = member.file_size * 1.1 + 2 ** 20 >= ZIP64_LIMIT
+            self._fh.write(_local_header(member, zip64))
+            self._write_streamed(member)
+            end = self._fh.tell()
+            self._fh.seek(member.offset)
+            self._fh.write(_local_header(member, zip64))
+            self._fh.seek(end)
+        else:
+            zip64 = member.file_size >= ZIP64_LIMIT or member.compress_size >= ZIP64_LIMIT
+            self._fh.write(_local_header(member, zip64))
+            if member.data is None:
+                self._previous.copy(member.previous, self._fh)
+            else:
+                self._fh.write(member.data)
+        if member.previous is not None:
+            self.reused += 1
+        member.data = member.previous = None
+        self._members.append(member)
+
+    def _write_streamed(self, member: Member) -> None:
+        """Write the member's data from its file, compressing it on the fly."""
+        compressor = None
+        if member.method == ZIP_DEFLATED:
+            compressor = self._policy.get_compressor()
+        member.crc = member.compress_size = member.file_size = 0
+        with open(member.path, "rb") as fh:
+            while True:
+                chunk = fh.read(2 ** 20)
+                if not chunk:
+                    break
+                member.file_size += len(chunk)
+                member.crc = zlib.crc32(chunk, member.crc)
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                self._fh.write(chunk)
+                member.compress_size += len(chunk)
+        if compressor is not None:
+            chunk = compressor.flush()
+            self._fh.write(chunk)
+            member.compress_size += len(chunk)
+
+    def close(self) -> None:
+        """Write the central directory and the end records."""
+        start = self._fh.tell()
+        for member in self._members:
+            self._fh.write(_central_header(member))
+        end = self._fh.tell()
+
+        count = len(self._members)
+        size = end - start
+        if count >= ZIP_FILECOUNT_LIMIT or start >= ZIP64_LIMIT or size >= ZIP64_LIMIT:
+            self._fh.write(
+                _ZIP64_END_RECORD.pack(
+                    _ZIP64_END_RECORD_SIGNATURE,
+                    _ZIP64_END_RECORD.size - 12,  # without the signature and this field
+                    _CREATE_SYSTEM_UNIX << 8 | _VERSION_ZIP64,
+                    _VERSION_ZIP64,
+                    0,  # number of this disk
+                    0,  # disk where the central directory starts
+                    count,  # entries in this disk
+                    count,
+                    size,
+                    start,
+                )
+            )
+            self._fh.write(_ZIP64_END_LOCATOR.pack(_ZIP64_END_LOCATOR_SIGNATURE, 0, end, 1))
+            count = min(count, ZIP_FILECOUNT_LIMIT)
+            size = min(size, ZIP64_LIMIT)
+            start = min(start, ZIP64_LIMIT)
+        comment = _COMMENT_PREFIX + self._policy.get_signature()
+        self._fh.write(
+            _END_RECORD.pack(_END_RECORD_SIGNATURE, 0, 0, count, count, size, start, len(comment))
+        )
+        self._fh.write(comment)
+
+
+def _dos_date_time(date_time: Tuple[int, ...]) -> Tuple[int, int]:
+    """Convert the date and time to the MS-DOS format used in zip files."""
+    year, month, day, hour, minute, second = date_time
+    return (year - 1980) << 9 | month << 5 | day, hour << 11 | minute << 5 | second // 2
+
+
+def _local_header(member: Member, zip64: bool) -> bytes:
+    """Build the local header of the member."""
+    name = member.name.encode("utf8")
+    compress_size, file_size = member.compress_size, member.file_size
+    if zip64:
+        extra = struct.pack("<HHQQ", _ZIP64_EXTRA_ID, 16, file_size, compress_size)
+        compress_size = file_size = ZIP64_LIMIT
+    else:
+        extra = b""
+    dos_date, dos_time = _dos_date_time(member.date_time)
+    header = _LOCAL_HEADER.pack(
+        _LOCAL_HEADER_SIGNATURE,
+        _VERSION_ZIP64 if zip64 else _VERSION_DEFAULT,
+        0 if member.name.isascii() else _FLAG_UTF8,
+        member.method,
+        dos_time,
+        dos_date,
+        member.crc,
+        compress_size,
+        file_size,
+        len(name),
+        len(extra),
+    )
+    return header + name + extra
+
+
+def _central_header(member: Member) -> bytes:
+    """Build the header of the member for the central directory."""
+    name = member.name.encode("utf8")
+    compress_size, file_size, offset = member.compress_size, member.file_size, member.offset
+
+    # only the values that don't fit go in the ZIP64 extra field, in this order
+    zip64_values = []
+    if file_size >= ZIP64_LIMIT:
+        zip64_values.append(file_size)
+        file_size = ZIP64_LIMIT
+    if compress_size >= ZIP64_LIMIT:
+        zip64_values.append(compress_size)
+        compress_size = ZIP64_LIMIT
+    if offset >= ZIP64_LIMIT:
+        zip64_values.append(offset)
+        offset = ZIP64_LIMIT
+    if zip64_values:
+        extra = struct.pack(
+            "<HH" + "Q" * len(zip64_values),
+            _ZIP64_EXTRA_ID,
+            8 * len(zip64_values),
+            *zip64_values,
+        )
+        version = _VERSION_ZIP64
+    else:
+        extra = b""
+        version = _VERSION_DEFAULT
+
+    dos_date, dos_time = _dos_date_time(member.date_time)
+    header = _CENTRAL_HEADER.pack(
+        _CENTRAL_HEADER_SIGNATURE,
+        _CREATE_SYSTEM_UNIX << 8 | version,
+        version,
+        0 if member.name.isascii() else _FLAG_UTF8,
+        member.method,
+        dos_time,
+        dos_date,
+        member.crc,
+        compress_size,
+        file_size,
+        len(name),
+        len(extra),
+        0,  # comment length
+        0,  # disk where the member starts
+        0,  # internal attributes
+        (member.mode & 0xFFFF) << 16,
+        offset,
+    )
+    return header + name + extra
+
+
+def build_zip(
+    zippath,
+    basedir,
+    workers: Optional[int] = None,
+    policy: Optional[CompressionPolicy] = None,
+    timestamp: Optional[datetime.datetime] = None,
+    incremental: bool = False,
+) -> None:
+    """Build a zip file with all the files in the directory (following symlinks).
+
+    The members are compressed following the given policy (by default deflating all but
+    the already compressed formats) concurrently in the given number of workers (by
+    default as many as CPUs), and written in a stable order (by name in each directory).
+
+    If a timestamp is given, it's used for all the members instead of their modification
+    times (and their permissions are normalized), so the zip only depends on the content
+    of the files.
+
+    If incremental, the compressed data of the files that didn't change since the zip
+    was built before is copied from it, instead of compressing them again. With a
+    timestamp the members' dates don't tell if the files changed, so their content is
+    compared with the previous one (which is faster than compressing it).
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if policy is None:
+        policy = CompressionPolicy()
+    zippath = pathlib.Path(zippath)
+    basedir = pathlib.Path(basedir)
+    members = list(_walk_members(basedir, timestamp))
+    logger.debug("Packing %d files using %d workers", len(members), workers)
+
+    previous = None
+    if incremental and zippath.exists():
+        previous = _PreviousZip(zippath, policy, verify_content=timestamp is not None)
+
+    # the zip is written aside and then moved, as the previous one may be read meanwhile
+    partial_path = zippath.with_name(zippath.name + ".partial")
+    try:
+        with open(str(partial_path), "wb") as fh:
+            writer = _ZipWriter(fh, policy, previous)
+            for member in _compressed_in_order(members, workers, policy, previous):
+                writer.write(member)
+            writer.close()
+        os.replace(str(partial_path), str(zippath))
+        if previous is not None:
+            logger.debug(
+                "Reused the compressed content of %d files from the previous %s",
+                writer.reused,
+                zippath.name,
+            )
+    finally:
+        if previous is not None:
+            previous.close()
+        if partial_path.exists():
+            partial_path.unlink()
@@ -21,9 +21,11 @@ import os
 import pathlib
 import shlex
 import sys
-from typing import Any, Dict, List, Set, cast
+from typing import Any, Dict, List, Optional, Set, cast
 
-from craft_parts import LifecycleManager, Step, plugins
+import pydantic
+from craft_parts import LifecycleManager, Step, callbacks, plugins
+from craft_parts.infos import StepInfo
 from craft_parts.parts import PartSpec
 from craft_parts.errors import PartsError
 from xdg import BaseDirectory  # type: ignore
@@ -40,6 +42,55 @@ class CharmPluginProperties(plugins.PluginProperties, plugins.PluginModel):
     source: str = ""
     charm_entrypoint: str = ""  # TODO: add default after removing --entrypoint
     charm_requirements: List[str] = []
+    charm_python_packages: List[str] = []
+    charm_allow_pip_binary: bool = True
+    charm_explain_ignores: bool = False
+    charm_link_workers: int = 1
+    charm_venv_cache: bool = False
+    charm_wheels_cache: bool = False
+    charm_wheelhouse: str = ""
+    charm_lock_dir: str = ""
+    charm_compile_bytecode: bool = False
+    charm_zipimport: List[str] = []
+    charm_prune_venv: bool = False
+    charm_prune_patterns: List[str] = []
+    charm_tree_shaking: str = ""
+    charm_keep_packages: List[str] = []
+    charm_dispatch_mode: str = ""
+    charm_dispatch_skip_site: bool = False
+    charm_in_process: bool = False
+    charm_concurrent_dependencies: bool = False
+    charm_source_date_epoch: Optional[int] = None
+
+    @pydantic.validator("charm_link_workers")
+    def validate_link_workers(cls, link_workers):
+        """Verify at least one worker is requested."""
+        if link_workers < 1:
+            raise ValueError("must be a positive integer")
+        return link_workers
+
+    @pydantic.validator("charm_tree_shaking")
+    def validate_tree_shaking(cls, tree_shaking):
+        """Verify the tree shaking mode is valid."""
+        if tree_shaking not in ("", "report", "remove"):
+            raise ValueError("must be one of: report, remove")
+        return tree_shaking
+
+    @pydantic.validator("charm_dispatch_mode")
+    def validate_dispatch_mode(cls, dispatch_mode):
+        """Verify the dispatch mode is valid."""
+        if dispatch_mode and dispatch_mode not in charm_builder.DISPATCH_MODES:
+            raise ValueError("must be one of: {}".format(", ".join(charm_builder.DISPATCH_MODES)))
+        return dispatch_mode
+
+    @pydantic.validator("charm_zipimport", each_item=True)
+    def validate_zipimport(cls, dirname):
+        """Verify only the directories with Python code for the charm are packed."""
+        if dirname not in charm_builder.PYTHONPATH_DIRNAMES:
+            raise ValueError(
+                "must be one of: {}".format(", ".join(charm_builder.PYTHONPATH_DIRNAMES))
+            )
+        return dirname
 
     @classmethod
     def unmarshal(cls, data: Dict[str, Any]):
@@ -72,6 +123,125 @@ class CharmPlugin(plugins.Plugin):
         (list of strings)
         List of paths to requirements files.
 
+      - ``charm-python-packages``
+        (list of strings)
+        Python packages to install, besides those in the requirements files.
+
+      - ``charm-allow-pip-binary``
+        (boolean)
+        If binary Python packages can be installed; if false all of them are
+        built from source. Default is true.
+
+      - ``charm-explain-ignores``
+        (boolean)
+        Report which ignore rule discarded each path and the time spent in each rule.
+
+      - ``charm-link-workers``
+        (integer)
+        How many files to link (or copy) concurrently into the charm payload.
+        Default is 1.
+
+      - ``charm-venv-cache``
+        (boolean)
+        Keep the installed dependencies in the charmcraft cache, shared by all
+        the projects, to reuse them (instead of running pip) when the
+        requirements, pip, Python and the system are the same. Default is false.
+
+      - ``charm-wheels-cache``
+        (boolean)
+        Download the dependencies first and build those only available as
+        sources into wheels (concurrently), keeping them in the charmcraft
+        cache so they are not built again; then install everything from
+        there. Default is false.
+
+      - ``charm-wheelhouse``
+        (string)
+        Directory, relative to the charm root, where the wheels of the
+        dependencies are kept, so after getting them once they are installed
+        without network access.
+
+      - ``charm-lock-dir``
+        (string)
+        Directory, relative to the charm root, where the requirements are
+        locked (with exact versions and hashes) for each system the charm is
+        built on, to install them from there without resolving them again.
+        The lock files are created on the first build, updated when the
+        requirements change, and can be refreshed with ``charmcraft lock``.
+
+      - ``charm-compile-bytecode``
+        (boolean)
+        Include in the charm the compiled bytecode of all its Python files,
+        so they are not compiled when running the hooks. Default is false.
+
+      - ``charm-zipimport``
+        (list of strings)
+        Directories (``lib`` and/or ``venv``) whose pure Python modules and
+        packages are packed in a zipimport archive next to them, which is
+        faster to extract and to import from; the rest of their content is
+        kept as is. The archives are added to the ``PYTHONPATH`` of the
+        dispatch script created by charmcraft, so nothing is packed if the
+        project provides its own dispatch.
+
+      - ``charm-prune-venv``
+        (boolean)
+        Remove from the installed dependencies what is not needed at runtime:
+        the ``tests`` directories at the top of each package, the bytecode
+        compiled by pip and the metadata only used by pip. Default is false.
+
+      - ``charm-prune-patterns``
+        (list of strings)
+        Patterns (like those of ``.jujuignore``, relative to the ``venv``
+        directory) of more files to remove when pruning the dependencies
+        (e.g. ``docs/``, ``*.pyi`` or ``*.c``, if no package needs them at
+        runtime); patterns starting with ``!`` keep what would be removed
+        otherwise.
+
+      - ``charm-tree-shaking``
+        (string)
+        Follow the imports from the charm entrypoint to find the installed
+        packages that are never imported, to ``report`` them or to ``remove``
+        them from the charm.
+
+      - ``charm-keep-packages``
+        (list of strings)
+        Top level names of installed packages that are imported dynamically,
+        so they are never removed by the tree shaking.
+
+      - ``charm-dispatch-mode``
+        (string)
+        How the dispatch script created by charmcraft runs the entrypoint:
+        ``classic`` (the default) runs it from a shell through its shebang,
+        and ``fast`` replaces the shell with the Python interpreter.
+
+      - ``charm-dispatch-skip-site``
+        (boolean)
+        Make the ``fast`` dispatch skip the site initialisation of the
+        interpreter (``-S``), so the system's site-packages are not scanned;
+        only for charms whose code and dependencies don't need any module
+        from there. It's not skipped anyway if the charm's own code imports
+        modules outside it and the standard library. Default is false.
+
+      - ``charm-concurrent-dependencies``
+        (boolean)
+        Install the dependencies in the background while the charm files are
+        linked, instead of after them (not possible if the project has a
+        ``venv`` directory that is not ignored). Default is false.
+
+      - ``charm-source-date-epoch``
+        (integer)
+        Build the charm reproducibly, using this date (in seconds since the
+        epoch) for what is generated: it's given to pip as ``SOURCE_DATE_EPOCH``
+        (which doesn't compile the bytecode then, see
+        ``charm-compile-bytecode``) and set in the zipimport archives. It's
+        set by charmcraft when the packing is reproducible.
+
+      - ``charm-in-process``
+        (boolean)
+        Run the charm builder in the charmcraft process instead of in a new
+        isolated interpreter (only its subprocesses, like pip, get the
+        isolated environment), reporting how long each build phase took.
+        Default is false.
+
     Extra files to be included in the charm payload must be listed under
     the ``prime`` file filter.
     """
@@ -98,7 +268,28 @@ class CharmPlugin(plugins.Plugin):
     def get_build_commands(self) -> List[str]:
         """Return a list of commands to run during the build step."""
         options = cast(CharmPluginProperties, self._options)
+        if options.charm_in_process:
+            # the charm builder is run by the lifecycle, see `PartsLifecycle`
+            return []
+
+        env_flags = [f"{key}={value}" for key, value in self.get_builder_environment().items()]
 
+        # invoke the charm builder
+        build_cmd = [
+            "env",
+            "-i",
+            *env_flags,
+            sys.executable,
+            "-I",
+            charm_builder.__file__,
+            *self.get_builder_arguments(),
+        ]
+        commands = [" ".join(shlex.quote(i) for i in build_cmd)]
+
+        return commands
+
+    def get_builder_environment(self) -> Dict[str, str]:
+        """Return the environment the charm builder runs with, isolated from the current one."""
         build_env = dict(LANG="C.UTF-8", LC_ALL="C.UTF-8")
         for key in [
             "PATH",
@@ -109,36 +300,87 @@ class CharmPlugin(plugins.Plugin):
             "http_proxy",
             "https_proxy",
             "no_proxy",
+            "SOURCE_DATE_EPOCH",
         ]:
             if key in os.environ:
                 build_env[key] = os.environ[key]
+        return build_env
 
-        env_flags = [f"{key}={value}" for key, value in build_env.items()]
+    def get_builder_arguments(self) -> List[str]:
+        """Return the command line arguments for the charm builder."""
+        options = cast(CharmPluginProperties, self._options)
 
-        # invoke the charm builder
-        build_cmd = [
-            "env",
-            "-i",
-            *env_flags,
-            sys.executable,
-            "-I",
-            charm_builder.__file__,
+        arguments = [
             "--charmdir",
             str(self._part_info.part_build_dir),
             "--builddir",
             str(self._part_info.part_install_dir),
+            "--cache-dir",
+            str(self._part_info.cache_dir),
         ]
 
         if options.charm_entrypoint:
             entrypoint = self._part_info.part_build_dir / options.charm_entrypoint
-            build_cmd.extend(["--entrypoint", str(entrypoint)])
+            arguments.extend(["--entrypoint", str(entrypoint)])
 
         for req in options.charm_requirements:
-            build_cmd.extend(["-r", req])
+            arguments.extend(["-r", req])
 
-        commands = [" ".join(shlex.quote(i) for i in build_cmd)]
+        for package in options.charm_python_packages:
+            arguments.extend(["-p", package])
 
-        return commands
+        if not options.charm_allow_pip_binary:
+            arguments.append("--disallow-pip-binary")
+
+        if options.charm_explain_ignores:
+            arguments.append("--explain-ignores")
+
+        if options.charm_venv_cache:
+            arguments.append("--venv-cache")
+
+        if options.charm_wheels_cache:
+            arguments.append("--wheels-cache")
+
+        if options.charm_wheelhouse:
+            wheelhouse = self._part_info.part_build_dir / options.charm_wheelhouse
+            arguments.extend(["--wheelhouse", str(wheelhouse)])
+
+        if options.charm_lock_dir:
+            lock_dir = self._part_info.part_build_dir / options.charm_lock_dir
+            arguments.extend(["--lock-dir", str(lock_dir)])
+
+        if options.charm_compile_bytecode:
+            arguments.append("--compile-bytecode")
+
+        if options.charm_prune_venv:
+            arguments.append("--prune-venv")
+            for pattern in options.charm_prune_patterns:
+                arguments.extend(["--prune-pattern", pattern])
+
+        if options.charm_tree_shaking:
+            arguments.extend(["--tree-shaking", options.charm_tree_shaking])
+            for package in options.charm_keep_packages:
+                arguments.extend(["--keep-package", package])
+
+        for dirname in options.charm_zipimport:
+            arguments.extend(["--zipimport", dirname])
+
+        if options.charm_dispatch_mode:
+            arguments.extend(["--dispatch-mode", options.charm_dispatch_mode])
+
+        if options.charm_dispatch_skip_site:
+            arguments.append("--dispatch-skip-site")
+
+        if options.charm_concurrent_dependencies:
+            arguments.append("--concurrent-dependencies")
+
+        if options.charm_source_date_epoch is not None:
+            arguments.extend(["--source-date-epoch", str(options.charm_source_date_epoch)])
+
+        if options.charm_link_workers > 1:
+            arguments.extend(["--link-workers", str(options.charm_link_workers)])
+
+        return arguments
 
 
 class BundlePluginProperties(plugins.PluginProperties, plugins.PluginModel):
@@ -241,6 +483,9 @@ class PartsLifecycle:
     ):
         self._all_parts = all_parts.copy()
 
+        # how long each phase of the charm build took, if it was run in-process
+        self.charm_build_timings: Dict[str, float] = {}
+
         # set the cache dir for parts package management
         cache_dir = BaseDirectory.save_cache_path("charmcraft")
 
@@ -278,8 +523,15 @@ class PartsLifecycle:
 
             actions = self._lcm.plan(target_step)
             logger.debug("Parts actions: %s", actions)
-            with self._lcm.action_executor() as aex:
-                aex.execute(actions)
+            in_process = self._all_parts.get("charm", {}).get("charm-in-process")
+            if in_process:
+                callbacks.register_post_step(self._build_charm_in_process, step_list=[Step.BUILD])
+            try:
+                with self._lcm.action_executor() as aex:
+                    aex.execute(actions)
+            finally:
+                if in_process:
+                    _unregister_post_step(self._build_charm_in_process)
         except RuntimeError as err:
             raise RuntimeError(f"Parts processing internal error: {err}") from err
         except OSError as err:
@@ -290,6 +542,39 @@ class PartsLifecycle:
         except Exception as err:
             raise CommandError(f"Parts processing error: {err}") from err
 
+    def _build_charm_in_process(self, step_info: StepInfo) -> bool:
+        """Run the charm builder in this process after the (empty) build step of the charm."""
+        if step_info.part_name != "charm":
+            return True
+
+        properties = CharmPluginProperties.unmarshal(self._all_parts["charm"])
+        plugin = CharmPlugin(properties=properties, part_info=step_info)
+        try:
+            self.charm_build_timings = charm_builder.build_in_process(
+                plugin.get_builder_arguments(),
+                plugin.get_builder_environment(),
+                step_info.part_build_dir,
+            )
+        except BaseException:
+            # the build step is already recorded as done, it must be run again next time; this
+            # is the state file layout of craft-parts v1.0-alpha.3 (see its
+            # state_manager.states.state_file_path, which needs a Part we don't have here)
+            state_path = step_info.part_state_dir / Step.BUILD.name.lower()
+            if state_path.exists():
+                state_path.unlink()
+            raise
+        return True
+
+
+def _unregister_post_step(func) -> None:
+    """Remove a registered post-step callback, leaving the others in place.
+
+    craft-parts (v1.0-alpha.3) can only unregister all the callbacks at once, so the hook
+    is taken out of its list directly.
+    """
+    hooks = callbacks._POST_STEP_HOOKS  # pylint: disable=protected-access
+    hooks[:] = [hook for hook in hooks if hook.function != func]
+
 
 def _get_dispatch_entrypoint(dirname: pathlib.Path) -> str:
     """Read the entrypoint from the dispatch file."""
@@ -68,7 +68,7 @@ class Provider(ABC):
         env["CHARMCRAFT_MANAGED_MODE"] = "1"
 
         # Pass-through host environment that target may need.
-        for env_key in ["http_proxy", "https_proxy", "no_proxy"]:
+        for env_key in ["http_proxy", "https_proxy", "no_proxy", "SOURCE_DATE_EPOCH"]:
             if env_key in os.environ:
                 env[env_key] = os.environ[env_key]
 
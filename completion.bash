@@ -27,6 +27,7 @@ _charmcraft()
         fetch-lib 
         help init 
         list-lib 
+        lock
         login 
         logout 
         names 
@@ -94,7 +95,7 @@ _charmcraft()
                     _filedir -d
                     ;;
                 *)
-                    COMPREPLY=( $(compgen -W "${globals[*]} --from --entrypoint --requirement" -- "$cur") )
+                    COMPREPLY=( $(compgen -W "${globals[*]} --from --entrypoint --requirement --explain-ignores" -- "$cur") )
                     ;;
             esac
             ;;
@@ -107,10 +108,13 @@ _charmcraft()
                     _filedir py
                     ;;
                 *)
-                    COMPREPLY=( $(compgen -W "${globals[*]} --entrypoint --requirement --force" -- "$cur") )
+                    COMPREPLY=( $(compgen -W "${globals[*]} --entrypoint --requirement --force --explain-ignores" -- "$cur") )
                     ;;
             esac
             ;;
+        lock)
+            COMPREPLY=( $(compgen -W "${globals[*]} --destructive-mode --bases-index" -- "$cur") )
+            ;;
         release)
             COMPREPLY=( $(compgen -W "${globals[*]} --revision --channel --resource" -- "$cur") )
             ;;
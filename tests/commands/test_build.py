@@ -14,6 +14,7 @@
 #
 # For further info, check https://github.com/canonical/charmcraft
 
+import datetime
 import logging
 import os
 import pathlib
@@ -39,12 +40,15 @@ from charmcraft.commands.build import (
     Builder,
     Validator,
     format_charm_file_name,
+    get_packing_timestamp,
+    get_started_at,
     polite_exec,
     relativise,
 )
-from charmcraft.config import Base, BasesConfiguration, load
+from charmcraft.config import Base, BasesConfiguration, PackingConfig, load
 from charmcraft.logsetup import message_handler
 from charmcraft.metadata import CHARM_METADATA
+from charmcraft.utils import get_host_architecture
 
 
 @pytest.fixture
@@ -115,6 +119,7 @@ def basic_project_builder(basic_project):
                 "entrypoint": basic_project / "src" / "charm.py",
                 "requirement": [],
                 "force": False,
+                "explain_ignores": False,
             },
             config,
         )
@@ -432,6 +437,21 @@ def test_validator_force(config, inp_value, out_value):
     assert result == out_value
 
 
+@pytest.mark.parametrize(
+    "inp_value,out_value",
+    [
+        (None, False),
+        (False, False),
+        (True, True),
+    ],
+)
+def test_validator_explain_ignores(config, inp_value, out_value):
+    """'explain_ignores' param: just converted to bool."""
+    validator = Validator(config)
+    result = validator.validate_explain_ignores(inp_value)
+    assert result == out_value
+
+
 # --- Polite Executor tests
 
 
@@ -509,6 +529,7 @@ def test_build_basic_complete_structure(basic_project, caplog, monkeypatch, conf
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -531,7 +552,9 @@ def test_build_basic_complete_structure(basic_project, caplog, monkeypatch, conf
     zf = zipfile.ZipFile(zipnames[0])
     assert zf.read("metadata.yaml") == metadata_raw
     assert zf.read("src/charm.py") == b"all the magic"
-    dispatch = DISPATCH_CONTENT.format(entrypoint_relative_path="src/charm.py").encode("ascii")
+    dispatch = DISPATCH_CONTENT.format(
+        pypath="lib:venv", entrypoint_relative_path="src/charm.py"
+    ).encode("ascii")
     assert zf.read("dispatch") == dispatch
     assert zf.read("hooks/install") == dispatch
     assert zf.read("hooks/start") == dispatch
@@ -561,6 +584,7 @@ def test_build_error_without_metadata_yaml(basic_project, monkeypatch):
                 "entrypoint": basic_project / "src" / "charm.py",
                 "requirement": [],
                 "force": False,
+                "explain_ignores": False,
             },
             config,
         )
@@ -610,6 +634,7 @@ def test_build_checks_provider(basic_project, mock_provider):
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -629,6 +654,7 @@ def test_build_checks_provider_error(basic_project, mock_provider):
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -646,6 +672,7 @@ def test_build_without_charmcraft_yaml_issues_dn02(basic_project, caplog, monkey
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -768,6 +795,7 @@ def test_build_project_is_cwd(
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -800,6 +828,108 @@ def test_build_project_is_cwd(
     ]
 
 
+def _lock_project(basic_project, lock_dir=True, python_packages=True, base=None):
+    """Set up the project to lock its requirements, and return the builder."""
+    host_base = get_host_as_base()
+    if base is None:
+        base = host_base
+    charm_part = []
+    if lock_dir:
+        charm_part.append("charm-lock-dir: locks")
+    if python_packages:
+        charm_part.append("charm-python-packages: [ops]")
+    charmcraft_file = basic_project / "charmcraft.yaml"
+    charmcraft_file.write_text(
+        dedent(
+            f"""\
+                type: charm
+                bases:
+                  - name: {base.name!r}
+                    channel: {base.channel!r}
+                    architectures: {host_base.architectures!r}
+                parts:
+                  charm:
+                """
+        )
+        + "".join(f"    {line}\n" for line in charm_part or ["charm-entrypoint: src/charm.py"])
+    )
+    config = load(basic_project)
+    return Builder(
+        {
+            "from": basic_project,
+            "entrypoint": None,
+            "requirement": [],
+            "force": False,
+            "explain_ignores": False,
+        },
+        config,
+    )
+
+
+def test_build_lock_in_instance(
+    basic_project, mock_capture_logs_from_instance, mock_instance, mock_provider, monkeypatch
+):
+    """The requirements are locked in the instance, writing the lock in the project."""
+    builder = _lock_project(
+        basic_project, base=Base(name="ubuntu", channel="18.04", architectures=[])
+    )
+
+    # the lock is not pulled, as it's written in the project
+    monkeypatch.chdir(basic_project)
+    lock_names = builder.run([0], lock=True)
+
+    assert lock_names == [f"locks/requirements-ubuntu-18.04-{get_host_architecture()}.lock"]
+    assert mock_instance.mock_calls == [
+        call.execute_run(
+            ["charmcraft", "lock", "--bases-index", "0"],
+            check=True,
+            cwd="/root/project",
+        ),
+    ]
+
+
+def test_build_lock_requirements(basic_project, monkeypatch):
+    """In managed mode the requirements are locked, without building the charm."""
+    monkeypatch.setenv("CHARMCRAFT_MANAGED_MODE", "1")
+    builder = _lock_project(basic_project)
+
+    with patch("charmcraft.parts.PartsLifecycle", autospec=True) as mock_lifecycle:
+        with patch("charmcraft.charm_builder.CharmBuilder.write_lock", autospec=True) as mock:
+            lock_names = builder.run([0], lock=True)
+    mock_lifecycle.assert_not_called()
+
+    ((charm_builder, downloads_dir), _) = mock.call_args
+    assert charm_builder.python_packages == ["ops"]
+    assert charm_builder.requirement_paths == []
+    assert charm_builder.allow_pip_binary is True
+    assert charm_builder.lock_dir == basic_project / "locks"
+    assert lock_names == [str(charm_builder.lock_path.relative_to(basic_project))]
+
+
+@pytest.mark.parametrize(
+    "lock_dir, python_packages, message",
+    [
+        (
+            False,
+            True,
+            "The 'charm-lock-dir' property of the 'charm' part must be set "
+            "to lock the requirements.",
+        ),
+        (True, False, "The charm has no requirements to lock."),
+    ],
+)
+def test_build_lock_requirements_error(
+    basic_project, monkeypatch, lock_dir, python_packages, message
+):
+    """The requirements can be locked only if it's configured and there are any."""
+    monkeypatch.setenv("CHARMCRAFT_MANAGED_MODE", "1")
+    builder = _lock_project(basic_project, lock_dir=lock_dir, python_packages=python_packages)
+
+    with pytest.raises(CommandError) as raised:
+        builder.run([0], lock=True)
+    assert str(raised.value) == message
+
+
 def test_build_project_is_not_cwd(
     basic_project,
     caplog,
@@ -832,6 +962,7 @@ def test_build_project_is_not_cwd(
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -915,6 +1046,7 @@ def test_build_bases_index_scenarios_provider(
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1097,6 +1229,7 @@ def test_build_bases_index_scenarios_managed_mode(basic_project, monkeypatch, ca
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": True,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1154,6 +1287,7 @@ def test_build_error_no_match_with_charmcraft_yaml(
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1238,6 +1372,7 @@ def test_build_package_tree_structure(tmp_path, monkeypatch, config):
             "entrypoint": "whatever",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1274,6 +1409,7 @@ def test_build_package_name(tmp_path, monkeypatch, config):
             "entrypoint": "whatever",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1282,6 +1418,118 @@ def test_build_package_name(tmp_path, monkeypatch, config):
     assert zipname == "name-from-metadata.charm"
 
 
+def test_build_package_compression_policy(tmp_path, monkeypatch, config):
+    """The zip members are compressed following the packing configuration."""
+    to_be_zipped_dir = tmp_path / BUILD_DIRNAME
+    to_be_zipped_dir.mkdir()
+    metadata_file = tmp_path / "metadata.yaml"
+    metadata_file.write_text("name: test-charm")
+    config.set(
+        packing=PackingConfig(
+            **{"compression-level": 1, "store": ["*.bin"], "store-incompressible": False}
+        )
+    )
+
+    monkeypatch.chdir(tmp_path)  # so the zip file is left in the temp dir
+    builder = Builder(
+        {
+            "from": tmp_path,
+            "entrypoint": "whatever",
+            "requirement": [],
+            "force": False,
+            "explain_ignores": False,
+        },
+        config,
+    )
+    with patch("charmcraft.commands.build.build_zip") as build_zip_mock:
+        zipname = builder.handle_package(to_be_zipped_dir)
+
+    ((zippath, prime_dir), kwargs) = build_zip_mock.call_args
+    assert (zippath, prime_dir) == (zipname, to_be_zipped_dir)
+    policy = kwargs["policy"]
+    assert policy.level == 1
+    assert policy.stored_patterns == ["*.bin"]
+    assert policy.store_incompressible is False
+    assert kwargs["timestamp"] is None
+    assert kwargs["incremental"] is False
+
+
+def test_build_package_reproducible(tmp_path, monkeypatch, config):
+    """A reproducible package only depends on the content of the files."""
+    to_be_zipped_dir = tmp_path / BUILD_DIRNAME
+    to_be_zipped_dir.mkdir()
+    (to_be_zipped_dir / "somefile").write_text("some content")
+    metadata_file = tmp_path / "metadata.yaml"
+    metadata_file.write_text("name: test-charm")
+    config.set(packing=PackingConfig(reproducible=True))
+
+    monkeypatch.chdir(tmp_path)  # so the zip file is left in the temp dir
+    builder = Builder(
+        {
+            "from": tmp_path,
+            "entrypoint": "whatever",
+            "requirement": [],
+            "force": False,
+            "explain_ignores": False,
+        },
+        config,
+    )
+    zipname = builder.handle_package(to_be_zipped_dir)
+    first_content = pathlib.Path(zipname).read_bytes()
+
+    os.utime(str(to_be_zipped_dir / "somefile"), (1700000000, 1700000000))
+    (to_be_zipped_dir / "somefile").chmod(0o600)
+    zipname = builder.handle_package(to_be_zipped_dir)
+    assert pathlib.Path(zipname).read_bytes() == first_content
+
+
+def test_get_packing_timestamp_not_reproducible(config, monkeypatch):
+    """No timestamp is forced if the package is not reproducible."""
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1600000000")
+    assert get_packing_timestamp(config) is None
+
+
+def test_get_packing_timestamp_default(config, monkeypatch):
+    """The oldest date of the package format is used if none was set."""
+    monkeypatch.delenv("SOURCE_DATE_EPOCH", raising=False)
+    config.set(packing=PackingConfig(reproducible=True))
+    assert get_packing_timestamp(config) == datetime.datetime(1980, 1, 1)
+
+
+def test_get_packing_timestamp_source_date_epoch(config, monkeypatch):
+    """The build start time is used if it was set."""
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1600000000")
+    config.set(packing=PackingConfig(reproducible=True))
+    assert get_packing_timestamp(config) == datetime.datetime(2020, 9, 13, 12, 26, 40)
+
+
+def test_get_packing_timestamp_source_date_epoch_invalid(config, monkeypatch):
+    """The build start time set is validated when it's used."""
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "yesterday")
+    config.set(packing=PackingConfig(reproducible=True))
+    with pytest.raises(CommandError):
+        get_packing_timestamp(config)
+
+
+def test_get_started_at(config, monkeypatch):
+    """The build start time is when the config was loaded if it was not set."""
+    monkeypatch.delenv("SOURCE_DATE_EPOCH", raising=False)
+    assert get_started_at(config) == config.project.started_at
+
+
+def test_get_started_at_source_date_epoch(config, monkeypatch):
+    """The build start time can be set through SOURCE_DATE_EPOCH."""
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1600000000")
+    assert get_started_at(config) == datetime.datetime(2020, 9, 13, 12, 26, 40)
+
+
+def test_get_started_at_source_date_epoch_invalid(config, monkeypatch):
+    """The build start time set is validated when it's used."""
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "yesterday")
+    with pytest.raises(CommandError):
+        get_started_at(config)
+
+
 def test_build_with_entrypoint_argument_issues_dn04(basic_project, caplog, monkeypatch):
     """Test cases for base-index parameter."""
     config = load(basic_project)
@@ -1291,6 +1539,7 @@ def test_build_with_entrypoint_argument_issues_dn04(basic_project, caplog, monke
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1333,6 +1582,7 @@ def test_build_entrypoint_from_parts(basic_project, monkeypatch, caplog):
             "entrypoint": None,
             "requirement": [],
             "force": True,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1403,6 +1653,7 @@ def test_build_entrypoint_from_commandline(basic_project, monkeypatch, caplog):
             "entrypoint": basic_project / "my_entrypoint.py",
             "requirement": [],
             "force": True,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1473,6 +1724,7 @@ def test_build_entrypoint_default(basic_project, monkeypatch, caplog):
             "entrypoint": None,
             "requirement": [],
             "force": True,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1541,6 +1793,7 @@ def test_build_entrypoint_from_both(basic_project, monkeypatch, caplog):
             "entrypoint": basic_project / "my_entrypoint.py",
             "requirement": [],
             "force": True,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1566,6 +1819,7 @@ def test_build_with_requirement_argment_issues_dn05(basic_project, caplog, monke
             "entrypoint": None,
             "requirement": ["reqs.txt"],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1609,6 +1863,7 @@ def test_build_requirements_from_parts(basic_project, monkeypatch, caplog):
             "entrypoint": None,
             "requirement": [],
             "force": True,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1679,6 +1934,7 @@ def test_build_requirements_from_commandline(basic_project, monkeypatch, caplog)
             "entrypoint": None,
             "requirement": ["reqs.txt"],
             "force": True,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1749,6 +2005,7 @@ def test_build_requirements_default(basic_project, monkeypatch, caplog):
             "entrypoint": None,
             "requirement": [],
             "force": True,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1819,6 +2076,7 @@ def test_build_requirements_no_requirements_txt(basic_project, monkeypatch, capl
             "entrypoint": None,
             "requirement": [],
             "force": True,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1855,6 +2113,273 @@ def test_build_requirements_no_requirements_txt(basic_project, monkeypatch, capl
     )
 
 
+def test_build_explain_ignores_part_property(basic_project, monkeypatch):
+    """The request to explain the ignore rules is passed to the charm part."""
+    host_base = get_host_as_base()
+    charmcraft_file = basic_project / "charmcraft.yaml"
+    charmcraft_file.write_text(
+        dedent(
+            f"""\
+                type: charm
+                bases:
+                  - build-on:
+                      - name: {host_base.name!r}
+                        channel: {host_base.channel!r}
+                    run-on:
+                      - name: {host_base.name!r}
+                        channel: {host_base.channel!r}
+                """
+        )
+    )
+    config = load(basic_project)
+    monkeypatch.chdir(basic_project)
+    builder = Builder(
+        {
+            "from": basic_project,
+            "entrypoint": None,
+            "requirement": [],
+            "force": False,
+            "explain_ignores": True,
+        },
+        config,
+    )
+
+    monkeypatch.setenv("CHARMCRAFT_MANAGED_MODE", "1")
+    with patch("charmcraft.parts.PartsLifecycle", autospec=True) as mock_lifecycle:
+        mock_lifecycle.side_effect = SystemExit()
+        with pytest.raises(SystemExit):
+            builder.run([0])
+    (parts_config,) = mock_lifecycle.call_args[0]
+    assert parts_config["charm"]["charm-explain-ignores"] is True
+
+
+@pytest.mark.parametrize(
+    "reproducible, source_date_epoch, expected",
+    [
+        ("false", "1600000000", None),
+        ("true", None, 315532800),
+        ("true", "1600000000", 1600000000),
+    ],
+)
+def test_build_reproducible_charm_part(
+    basic_project, monkeypatch, reproducible, source_date_epoch, expected
+):
+    """The charm builder gets the date for what it generates if the package is reproducible."""
+    if source_date_epoch is None:
+        monkeypatch.delenv("SOURCE_DATE_EPOCH", raising=False)
+    else:
+        monkeypatch.setenv("SOURCE_DATE_EPOCH", source_date_epoch)
+    host_base = get_host_as_base()
+    charmcraft_file = basic_project / "charmcraft.yaml"
+    charmcraft_file.write_text(
+        dedent(
+            f"""\
+                type: charm
+                bases:
+                  - build-on:
+                      - name: {host_base.name!r}
+                        channel: {host_base.channel!r}
+                    run-on:
+                      - name: {host_base.name!r}
+                        channel: {host_base.channel!r}
+                packing:
+                  reproducible: {reproducible}
+                """
+        )
+    )
+    config = load(basic_project)
+    monkeypatch.chdir(basic_project)
+    builder = Builder(
+        {
+            "from": basic_project,
+            "entrypoint": None,
+            "requirement": [],
+            "force": False,
+            "explain_ignores": False,
+        },
+        config,
+    )
+
+    monkeypatch.setenv("CHARMCRAFT_MANAGED_MODE", "1")
+    with patch("charmcraft.parts.PartsLifecycle", autospec=True) as mock_lifecycle:
+        mock_lifecycle.side_effect = SystemExit()
+        with pytest.raises(SystemExit):
+            builder.run([0])
+    (parts_config,) = mock_lifecycle.call_args[0]
+    assert parts_config["charm"].get("charm-source-date-epoch") == expected
+
+
+def test_build_wheelhouse_in_project(basic_project, monkeypatch):
+    """The wheelhouse is located in the project, no matter where the part is built."""
+    host_base = get_host_as_base()
+    charmcraft_file = basic_project / "charmcraft.yaml"
+    charmcraft_file.write_text(
+        dedent(
+            f"""\
+                type: charm
+                bases:
+                  - build-on:
+                      - name: {host_base.name!r}
+                        channel: {host_base.channel!r}
+                    run-on:
+                      - name: {host_base.name!r}
+                        channel: {host_base.channel!r}
+                parts:
+                  charm:
+                    charm-wheelhouse: wheels
+                """
+        )
+    )
+    config = load(basic_project)
+    monkeypatch.chdir(basic_project)
+    builder = Builder(
+        {
+            "from": basic_project,
+            "entrypoint": None,
+            "requirement": [],
+            "force": False,
+            "explain_ignores": False,
+        },
+        config,
+    )
+
+    monkeypatch.setenv("CHARMCRAFT_MANAGED_MODE", "1")
+    with patch("charmcraft.parts.PartsLifecycle", autospec=True) as mock_lifecycle:
+        mock_lifecycle.side_effect = SystemExit()
+        with pytest.raises(SystemExit):
+            builder.run([0])
+    (parts_config,) = mock_lifecycle.call_args[0]
+    assert parts_config["charm"]["charm-wheelhouse"] == str(basic_project / "wheels")
+
+
+def test_build_python_packages_venv_primed(basic_project, monkeypatch):
+    """The virtualenv is included in the charm if there are only extra Python packages."""
+    host_base = get_host_as_base()
+    charmcraft_file = basic_project / "charmcraft.yaml"
+    charmcraft_file.write_text(
+        dedent(
+            f"""\
+                type: charm
+                bases:
+                  - build-on:
+                      - name: {host_base.name!r}
+                        channel: {host_base.channel!r}
+                    run-on:
+                      - name: {host_base.name!r}
+                        channel: {host_base.channel!r}
+                parts:
+                  charm:
+                    charm-python-packages: [ops]
+                """
+        )
+    )
+    config = load(basic_project)
+    monkeypatch.chdir(basic_project)
+    builder = Builder(
+        {
+            "from": basic_project,
+            "entrypoint": None,
+            "requirement": [],
+            "force": False,
+            "explain_ignores": False,
+        },
+        config,
+    )
+
+    monkeypatch.setenv("CHARMCRAFT_MANAGED_MODE", "1")
+    with patch("charmcraft.parts.PartsLifecycle", autospec=True) as mock_lifecycle:
+        mock_lifecycle.side_effect = SystemExit()
+        with pytest.raises(SystemExit):
+            builder.run([0])
+    (parts_config,) = mock_lifecycle.call_args[0]
+    assert parts_config["charm"]["charm-requirements"] == []
+    assert "venv" in parts_config["charm"]["prime"]
+
+
+def test_build_zipimport_primed(basic_project, monkeypatch):
+    """The zipimport archives are included in the charm, with what is kept out of them."""
+    host_base = get_host_as_base()
+    charmcraft_file = basic_project / "charmcraft.yaml"
+    charmcraft_file.write_text(
+        dedent(
+            f"""\
+                type: charm
+                bases:
+                  - build-on:
+                      - name: {host_base.name!r}
+                        channel: {host_base.channel!r}
+                    run-on:
+                      - name: {host_base.name!r}
+                        channel: {host_base.channel!r}
+                parts:
+                  charm:
+                    charm-python-packages: [ops]
+                    charm-zipimport: [venv, lib]
+                """
+        )
+    )
+    (basic_project / "lib").mkdir(exist_ok=True)
+    config = load(basic_project)
+    monkeypatch.chdir(basic_project)
+    builder = Builder(
+        {
+            "from": basic_project,
+            "entrypoint": None,
+            "requirement": [],
+            "force": False,
+            "explain_ignores": False,
+        },
+        config,
+    )
+
+    monkeypatch.setenv("CHARMCRAFT_MANAGED_MODE", "1")
+    with patch("charmcraft.parts.PartsLifecycle", autospec=True) as mock_lifecycle:
+        mock_lifecycle.side_effect = SystemExit()
+        with pytest.raises(SystemExit):
+            builder.run([0])
+    (parts_config,) = mock_lifecycle.call_args[0]
+    prime = parts_config["charm"]["prime"]
+    assert {"venv", "venv.zip", "lib", "lib.zip"} <= set(prime)
+
+
+def test_build_explain_ignores_in_instance(basic_project, mock_instance, monkeypatch):
+    """The request to explain the ignore rules is passed to the pack inside the instance."""
+    host_base = get_host_as_base()
+    charmcraft_file = basic_project / "charmcraft.yaml"
+    charmcraft_file.write_text(
+        dedent(
+            f"""\
+                type: charm
+                bases:
+                  - name: ubuntu
+                    channel: "18.04"
+                    architectures: {host_base.architectures!r}
+                """
+        )
+    )
+    config = load(basic_project)
+    monkeypatch.chdir(basic_project)
+    builder = Builder(
+        {
+            "from": basic_project,
+            "entrypoint": basic_project / "src" / "charm.py",
+            "requirement": [],
+            "force": False,
+            "explain_ignores": True,
+        },
+        config,
+    )
+
+    builder.run([0])
+    assert mock_instance.mock_calls == [
+        call.execute_run(
+            ["charmcraft", "pack", "--bases-index", "0", "--explain-ignores"],
+            check=True,
+            cwd="/root/project",
+        ),
+    ]
+
+
 def test_build_requirements_from_both(basic_project, monkeypatch, caplog):
     """Test cases for base-index parameter."""
     host_base = get_host_as_base()
@@ -1885,6 +2410,7 @@ def test_build_requirements_from_both(basic_project, monkeypatch, caplog):
             "entrypoint": None,
             "requirement": ["reqs.txt"],
             "force": True,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1908,6 +2434,7 @@ def test_build_using_linters_attributes(basic_project, monkeypatch, config):
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -1965,6 +2492,7 @@ def test_show_linters_attributes(basic_project, caplog, config):
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -2007,6 +2535,7 @@ def test_show_linters_lint_warnings(basic_project, caplog, config):
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -2043,6 +2572,7 @@ def test_show_linters_lint_errors_normal(basic_project, caplog, config):
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": False,
+            "explain_ignores": False,
         },
         config,
     )
@@ -2083,6 +2613,7 @@ def test_show_linters_lint_errors_forced(basic_project, caplog, config):
             "entrypoint": basic_project / "src" / "charm.py",
             "requirement": [],
             "force": True,
+            "explain_ignores": False,
         },
         config,
     )
@@ -0,0 +1,71 @@
+# Copyright 2020-2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For further info, check https://github.com/canonical/charmcraft
+
+"""Tests for the lock command."""
+
+from argparse import Namespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from charmcraft.cmdbase import CommandError
+from charmcraft.commands.lock import LockCommand
+
+
+def test_lock_bundle(config):
+    """Only the requirements of charms can be locked."""
+    config.set(type="bundle")
+    args = Namespace(destructive_mode=False, bases_index=None)
+
+    with pytest.raises(CommandError) as cm:
+        LockCommand("group", config).run(args)
+    assert str(cm.value) == "Only the requirements of a charm can be locked."
+
+
+def test_lock_validator(config, tmp_path):
+    """The build infrastructure validates the arguments."""
+    args = Namespace(destructive_mode=True, bases_index=[1])
+    config.set(type="charm")
+    with patch("charmcraft.commands.build.Validator", autospec=True) as validator_class_mock:
+        validator_class_mock.return_value = validator_instance_mock = MagicMock()
+        with patch("charmcraft.commands.build.Builder"):
+            LockCommand("group", config).run(args)
+    validator_instance_mock.process.assert_called_with(
+        Namespace(
+            **{
+                "destructive_mode": True,
+                "from": tmp_path,
+                "entrypoint": None,
+                "requirement": None,
+                "bases_indices": [1],
+                "force": False,
+                "explain_ignores": False,
+            }
+        )
+    )
+
+
+def test_lock_builder_infrastructure_called(config):
+    """The build infrastructure is run to lock the requirements."""
+    config.set(type="charm")
+    args = Namespace(destructive_mode=False, bases_index=None)
+    with patch("charmcraft.commands.build.Validator", autospec=True) as validator_mock:
+        validator_mock(config).process.return_value = "processed args"
+        with patch("charmcraft.commands.build.Builder") as builder_class_mock:
+            builder_class_mock.return_value = builder_instance_mock = MagicMock()
+            LockCommand("group", config).run(args)
+    builder_class_mock.assert_called_with("processed args", config)
+    builder_instance_mock.run.assert_called_with(None, destructive_mode=False, lock=True)
@@ -37,6 +37,7 @@ noargs = Namespace(
     bases_index=[],
     destructive_mode=False,
     force=None,
+    explain_ignores=False,
 )
 
 
@@ -115,6 +116,16 @@ def test_resolve_bundle_with_entrypoint(config):
     assert str(cm.value) == "The -e/--entry option is valid only when packing a charm"
 
 
+def test_resolve_bundle_with_explain_ignores(config):
+    """The explain ignores option is not valid when packing a bundle."""
+    config.set(type="bundle")
+    args = Namespace(requirement=None, entrypoint=None, explain_ignores=True)
+
+    with pytest.raises(CommandError) as cm:
+        PackCommand("group", config).run(args)
+    assert str(cm.value) == "The --explain-ignores option is valid only when packing a charm"
+
+
 # -- tests for main bundle building process
 
 
@@ -442,6 +453,7 @@ def test_charm_parameters_validator(config, tmp_path):
         entrypoint="test-epoint",
         bases_index=[],
         force=True,
+        explain_ignores=False,
     )
     config.set(
         type="charm",
@@ -460,6 +472,7 @@ def test_charm_parameters_validator(config, tmp_path):
                 "entrypoint": "test-epoint",
                 "bases_indices": [],
                 "force": True,
+                "explain_ignores": False,
             }
         )
     )
@@ -16,20 +16,32 @@
 
 import errno
 import filecmp
+import hashlib
+import importlib.util
+import io
+import json
 import logging
 import os
 import pathlib
+import py_compile
+import re
 import socket
+import subprocess
 import sys
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import call, patch
 
 import pytest
 
 from charmcraft import charm_builder
-from charmcraft.charm_builder import VENV_DIRNAME, CharmBuilder
+from charmcraft.charm_builder import DISPATCH_CONTENT, VENV_DIRNAME, CharmBuilder
 from charmcraft.cmdbase import CommandError
-from charmcraft.commands.build import BUILD_DIRNAME, DISPATCH_CONTENT, DISPATCH_FILENAME
+from charmcraft.commands.build import BUILD_DIRNAME, DISPATCH_FILENAME
 from charmcraft.metadata import CHARM_METADATA
+from charmcraft.packing import MIN_TIMESTAMP, build_zip
+from charmcraft.utils import OSPlatform
 
 
 def test_build_generics_simple_files(tmp_path):
@@ -153,7 +165,7 @@ def test_build_generics_ignored_dir(tmp_path, caplog):
     assert expected in [rec.message for rec in caplog.records]
 
 
-def _test_build_generics_tree(tmp_path, caplog, *, expect_hardlinks):
+def _test_build_generics_tree(tmp_path, caplog, *, expect_hardlinks, link_workers=1):
     caplog.set_level(logging.DEBUG)
 
     build_dir = tmp_path / BUILD_DIRNAME
@@ -197,6 +209,7 @@ def _test_build_generics_tree(tmp_path, caplog, *, expect_hardlinks):
         charmdir=tmp_path,
         builddir=build_dir,
         entrypoint=entrypoint,
+        link_workers=link_workers,
     )
 
     # set it up to ignore some stuff and make it work
@@ -257,6 +270,140 @@ def test_build_generics_tree_xdev(tmp_path, caplog):
         _test_build_generics_tree(tmp_path, caplog, expect_hardlinks=False)
 
 
+def test_build_generics_tree_parallel(tmp_path, caplog):
+    """Manages ok a deep tree, including internal ignores, linking concurrently."""
+    _test_build_generics_tree(tmp_path, caplog, expect_hardlinks=True, link_workers=4)
+
+
+def test_build_generics_tree_parallel_xdev(tmp_path, caplog):
+    """Manages ok a deep tree copying concurrently when hardlinks can't be done."""
+    with patch("os.link") as mock_link:
+        mock_link.side_effect = OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        _test_build_generics_tree(tmp_path, caplog, expect_hardlinks=False, link_workers=4)
+
+
+def test_build_generics_parallel_error_order(tmp_path):
+    """When linking concurrently, the error raised is from the first failing file."""
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=tmp_path / BUILD_DIRNAME,
+        entrypoint=tmp_path / "charm.py",
+        link_workers=4,
+    )
+    to_link = [(str(tmp_path / "src{}".format(i)), "dest{}".format(i)) for i in range(20)]
+
+    def fake_link(src, dest):
+        if dest in ("dest7", "dest3", "dest15"):
+            raise OSError(errno.EIO, "failed " + dest)
+
+    with patch("os.link", side_effect=fake_link):
+        with pytest.raises(OSError) as raised:
+            builder.link_files(to_link)
+    assert str(raised.value) == "[Errno 5] failed dest3"
+
+
+def test_build_generics_link_strategies(tmp_path, caplog):
+    """The strategy used to link or copy each file is recorded."""
+    caplog.set_level(logging.DEBUG)
+    build_dir = tmp_path / BUILD_DIRNAME
+    build_dir.mkdir()
+    entrypoint = tmp_path / "crazycharm.py"
+    entrypoint.touch()
+    (tmp_path / "file1.txt").write_text("content")
+
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=entrypoint,
+    )
+    with patch("os.link", side_effect=[None, OSError(errno.EXDEV, "xdev")]):
+        with patch("charmcraft.charm_builder._copy_file", return_value="reflink"):
+            builder.handle_generic_paths()
+
+    assert builder.link_strategies == {"hardlink": 1, "reflink": 1}
+    expected = "Files linked or copied: 1 by hardlink, 1 by reflink"
+    assert expected in [rec.message for rec in caplog.records]
+
+
+def _copy_and_check(tmp_path, content=b"some content"):
+    """Copy a file returning the strategy used, after checking it was properly copied."""
+    src = tmp_path / "src"
+    src.write_bytes(content)
+    src.chmod(0o751)
+    os.utime(src, (1234567, 7654321))
+    dest = tmp_path / "dest"
+
+    strategy = charm_builder._copy_file(str(src), str(dest))
+
+    assert dest.read_bytes() == content
+    assert dest.stat().st_mode == src.stat().st_mode
+    assert dest.stat().st_mtime == src.stat().st_mtime
+    assert not dest.samefile(src)
+    return strategy
+
+
+def _unsupported(*args):
+    raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+
+
+def test_copy_file_reflink(tmp_path):
+    """Files are cloned if the filesystem supports it."""
+    with patch("charmcraft.charm_builder.fcntl") as mock_fcntl:
+        # fake the clone, copying the content
+        def fake_clone(dest_fd, request, src_fd):
+            os.write(dest_fd, os.read(src_fd, 1000))
+
+        mock_fcntl.ioctl.side_effect = fake_clone
+        assert _copy_and_check(tmp_path) == "reflink"
+    assert mock_fcntl.ioctl.call_args[0][1] == charm_builder.FICLONE
+
+
+def test_copy_file_copy_file_range(tmp_path):
+    """If the file can't be cloned it's copied inside the kernel."""
+    with patch("charmcraft.charm_builder.fcntl.ioctl", side_effect=_unsupported):
+        assert _copy_and_check(tmp_path) == "copy_file_range"
+
+
+@pytest.mark.parametrize("content", [b"", b"x" * 100000])
+def test_copy_file_copy_file_range_sizes(tmp_path, content):
+    """Empty and big files are copied inside the kernel too."""
+    with patch("charmcraft.charm_builder.fcntl.ioctl", side_effect=_unsupported):
+        assert _copy_and_check(tmp_path, content) == "copy_file_range"
+
+
+def test_copy_file_sendfile(tmp_path):
+    """If copy_file_range is not possible, sendfile is used."""
+    with patch("charmcraft.charm_builder.fcntl.ioctl", side_effect=_unsupported):
+        with patch("os.copy_file_range", side_effect=_unsupported, create=True):
+            assert _copy_and_check(tmp_path) == "sendfile"
+
+
+def test_copy_file_copy_file_range_nothing_copied(tmp_path):
+    """If copy_file_range doesn't copy anything from a non empty file, sendfile is used."""
+    with patch("charmcraft.charm_builder.fcntl.ioctl", side_effect=_unsupported):
+        with patch("os.copy_file_range", return_value=0, create=True):
+            assert _copy_and_check(tmp_path) == "sendfile"
+
+
+def test_copy_file_buffered(tmp_path):
+    """If nothing can be done in the kernel, the file is copied through user space."""
+    with patch("charmcraft.charm_builder.fcntl.ioctl", side_effect=_unsupported):
+        with patch("os.copy_file_range", side_effect=_unsupported, create=True):
+            with patch("os.sendfile", side_effect=_unsupported):
+                assert _copy_and_check(tmp_path) == "buffered"
+
+
+def test_copy_file_error(tmp_path):
+    """Errors other than the strategy not being supported are raised."""
+    src = tmp_path / "src"
+    src.write_text("content")
+    with patch("charmcraft.charm_builder.fcntl.ioctl", side_effect=_unsupported):
+        with patch("os.copy_file_range", side_effect=OSError(errno.ENOSPC, "full"), create=True):
+            with pytest.raises(OSError) as raised:
+                charm_builder._copy_file(str(src), str(tmp_path / "dest"))
+    assert raised.value.errno == errno.ENOSPC
+
+
 def test_build_generics_symlink_file(tmp_path):
     """Respects a symlinked file."""
     build_dir = tmp_path / BUILD_DIRNAME
@@ -442,6 +589,32 @@ def test_build_generics_different_filetype(tmp_path, caplog, monkeypatch):
     assert expected in [rec.message for rec in caplog.records]
 
 
+def test_build_generics_walk_order_and_symlinks(tmp_path):
+    """The tree is walked top-down in directory order, never through symlinks."""
+    (tmp_path / "dir1" / "sub").mkdir(parents=True)
+    (tmp_path / "dir1" / "sub" / "file").touch()
+    (tmp_path / "dir2").mkdir()
+    (tmp_path / "dir2" / "link").symlink_to(tmp_path / "dir1")
+    (tmp_path / "file").touch()
+
+    walked = []
+    for rel_dirpath, dir_entries, file_entries in charm_builder._walk(str(tmp_path)):
+        dir_entries.sort(key=lambda entry: entry.name)
+        walked.append(
+            (
+                rel_dirpath,
+                [entry.name for entry in dir_entries],
+                sorted(entry.name for entry in file_entries),
+            )
+        )
+    assert walked == [
+        ("", ["dir1", "dir2"], ["file"]),
+        ("dir1", ["sub"], []),
+        ("dir1/sub", [], ["file"]),
+        ("dir2", ["link"], []),
+    ]
+
+
 def test_build_dispatcher_modern_dispatch_created(tmp_path):
     """The dispatcher script is properly built."""
     metadata = tmp_path / CHARM_METADATA
@@ -461,7 +634,9 @@ def test_build_dispatcher_modern_dispatch_created(tmp_path):
     included_dispatcher = build_dir / DISPATCH_FILENAME
     with included_dispatcher.open("rt", encoding="utf8") as fh:
         dispatcher_code = fh.read()
-    assert dispatcher_code == DISPATCH_CONTENT.format(entrypoint_relative_path="somestuff.py")
+    assert dispatcher_code == DISPATCH_CONTENT.format(
+        pypath="lib:venv", entrypoint_relative_path="somestuff.py"
+    )
 
 
 def test_build_dispatcher_modern_dispatch_respected(tmp_path):
@@ -747,6 +922,1181 @@ def test_build_dependencies_virtualenv_error_installing(tmp_path):
             builder.handle_dependencies()
 
 
+def _build_dependencies_cached(tmp_path, cache_dir, build_name="build", venv_cache=True):
+    """Install the dependencies using the cache, faking pip; return the pip calls."""
+    build_dir = tmp_path / build_name
+    build_dir.mkdir()
+    venvpath = build_dir / VENV_DIRNAME
+
+    def fake_pip(cmd):
+        if cmd[1] == "install":
+            (venvpath / "ops").mkdir(parents=True)
+            (venvpath / "ops" / "__init__.py").write_text("ops")
+            (venvpath / "ops.link").symlink_to("ops")
+        return 0
+
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=pathlib.Path("whatever"),
+        requirements=[str(tmp_path / "reqs.txt")],
+        cache_dir=cache_dir,
+        venv_cache=venv_cache,
+    )
+    with patch("charmcraft.charm_builder.subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 1
+        mock_run.return_value.stdout = (
+            "pip 20.0.2 from /usr/lib/python3/dist-packages/pip (python 3.8)\n"
+        )
+        with patch("charmcraft.charm_builder._process_run", side_effect=fake_pip) as mock:
+            builder.handle_dependencies()
+
+    assert (venvpath / "ops" / "__init__.py").read_text() == "ops"
+    assert os.readlink(venvpath / "ops.link") == "ops"
+    return [c[1][0][:2] for c in mock.mock_calls]
+
+
+def test_build_dependencies_cache_miss_and_hit(tmp_path):
+    """The installed dependencies are stored in the cache and reused later."""
+    (tmp_path / "reqs.txt").write_text("ops")
+    cache_dir = tmp_path / "cache"
+
+    calls = _build_dependencies_cached(tmp_path, cache_dir, "build1")
+    assert calls == [["pip3", "--version"], ["pip3", "install"]]
+    (cached,) = [p for p in (cache_dir / charm_builder.VENV_CACHE_DIRNAME).iterdir() if p.is_dir()]
+    assert (cached / "ops" / "__init__.py").samefile(
+        tmp_path / "build1" / "venv" / "ops" / "__init__.py"
+    )
+    assert json.loads(cached.with_suffix(".json").read_text()) == {"size": 3}
+
+    # pip is not used to install anything in the second build
+    calls = _build_dependencies_cached(tmp_path, cache_dir, "build2")
+    assert calls == [["pip3", "--version"]]
+    assert (tmp_path / "build2" / "venv" / "ops" / "__init__.py").samefile(
+        cached / "ops" / "__init__.py"
+    )
+
+
+def test_build_dependencies_cache_not_requested(tmp_path):
+    """The installed dependencies are not cached unless requested."""
+    (tmp_path / "reqs.txt").write_text("ops")
+    cache_dir = tmp_path / "cache"
+
+    _build_dependencies_cached(tmp_path, cache_dir, "build1", venv_cache=False)
+    calls = _build_dependencies_cached(tmp_path, cache_dir, "build2", venv_cache=False)
+    assert calls[-1] == ["pip3", "install"]
+    assert not (cache_dir / charm_builder.VENV_CACHE_DIRNAME).exists()
+
+
+def test_build_dependencies_cache_requirements_changed(tmp_path):
+    """The cache is not used if the requirements changed."""
+    (tmp_path / "reqs.txt").write_text("ops")
+    cache_dir = tmp_path / "cache"
+    _build_dependencies_cached(tmp_path, cache_dir, "build1")
+
+    (tmp_path / "reqs.txt").write_text("ops==1.2")
+    calls = _build_dependencies_cached(tmp_path, cache_dir, "build2")
+    assert calls == [["pip3", "--version"], ["pip3", "install"]]
+    assert len(list((cache_dir / charm_builder.VENV_CACHE_DIRNAME).glob("*.json"))) == 2
+
+
+def test_build_dependencies_cache_key(tmp_path):
+    """The cache key covers requirements, pip and Python versions, platform, and bytecode."""
+    (tmp_path / "reqs.txt").write_text("ops")
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=tmp_path / BUILD_DIRNAME,
+        entrypoint=pathlib.Path("whatever"),
+        requirements=[str(tmp_path / "reqs.txt")],
+        cache_dir=tmp_path / "cache",
+    )
+
+    def get_key(pip_version, os_platform=("ubuntu", "20.04", "x86_64")):
+        with patch("charmcraft.charm_builder.subprocess.run") as mock_run:
+            mock_run.return_value.stdout = pip_version
+            with patch("charmcraft.charm_builder.get_os_platform", return_value=os_platform):
+                return builder._dependencies_key()
+
+    key = get_key("pip 20.0.2 from /usr/lib (python 3.8)")
+    assert key == get_key("pip 20.0.2 from /usr/lib (python 3.8)")
+    assert key != get_key("pip 20.0.2 from /usr/lib (python 3.9)")
+    assert key != get_key("pip 21.0 from /usr/lib (python 3.8)")
+    assert key != get_key("pip 20.0.2 from /usr/lib (python 3.8)", ("ubuntu", "18.04", "x86_64"))
+    assert key != get_key("pip 20.0.2 from /usr/lib (python 3.8)", ("ubuntu", "20.04", "aarch64"))
+
+    # what pip installs when building reproducibly is not what it installs otherwise
+    builder.source_date_epoch = 315532800
+    assert key != get_key("pip 20.0.2 from /usr/lib (python 3.8)")
+    builder.source_date_epoch = None
+
+    # requirements file missing, no cache
+    builder.requirement_paths = [str(tmp_path / "missing.txt")]
+    assert get_key("pip 20.0.2 from /usr/lib (python 3.8)") is None
+
+
+def test_build_dependencies_cache_lru(tmp_path):
+    """The least recently used entries are removed when the cache is too big."""
+    cache_path = tmp_path / "cache" / charm_builder.VENV_CACHE_DIRNAME
+    cache_path.mkdir(parents=True)
+    for age, name in enumerate(["new", "mid", "old", "older"]):
+        (cache_path / name).mkdir()
+        meta = cache_path / (name + ".json")
+        meta.write_text(json.dumps({"size": 100}))
+        os.utime(meta, (1000000 - age, 1000000 - age))
+    (cache_path / "older.json").write_text("broken")
+
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=tmp_path / BUILD_DIRNAME,
+        entrypoint=pathlib.Path("whatever"),
+        cache_dir=tmp_path / "cache",
+        venv_cache_size=150,
+    )
+    builder._clean_venv_cache(keep="mid")
+
+    # the oldest one is removed, then the kept one is skipped, and then the newer one
+    assert sorted(p.name for p in cache_path.iterdir()) == [
+        "mid",
+        "mid.json",
+        "older",
+        "older.json",
+    ]
+
+
+def test_build_dependencies_cache_store_error(tmp_path):
+    """Problems storing in the cache are not fatal."""
+    (tmp_path / "reqs.txt").write_text("ops")
+    cache_dir = tmp_path / "cache"
+    cache_dir.write_text("not a directory")
+
+    calls = _build_dependencies_cached(tmp_path, cache_dir)
+    assert calls == [["pip3", "--version"], ["pip3", "install"]]
+
+
+def _build_dependencies_wheelhouse(tmp_path, pip_retcode=0):
+    """Install the dependencies using a wheelhouse, faking pip; return the pip calls."""
+    build_dir = tmp_path / BUILD_DIRNAME
+    build_dir.mkdir(exist_ok=True)
+    (tmp_path / "reqs.txt").write_text("ops")
+    wheelhouse = tmp_path / "wheels"
+
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=pathlib.Path("whatever"),
+        requirements=[str(tmp_path / "reqs.txt")],
+        wheelhouse=wheelhouse,
+    )
+    with patch("charmcraft.charm_builder.subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 1
+        mock_run.return_value.stdout = (
+            "pip 20.0.2 from /usr/lib/python3/dist-packages/pip (python 3.8)\n"
+        )
+        with patch("charmcraft.charm_builder._process_run") as mock:
+            mock.side_effect = lambda cmd: 0 if cmd[1] == "--version" else pip_retcode
+            builder.handle_dependencies()
+    return mock.mock_calls
+
+
+def test_build_dependencies_wheelhouse(tmp_path):
+    """The wheels are got once in the wheelhouse, and installed from there without index."""
+    wheelhouse = tmp_path / "wheels"
+    envpath = tmp_path / BUILD_DIRNAME / VENV_DIRNAME
+    reqs = "--requirement={}".format(tmp_path / "reqs.txt")
+    install_call = call(
+        [
+            "pip3",
+            "install",
+            "--target={}".format(envpath),
+            "--no-index",
+            "--find-links={}".format(wheelhouse),
+            reqs,
+        ]
+    )
+
+    calls = _build_dependencies_wheelhouse(tmp_path)
+    assert calls == [
+        call(["pip3", "--version"]),
+        call(
+            [
+                "pip3",
+                "wheel",
+                "--wheel-dir={}".format(wheelhouse),
+                "--find-links={}".format(wheelhouse),
+                reqs,
+            ]
+        ),
+        install_call,
+    ]
+    stamp = json.loads((wheelhouse / charm_builder.WHEELHOUSE_STAMP_FILENAME).read_text())
+    assert len(stamp["ready"]) == 1
+
+    # the second time the wheelhouse has all that is needed
+    calls = _build_dependencies_wheelhouse(tmp_path)
+    assert calls == [call(["pip3", "--version"]), install_call]
+
+
+def test_build_dependencies_wheelhouse_error(tmp_path):
+    """Problems getting the wheels are reported."""
+    with pytest.raises(CommandError) as raised:
+        _build_dependencies_wheelhouse(tmp_path, pip_retcode=1)
+    assert str(raised.value) == "problems getting the dependencies into the wheelhouse"
+    assert not (tmp_path / "wheels" / charm_builder.WHEELHOUSE_STAMP_FILENAME).exists()
+
+
+def _build_dependencies_lock(
+    tmp_path, relock=False, download_retcode=0, downloaded=None, allow_pip_binary=None
+):
+    """Install the dependencies using a lock file, faking pip; return the pip calls."""
+    build_dir = tmp_path / BUILD_DIRNAME
+    build_dir.mkdir(exist_ok=True)
+    if not (tmp_path / "reqs.txt").exists():
+        (tmp_path / "reqs.txt").write_text("ops")
+
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=pathlib.Path("whatever"),
+        requirements=[str(tmp_path / "reqs.txt")],
+        lock_dir=tmp_path / "locks",
+        relock=relock,
+        allow_pip_binary=allow_pip_binary,
+    )
+
+    if downloaded is None:
+        downloaded = {"ops-1.2.0-py3-none-any.whl": b"ops", "PyYAML-5.4.1.tar.gz": b"yaml"}
+
+    def fake_pip(cmd):
+        if cmd[1] == "download":
+            dest = pathlib.Path(cmd[2].split("=", 1)[1])
+            for name, content in downloaded.items():
+                (dest / name).write_bytes(content)
+            return download_retcode
+        return 0
+
+    os_platform = OSPlatform(system="ubuntu", release="20.04", machine="x86_64")
+    with patch("charmcraft.charm_builder.get_os_platform", return_value=os_platform):
+        with patch("charmcraft.charm_builder.get_host_architecture", return_value="amd64"):
+            with patch("charmcraft.charm_builder._process_run", side_effect=fake_pip) as mock:
+                builder.handle_dependencies()
+    return mock.mock_calls
+
+
+def _lock_install_call(tmp_path, find_links=None, extra_args=()):
+    """Build the call to install the dependencies from the lock file."""
+    cmd = ["pip3", "install", "--target={}".format(tmp_path / BUILD_DIRNAME / VENV_DIRNAME)]
+    if find_links is not None:
+        cmd.append("--find-links={}".format(find_links))
+    cmd.extend(extra_args)
+    cmd.extend(
+        [
+            "--no-deps",
+            "--require-hashes",
+            "--requirement={}".format(tmp_path / "locks" / "requirements-ubuntu-20.04-amd64.lock"),
+        ]
+    )
+    return call(cmd)
+
+
+def test_build_dependencies_lock_created(tmp_path):
+    """The requirements are resolved into the lock file, and installed from it."""
+    calls = _build_dependencies_lock(tmp_path)
+
+    reqs = "--requirement={}".format(tmp_path / "reqs.txt")
+    _, (download_cmd,), _ = calls[1]
+    assert download_cmd[:2] == ["pip3", "download"]
+    assert download_cmd[3:] == [reqs]
+    downloads_dir = download_cmd[2].split("=", 1)[1]
+    assert calls == [
+        call(["pip3", "--version"]),
+        call(["pip3", "download", "--dest={}".format(downloads_dir), reqs]),
+        _lock_install_call(tmp_path, find_links=downloads_dir),
+    ]
+    assert not pathlib.Path(downloads_dir).exists()
+
+    lock_lines = (tmp_path / "locks" / "requirements-ubuntu-20.04-amd64.lock").read_text()
+    header, *requirements = lock_lines.splitlines()
+    assert header.startswith("# Generated by charmcraft, do not edit; inputs: ")
+    assert requirements == [
+        "ops==1.2.0 --hash=sha256:{}".format(hashlib.sha256(b"ops").hexdigest()),
+        "pyyaml==5.4.1 --hash=sha256:{}".format(hashlib.sha256(b"yaml").hexdigest()),
+    ]
+
+
+def test_build_dependencies_lock_created_sdists_only(tmp_path):
+    """The index is still used when installing just resolved sdists, for their build needs."""
+    calls = _build_dependencies_lock(
+        tmp_path, downloaded={"PyYAML-5.4.1.tar.gz": b"yaml", "ops-1.2.0.tar.gz": b"ops"}
+    )
+
+    _, (download_cmd,), _ = calls[1]
+    downloads_dir = download_cmd[2].split("=", 1)[1]
+    _, (install_cmd,), _ = calls[2]
+    assert "--no-index" not in install_cmd
+    assert calls[2] == _lock_install_call(tmp_path, find_links=downloads_dir)
+
+    lock_lines = (tmp_path / "locks" / "requirements-ubuntu-20.04-amd64.lock").read_text()
+    assert lock_lines.splitlines()[1:] == [
+        "ops==1.2.0 --hash=sha256:{}".format(hashlib.sha256(b"ops").hexdigest()),
+        "pyyaml==5.4.1 --hash=sha256:{}".format(hashlib.sha256(b"yaml").hexdigest()),
+    ]
+
+
+def test_build_dependencies_lock_created_no_binary(tmp_path):
+    """The binary policy is respected when installing just resolved distributions."""
+    calls = _build_dependencies_lock(
+        tmp_path, allow_pip_binary=False, downloaded={"PyYAML-5.4.1.tar.gz": b"yaml"}
+    )
+    _, (download_cmd,), _ = calls[1]
+    downloads_dir = download_cmd[2].split("=", 1)[1]
+    assert calls[2] == _lock_install_call(
+        tmp_path, find_links=downloads_dir, extra_args=["--no-binary=:all:"]
+    )
+
+
+def test_build_dependencies_lock_current(tmp_path):
+    """A current lock file is used without resolving the requirements again."""
+    _build_dependencies_lock(tmp_path)
+    calls = _build_dependencies_lock(tmp_path)
+    assert calls == [call(["pip3", "--version"]), _lock_install_call(tmp_path)]
+
+
+@pytest.mark.parametrize("relock", [False, True])
+def test_build_dependencies_lock_outdated(tmp_path, relock):
+    """The requirements are resolved again if they changed, or if indicated."""
+    _build_dependencies_lock(tmp_path)
+    if not relock:
+        (tmp_path / "reqs.txt").write_text("ops\npyyaml")
+    calls = _build_dependencies_lock(tmp_path, relock=relock)
+    assert [cmd[:2] for _, (cmd,), _ in calls] == [
+        ["pip3", "--version"],
+        ["pip3", "download"],
+        ["pip3", "install"],
+    ]
+
+
+def test_build_dependencies_lock_error(tmp_path):
+    """Problems resolving the requirements are reported."""
+    with pytest.raises(CommandError) as raised:
+        _build_dependencies_lock(tmp_path, download_retcode=1)
+    assert str(raised.value) == "problems resolving dependencies"
+    assert not (tmp_path / "locks").exists()
+
+
+def test_build_dependencies_packages_and_source_policy(tmp_path):
+    """Extra packages are installed, and all is built from source if binaries not allowed."""
+    build_dir = tmp_path / BUILD_DIRNAME
+    build_dir.mkdir()
+
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=pathlib.Path("whatever"),
+        python_packages=["ops", "pyyaml==5.4"],
+        allow_pip_binary=False,
+    )
+    with patch("charmcraft.charm_builder.subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 1
+        with patch("charmcraft.charm_builder._process_run") as mock:
+            mock.return_value = 0
+            builder.handle_dependencies()
+
+    envpath = build_dir / VENV_DIRNAME
+    assert mock.mock_calls == [
+        call(["pip3", "--version"]),
+        call(
+            [
+                "pip3",
+                "install",
+                "--target={}".format(envpath),
+                "--no-binary=:all:",
+                "ops",
+                "pyyaml==5.4",
+            ]
+        ),
+    ]
+
+
+def _build_dependencies_wheels(tmp_path, downloaded, cached=(), build_retcode=0):
+    """Install the dependencies building the wheels, faking pip; return the pip calls."""
+    build_dir = tmp_path / BUILD_DIRNAME
+    build_dir.mkdir()
+    cache_dir = tmp_path / "cache"
+
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=pathlib.Path("whatever"),
+        python_packages=["mypkg"],
+        allow_pip_binary=False,
+        cache_dir=cache_dir,
+        wheels_cache=True,
+    )
+
+    def fake_pip(cmd):
+        if cmd[1] == "download":
+            dest = pathlib.Path(cmd[2].split("=", 1)[1])
+            for name in downloaded:
+                (dest / name).touch()
+        if cmd[1] == "wheel":
+            return build_retcode
+        return 0
+
+    with patch("charmcraft.charm_builder.subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 1
+        mock_run.return_value.stdout = (
+            "pip 20.0.2 from /usr/lib/python3/dist-packages/pip (python 3.8)\n"
+        )
+        for name in cached:
+            builder.wheels_cache_path.mkdir(parents=True, exist_ok=True)
+            (builder.wheels_cache_path / name).touch()
+        with patch("charmcraft.charm_builder._process_run", side_effect=fake_pip) as mock:
+            with patch.object(builder, "_venv_to_cache"):
+                builder.handle_dependencies()
+        wheels_path = builder.wheels_cache_path
+    return mock.mock_calls, wheels_path
+
+
+def test_build_dependencies_wheels_built(tmp_path):
+    """The downloaded sdists are built into wheels in the cache, and installed offline."""
+    calls, wheels_path = _build_dependencies_wheels(
+        tmp_path,
+        downloaded=["My.Pkg-1.0.tar.gz", "other-2.1.zip", "binary-3.0-py3-none-any.whl"],
+        cached=["my_pkg-0.9-cp38-cp38-linux_x86_64.whl", "other-2.1-py3-none-any.whl"],
+    )
+
+    download_call, wheel_call, install_call = calls[1:]
+    (downloads_arg,) = [arg for arg in download_call[1][0] if arg.startswith("--dest=")]
+    downloads_dir = downloads_arg.split("=", 1)[1]
+    assert download_call == call(["pip3", "download", downloads_arg, "--no-binary=:all:", "mypkg"])
+    # only what is not in the cache is built
+    assert wheel_call == call(
+        [
+            "pip3",
+            "wheel",
+            "--no-deps",
+            "--wheel-dir={}".format(wheels_path),
+            str(pathlib.Path(downloads_dir) / "My.Pkg-1.0.tar.gz"),
+        ]
+    )
+    # the wheels built from source are used, so no need to ask for it
+    assert install_call == call(
+        [
+            "pip3",
+            "install",
+            "--target={}".format(tmp_path / BUILD_DIRNAME / VENV_DIRNAME),
+            "--no-index",
+            "--find-links={}".format(wheels_path),
+            "--find-links={}".format(downloads_dir),
+            "mypkg",
+        ]
+    )
+    assert not pathlib.Path(downloads_dir).exists()
+
+
+def test_build_dependencies_wheels_parallel(tmp_path):
+    """The wheels are built concurrently."""
+    with patch("os.cpu_count", return_value=3):
+        with patch("concurrent.futures.ThreadPoolExecutor", wraps=ThreadPoolExecutor) as mock:
+            calls, _ = _build_dependencies_wheels(
+                tmp_path, downloaded=["a-1.tar.gz", "b-1.tar.gz", "c-1.tar.bz2", "d-1.zip"]
+            )
+    mock.assert_called_once_with(max_workers=3)
+    assert [c[1][0][1] for c in calls] == ["--version", "download"] + ["wheel"] * 4 + ["install"]
+
+
+def test_build_dependencies_wheels_error(tmp_path):
+    """Problems building a wheel are reported."""
+    with pytest.raises(CommandError) as raised:
+        _build_dependencies_wheels(
+            tmp_path, downloaded=["a-1.tar.gz", "b-1.tar.gz"], build_retcode=1
+        )
+    assert str(raised.value) == "problems building the wheel for 'a-1.tar.gz'"
+
+
+def test_build_dependencies_wheels_not_requested(tmp_path):
+    """Without the wheels cache the dependencies are installed with a single pip call."""
+    build_dir = tmp_path / BUILD_DIRNAME
+    build_dir.mkdir()
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=pathlib.Path("whatever"),
+        python_packages=["mypkg"],
+        allow_pip_binary=False,
+        cache_dir=tmp_path / "cache",
+    )
+    with patch("charmcraft.charm_builder._process_run", return_value=0) as mock:
+        builder.handle_dependencies()
+    assert mock.mock_calls == [
+        call(["pip3", "--version"]),
+        call(
+            [
+                "pip3",
+                "install",
+                "--target={}".format(build_dir / VENV_DIRNAME),
+                "--no-binary=:all:",
+                "mypkg",
+            ]
+        ),
+    ]
+
+
+def test_build_dependencies_distribution_names():
+    """The name and version is got from the distribution file names."""
+    assert charm_builder._sdist_name_version("PyYAML-5.4.1.tar.gz") == ("pyyaml", "5.4.1")
+    assert charm_builder._sdist_name_version("zope.interface-5.0.zip") == (
+        "zope_interface",
+        "5.0",
+    )
+    assert charm_builder._sdist_name_version("my-pkg-1.0.tar.bz2") == ("my_pkg", "1.0")
+    assert charm_builder._sdist_name_version("ops-1.2-py3-none-any.whl") is None
+    assert charm_builder._wheel_name_version("PyYAML-5.4.1-cp38-cp38-linux_x86_64.whl") == (
+        "pyyaml",
+        "5.4.1",
+    )
+
+
+def _compile_bytecode(build_dir):
+    """Compile the bytecode of the tree in build_dir, return the pyc files content."""
+    (build_dir / "src").mkdir(parents=True)
+    (build_dir / "src" / "charm.py").write_text("import foo\n")
+    (build_dir / "lib").mkdir()
+    (build_dir / "lib" / "foo.py").write_text("def bar(): pass\n")
+    (build_dir / "lib" / "py2.py").write_text("print 'old stuff'\n")
+
+    builder = CharmBuilder(
+        charmdir=build_dir,
+        builddir=build_dir,
+        entrypoint=build_dir / "src" / "charm.py",
+        compile_bytecode=True,
+    )
+    builder.handle_bytecode()
+
+    return {
+        str(path.relative_to(build_dir)): path.read_bytes() for path in build_dir.glob("**/*.pyc")
+    }
+
+
+def test_build_bytecode(tmp_path):
+    """The bytecode is compiled hash-based and reproducible, not failing on bad files."""
+    compiled1 = _compile_bytecode(tmp_path / "build1")
+    compiled2 = _compile_bytecode(tmp_path / "build2")
+
+    # compiled by the system's python3, which may not be the one running the tests
+    names = sorted(re.sub(r"\.[^.]+\.pyc$", ".pyc", name) for name in compiled1)
+    assert names == ["lib/__pycache__/foo.pyc", "src/__pycache__/charm.pyc"]
+    assert compiled1 == compiled2
+    for content in compiled1.values():
+        # flags in the header: hash-based and checked
+        assert int.from_bytes(content[4:8], "little") == 0b11
+
+
+def test_build_bytecode_error(tmp_path):
+    """Problems compiling the bytecode are reported."""
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=tmp_path,
+        entrypoint=tmp_path / "charm.py",
+        compile_bytecode=True,
+    )
+    with patch("charmcraft.charm_builder._process_run", return_value=1) as mock:
+        with pytest.raises(CommandError) as raised:
+            builder.handle_bytecode()
+    assert str(raised.value) == "problems compiling the bytecode"
+    assert mock.mock_calls == [
+        call(["python3", "-c", charm_builder.COMPILE_BYTECODE_SCRIPT, str(tmp_path)])
+    ]
+
+
+@pytest.fixture
+def prunable_venv(tmp_path):
+    """A build dir with an installed venv with stuff not needed at runtime."""
+    build_dir = tmp_path / BUILD_DIRNAME
+    venv_dir = build_dir / "venv"
+    for rel_path, size in [
+        ("foo/__init__.py", 10),
+        ("foo/__init__.pyi", 20),
+        ("foo/__pycache__/__init__.cpython-38.pyc", 30),
+        ("foo/_speedups.c", 40),
+        ("foo/_speedups.so", 50),
+        ("foo/tests/__init__.py", 60),
+        ("foo/tests/test_foo.py", 70),
+        ("foo/README.md", 80),
+        ("foo-1.0.dist-info/METADATA", 90),
+        ("foo-1.0.dist-info/RECORD", 100),
+        ("foo-1.0.dist-info/INSTALLER", 110),
+        ("bar/tests/__init__.py", 120),
+        ("bar/docs/index.rst", 130),
+        ("bar/test.py", 140),
+        ("baz/utils/tests/helpers.py", 150),
+        ("legacy.pyc", 160),
+    ]:
+        path = venv_dir / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * size)
+    return build_dir
+
+
+def _venv_files(build_dir):
+    """Return the relative paths of all the files in the venv."""
+    venv_dir = build_dir / "venv"
+    return sorted(
+        str(path.relative_to(venv_dir)) for path in venv_dir.glob("**/*") if not path.is_dir()
+    )
+
+
+def test_build_prune_default_patterns(tmp_path, prunable_venv, caplog):
+    """What is not needed at runtime is removed, reporting the sizes."""
+    caplog.set_level(logging.INFO, logger="charmcraft.charm_builder")
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=prunable_venv,
+        entrypoint=pathlib.Path("whatever"),
+        prune_venv=True,
+    )
+    builder.handle_prune()
+
+    assert _venv_files(prunable_venv) == [
+        "bar/docs/index.rst",
+        "bar/test.py",
+        "baz/utils/tests/helpers.py",
+        "foo-1.0.dist-info/METADATA",
+        "foo-1.0.dist-info/RECORD",
+        "foo/README.md",
+        "foo/__init__.py",
+        "foo/__init__.pyi",
+        "foo/_speedups.c",
+        "foo/_speedups.so",
+        "legacy.pyc",
+    ]
+    assert not (prunable_venv / "venv" / "foo" / "tests").exists()
+    assert "Pruned 5 files from the dependencies: 0.00 MiB to 0.00 MiB" in caplog.messages
+
+
+def test_build_prune_project_patterns(tmp_path, prunable_venv, caplog):
+    """The project can remove more stuff, and keep what would be removed by default."""
+    caplog.set_level(logging.INFO, logger="charmcraft.charm_builder")
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=prunable_venv,
+        entrypoint=pathlib.Path("whatever"),
+        prune_venv=True,
+        prune_patterns=["*.md", "docs/", "tests/", "*.pyi", "*.c", "!/bar/tests/"],
+    )
+    builder.handle_prune()
+
+    assert _venv_files(prunable_venv) == [
+        "bar/test.py",
+        "bar/tests/__init__.py",
+        "foo-1.0.dist-info/METADATA",
+        "foo-1.0.dist-info/RECORD",
+        "foo/__init__.py",
+        "foo/_speedups.so",
+        "legacy.pyc",
+    ]
+
+
+def test_build_prune_sizes(tmp_path, caplog):
+    """The sizes before and after pruning are reported."""
+    caplog.set_level(logging.INFO, logger="charmcraft.charm_builder")
+    venv_dir = tmp_path / BUILD_DIRNAME / "venv"
+    (venv_dir / "foo" / "tests").mkdir(parents=True)
+    (venv_dir / "foo" / "__init__.py").write_bytes(b"x" * 2 ** 20)
+    (venv_dir / "foo" / "tests" / "test_foo.py").write_bytes(b"x" * 2 ** 19)
+    (venv_dir / "foo" / "__pycache__").mkdir()
+    (venv_dir / "foo" / "__pycache__" / "__init__.cpython-38.pyc").write_bytes(b"x" * 2 ** 19)
+
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=tmp_path / BUILD_DIRNAME,
+        entrypoint=pathlib.Path("whatever"),
+        prune_venv=True,
+    )
+    builder.handle_prune()
+    assert "Pruned 2 files from the dependencies: 2.00 MiB to 1.00 MiB" in caplog.messages
+
+
+def test_build_prune_without_venv(tmp_path):
+    """Nothing is done if there are no dependencies installed."""
+    build_dir = tmp_path / BUILD_DIRNAME
+    build_dir.mkdir()
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=pathlib.Path("whatever"),
+        prune_venv=True,
+    )
+    builder.handle_prune()
+    assert list(build_dir.iterdir()) == []
+
+
+@pytest.fixture
+def shakeable_charm(tmp_path):
+    """A build dir with charm code and installed packages, some of them never imported."""
+    build_dir = tmp_path / BUILD_DIRNAME
+    for rel_path, content in [
+        ("src/charm.py", "import ops\nfrom helpers import stuff\nfrom charms.foo.v0 import foo\n"),
+        ("src/helpers/__init__.py", ""),
+        ("src/helpers/stuff.py", "from . import other\n"),
+        ("src/helpers/other.py", "import yaml\n"),
+        ("src/unused.py", "import unused\n"),
+        ("lib/charms/foo/v0/foo.py", "try:\n    import requests\nexcept ImportError:\n    pass\n"),
+        ("venv/ops/__init__.py", "from .main import main\n"),
+        ("venv/ops/main.py", "import os, sys\nimport ops.model\n"),
+        ("venv/yaml/__init__.py", "from ._yaml import *\n"),
+        ("venv/yaml/_yaml.cpython-38-x86_64-linux-gnu.so", "binary"),
+        ("venv/requests/__init__.py", "import urllib3\nfrom idna import decode\n"),
+        ("venv/urllib3/__init__.py", ""),
+        ("venv/idna.py", ""),
+        ("venv/unused/__init__.py", "import alsounused\n"),
+        ("venv/alsounused.py", ""),
+        ("venv/_cffi_backend.cpython-38-x86_64-linux-gnu.so", "binary"),
+        ("venv/plugins/__init__.py", ""),
+        ("venv/broken/__init__.py", "this is not python"),
+        ("venv/ops-1.2.dist-info/METADATA", ""),
+        ("venv/bin/script", ""),
+    ]:
+        path = build_dir / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    return build_dir
+
+
+def test_build_tree_shaking_report(tmp_path, shakeable_charm, caplog):
+    """The installed packages never imported are reported."""
+    caplog.set_level(logging.INFO, logger="charmcraft.charm_builder")
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=shakeable_charm,
+        entrypoint=pathlib.Path("whatever"),
+        tree_shaking="report",
+        keep_packages=["plugins"],
+    )
+    builder.handle_tree_shaking(shakeable_charm / "src" / "charm.py")
+
+    assert (
+        "Installed packages never imported by the charm (0.00 MiB): "
+        "_cffi_backend, alsounused, broken, unused" in caplog.messages
+    )
+    assert (shakeable_charm / "venv" / "unused").exists()
+
+
+def test_build_tree_shaking_remove(tmp_path, shakeable_charm, caplog):
+    """The installed packages never imported are removed."""
+    caplog.set_level(logging.INFO, logger="charmcraft.charm_builder")
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=shakeable_charm,
+        entrypoint=pathlib.Path("whatever"),
+        tree_shaking="remove",
+        keep_packages=["plugins", "_cffi_backend", "broken"],
+    )
+    builder.handle_tree_shaking(shakeable_charm / "src" / "charm.py")
+
+    assert (
+        "Removed installed packages never imported by the charm (0.00 MiB): alsounused, unused"
+        in caplog.messages
+    )
+    assert sorted(path.name for path in (shakeable_charm / "venv").iterdir()) == [
+        "_cffi_backend.cpython-38-x86_64-linux-gnu.so",
+        "bin",
+        "broken",
+        "idna.py",
+        "ops",
+        "ops-1.2.dist-info",
+        "plugins",
+        "requests",
+        "urllib3",
+        "yaml",
+    ]
+
+
+def test_build_tree_shaking_all_used(tmp_path, caplog):
+    """Nothing is reported if all the installed packages are imported."""
+    caplog.set_level(logging.INFO, logger="charmcraft.charm_builder")
+    build_dir = tmp_path / BUILD_DIRNAME
+    (build_dir / "venv" / "ops").mkdir(parents=True)
+    (build_dir / "venv" / "ops" / "__init__.py").touch()
+    (build_dir / "charm.py").write_text("from ops import main\n")
+
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=pathlib.Path("whatever"),
+        tree_shaking="remove",
+    )
+    builder.handle_tree_shaking(build_dir / "charm.py")
+    assert "All the installed packages are imported by the charm" in caplog.messages
+    assert (build_dir / "venv" / "ops" / "__init__.py").exists()
+
+
+@pytest.mark.parametrize(
+    "zipimport, has_lib, pypath",
+    [
+        ([], True, "lib:venv"),
+        (["venv"], True, "lib:venv:venv.zip"),
+        (["lib", "venv"], True, "lib:lib.zip:venv:venv.zip"),
+        (["lib", "venv"], False, "lib:venv:venv.zip"),
+    ],
+)
+def test_build_dispatcher_zipimport(tmp_path, zipimport, has_lib, pypath):
+    """The zipimport archives that will be in the charm are in the dispatch's PYTHONPATH."""
+    build_dir = tmp_path / BUILD_DIRNAME
+    build_dir.mkdir()
+    if has_lib:
+        (build_dir / "lib").mkdir()
+
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=pathlib.Path("whatever"),
+        requirements=["reqs.txt"],
+        zipimport=zipimport,
+    )
+    builder.handle_dispatcher(build_dir / "src" / "charm.py")
+
+    dispatch = (build_dir / DISPATCH_FILENAME).read_text()
+    assert dispatch == DISPATCH_CONTENT.format(
+        pypath=pypath, entrypoint_relative_path="src/charm.py"
+    )
+
+
+def _build_fast_dispatcher(tmp_path, charm_code, shebang="#!/usr/bin/env python3", skip_site=True):
+    """Build the fast dispatcher for a charm with the given code, and return its content."""
+    build_dir = tmp_path / BUILD_DIRNAME
+    for rel_path, content in [
+        ("src/charm.py", "{}\n{}".format(shebang, charm_code)),
+        ("src/helpers.py", "import json\n"),
+        ("lib/charms/foo/v0/foo.py", "import ops\n"),
+        ("venv/ops/__init__.py", "import yaml\n"),
+        ("venv/yaml/__init__.py", ""),
+    ]:
+        path = build_dir / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=pathlib.Path("whatever"),
+        dispatch_mode="fast",
+        dispatch_skip_site=skip_site,
+    )
+    builder.handle_dispatcher(build_dir / "src" / "charm.py")
+    return (build_dir / DISPATCH_FILENAME).read_text()
+
+
+def _fast_dispatch(python):
+    """Return the content of the fast dispatch running the entrypoint with that python."""
+    return charm_builder.DISPATCH_FAST_CONTENT.format(
+        pypath="lib:venv", python=python, entrypoint="src/charm.py"
+    )
+
+
+def test_build_dispatcher_fast_skip_site(tmp_path):
+    """The fast dispatch execs the interpreter skipping the site initialisation."""
+    charm_code = (
+        "import logging\n"
+        "from charms.foo.v0 import foo\n"
+        "from ops.main import main\n"
+        "from .helpers import something\n"
+        "import helpers\n"
+    )
+    dispatch = _build_fast_dispatcher(tmp_path, charm_code)
+    assert dispatch == _fast_dispatch("python3 -S")
+
+
+def test_build_dispatcher_fast_keep_site(tmp_path):
+    """The fast dispatch keeps the site initialisation unless told otherwise."""
+    dispatch = _build_fast_dispatcher(tmp_path, "import ops\n", skip_site=False)
+    assert dispatch == _fast_dispatch("python3")
+
+
+def test_build_dispatcher_fast_external_imports(tmp_path, caplog):
+    """The site initialisation is not skipped if the charm imports modules from the system."""
+    caplog.set_level(logging.INFO, logger="charmcraft.charm_builder")
+    charm_code = "import apt\nimport ops\n"
+    dispatch = _build_fast_dispatcher(tmp_path, charm_code)
+    assert dispatch == _fast_dispatch("python3")
+    assert (
+        "Not skipping the site initialisation in the dispatch, the charm imports "
+        "modules it doesn't include: apt"
+    ) in caplog.messages
+
+
+@pytest.mark.parametrize(
+    "shebang, python",
+    [
+        ("#!/usr/bin/python3.8", "/usr/bin/python3.8 -S"),
+        ("#!/usr/bin/env -S python3 -u", "python3 -u -S"),
+        ("#!/usr/bin/python3 -S", "/usr/bin/python3 -S"),
+        ("#!/bin/bash", "python3 -S"),
+        ("", "python3 -S"),
+    ],
+)
+def test_build_dispatcher_fast_interpreter(tmp_path, shebang, python):
+    """The fast dispatch uses the interpreter from the entrypoint's shebang."""
+    dispatch = _build_fast_dispatcher(tmp_path, "import ops\n", shebang=shebang)
+    assert dispatch == _fast_dispatch(python)
+
+
+@pytest.fixture
+def zipimport_venv(tmp_path):
+    """A build dir with an installed venv with all kinds of stuff in it."""
+    build_dir = tmp_path / BUILD_DIRNAME
+    venv_dir = build_dir / "venv"
+    for rel_path, content in [
+        ("purepkg/__init__.py", "VALUE = 'pure'\n"),
+        ("purepkg/sub/__init__.py", ""),
+        ("purepkg/sub/mod.py", "from purepkg import VALUE\n"),
+        ("purepkg/py.typed", ""),
+        ("toplevel.py", "VALUE = 'toplevel'\n"),
+        ("nspkg/part/__init__.py", "VALUE = 'namespace'\n"),
+        ("extpkg/__init__.py", ""),
+        ("extpkg/_speedups.so", "binary stuff"),
+        ("datapkg/__init__.py", ""),
+        ("datapkg/schema.json", "{}"),
+        ("purepkg-1.0.dist-info/METADATA", "Name: purepkg\n"),
+        ("bin/script", "#!/bin/sh\n"),
+        ("stuff.pth", "import something\n"),
+    ]:
+        path = venv_dir / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    (venv_dir / "linkedpkg").mkdir()
+    (venv_dir / "linkedpkg" / "__init__.py").symlink_to(venv_dir / "toplevel.py")
+
+    # bytecode as installed by pip
+    for rel_path in ["purepkg/sub/mod.py", "toplevel.py"]:
+        path = venv_dir / rel_path
+        py_compile.compile(str(path), cfile=importlib.util.cache_from_source(str(path)))
+    return build_dir
+
+
+def test_build_zipimport_venv(tmp_path, zipimport_venv):
+    """Only what can be imported from a zipimport archive is moved to it."""
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=zipimport_venv,
+        entrypoint=pathlib.Path("whatever"),
+        requirements=["reqs.txt"],
+        zipimport=["venv"],
+    )
+    builder.handle_zipimport()
+
+    with zipfile.ZipFile(str(zipimport_venv / "venv.zip")) as zf:
+        names = zf.namelist()
+    assert names == [
+        "nspkg/",
+        "nspkg/part/",
+        "nspkg/part/__init__.py",
+        "purepkg/",
+        "purepkg/__init__.py",
+        "purepkg/py.typed",
+        "purepkg/sub/",
+        "purepkg/sub/__init__.py",
+        "purepkg/sub/mod.py",
+        "purepkg/sub/mod.pyc",
+        "toplevel.py",
+        "toplevel.pyc",
+    ]
+
+    venv_dir = zipimport_venv / "venv"
+    remaining = sorted(
+        str(path.relative_to(venv_dir)) for path in venv_dir.glob("**/*") if not path.is_dir()
+    )
+    assert remaining == [
+        "bin/script",
+        "datapkg/__init__.py",
+        "datapkg/schema.json",
+        "extpkg/__init__.py",
+        "extpkg/_speedups.so",
+        "linkedpkg/__init__.py",
+        "purepkg-1.0.dist-info/METADATA",
+        "stuff.pth",
+    ]
+
+    # the packed code can be imported, using the bytecode
+    cmd = [
+        sys.executable,
+        "-c",
+        "import purepkg.sub.mod, toplevel, nspkg.part; "
+        "print(purepkg.sub.mod.VALUE, toplevel.VALUE, nspkg.part.VALUE)",
+    ]
+    env = dict(os.environ, PYTHONPATH=str(zipimport_venv / "venv.zip"))
+    proc = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, check=True)
+    assert proc.stdout.decode() == "pure toplevel namespace\n"
+
+
+def test_build_zipimport_missing_dirs(tmp_path):
+    """Nothing is packed if the directories will not be in the charm."""
+    build_dir = tmp_path / BUILD_DIRNAME
+    build_dir.mkdir()
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=pathlib.Path("whatever"),
+        zipimport=["venv", "lib"],
+    )
+    builder.handle_zipimport()
+    assert list(build_dir.iterdir()) == []
+
+
+def test_build_zipimport_compressed(tmp_path):
+    """The zipimport archives are compressed, as the charm stores them as they are."""
+    build_dir = tmp_path / BUILD_DIRNAME
+    (build_dir / "venv").mkdir(parents=True)
+    module = "".join("VALUE_{0} = {0!r}\n".format(idx) for idx in range(5000))
+    (build_dir / "venv" / "bigmodule.py").write_text(module)
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=pathlib.Path("whatever"),
+        requirements=["reqs.txt"],
+        zipimport=["venv"],
+    )
+    builder.handle_zipimport()
+
+    charm_path = tmp_path / "crazycharm.charm"
+    build_zip(charm_path, build_dir)
+    with zipfile.ZipFile(str(charm_path)) as zf:
+        info = zf.getinfo("venv.zip")
+        inner_venv = zf.read("venv.zip")
+    assert info.compress_type == zipfile.ZIP_STORED
+    assert info.compress_size < len(module) / 2
+    with zipfile.ZipFile(io.BytesIO(inner_venv)) as zf:
+        assert zf.getinfo("bigmodule.py").compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_build_zipimport_project_dispatch(tmp_path, caplog):
+    """Nothing is packed if the project provides its own dispatch, as it would not find it."""
+    caplog.set_level(logging.WARNING, logger="charmcraft.charm_builder")
+    charm_dir = tmp_path / "charm"
+    for rel_path, content in [
+        (CHARM_METADATA, "name: crazycharm\n"),
+        ("src/charm.py", "import mylib\n"),
+        ("lib/mylib.py", "VALUE = 42\n"),
+        (DISPATCH_FILENAME, "#!/bin/sh\nPYTHONPATH=lib:venv ./src/charm.py\n"),
+    ]:
+        path = charm_dir / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    build_dir = tmp_path / BUILD_DIRNAME
+
+    builder = CharmBuilder(
+        charmdir=charm_dir,
+        builddir=build_dir,
+        entrypoint=charm_dir / "src" / "charm.py",
+        zipimport=["lib"],
+    )
+    builder.build_charm()
+
+    assert builder.project_dispatch
+    assert (build_dir / "lib" / "mylib.py").exists()
+    assert not (build_dir / "lib.zip").exists()
+    assert caplog.messages == [
+        "Not packing 'lib' in zipimport archives, the project's dispatch would not find them"
+    ]
+
+
+def _touch_tree(path, mtime, mode):
+    """Set the modification time and permissions (if not executable) of all the files."""
+    for filepath in sorted(path.glob("**/*")):
+        if filepath.is_file():
+            if not filepath.stat().st_mode & 0o100:
+                filepath.chmod(mode)
+            os.utime(str(filepath), (mtime, mtime))
+
+
+def _build_reproducible(basedir, mtime, mode):
+    """Build and pack a charm with dependencies reproducibly; return the charm path."""
+    charm_dir = basedir / "charm"
+    for rel_path, content in [
+        (CHARM_METADATA, "name: crazycharm\n"),
+        ("requirements.txt", "ops\n"),
+        ("src/charm.py", "#!/usr/bin/env python3\nimport ops\n"),
+        ("lib/charms/foo/v0/foo.py", "import ops\n"),
+    ]:
+        path = charm_dir / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    (charm_dir / "src" / "charm.py").chmod(0o755)
+    _touch_tree(charm_dir, mtime, mode)
+    build_dir = basedir / BUILD_DIRNAME
+    process_run = charm_builder._process_run
+
+    def fake_pip(cmd, **kwargs):
+        assert kwargs["env"]["SOURCE_DATE_EPOCH"] == "315532800"
+        if cmd[:2] == ["python3", "-c"]:
+            # compile the bytecode for real
+            return process_run(cmd, **kwargs)
+        if cmd[1] == "install":
+            assert "--no-compile" in cmd
+            venv_dir = build_dir / VENV_DIRNAME
+            for rel_path, content in [
+                ("ops/__init__.py", "from ops import main\n"),
+                ("ops/main.py", "def main(): pass\n"),
+                ("ops-1.0.dist-info/METADATA", "Name: ops\n"),
+            ]:
+                path = venv_dir / rel_path
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(content)
+            _touch_tree(venv_dir, mtime, mode)
+        return 0
+
+    builder = CharmBuilder(
+        charmdir=charm_dir,
+        builddir=build_dir,
+        entrypoint=charm_dir / "src" / "charm.py",
+        requirements=[str(charm_dir / "requirements.txt")],
+        compile_bytecode=True,
+        zipimport=["lib", "venv"],
+        source_date_epoch=315532800,
+    )
+    with patch("charmcraft.charm_builder.subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 1
+        with patch("charmcraft.charm_builder._process_run", side_effect=fake_pip):
+            builder.build_charm()
+
+    charm_path = basedir / "crazycharm.charm"
+    build_zip(charm_path, build_dir, timestamp=MIN_TIMESTAMP)
+    return charm_path
+
+
+def test_build_reproducible(tmp_path):
+    """Building the same charm twice reproducibly gives the same bytes, inner archives too."""
+    charm1 = _build_reproducible(tmp_path / "first", 1600000000, 0o644)
+    charm2 = _build_reproducible(tmp_path / "second", 1700000000, 0o600)
+
+    with zipfile.ZipFile(str(charm1)) as zf:
+        names = zf.namelist()
+        inner_venv = zf.read("venv.zip")
+    assert "lib.zip" in names
+    with zipfile.ZipFile(io.BytesIO(inner_venv)) as zf:
+        infos = zf.infolist()
+    assert [info.filename for info in infos][:3] == ["ops/", "ops/__init__.py", "ops/__init__.pyc"]
+    assert {info.date_time for info in infos} == {(1980, 1, 1, 0, 0, 0)}
+    assert {info.external_attr >> 16 for info in infos} == {0o40755, 0o100644}
+
+    assert charm1.read_bytes() == charm2.read_bytes()
+
+
+def test_build_reproducible_zipimport_date(tmp_path, zipimport_venv):
+    """The zipimport archives members get the given date, not before the zip format limit."""
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=zipimport_venv,
+        entrypoint=pathlib.Path("whatever"),
+        requirements=["reqs.txt"],
+        zipimport=["venv"],
+        source_date_epoch=0,
+    )
+    builder.handle_zipimport()
+    with zipfile.ZipFile(str(zipimport_venv / "venv.zip")) as zf:
+        assert {info.date_time for info in zf.infolist()} == {(1980, 1, 1, 0, 0, 0)}
+
+
 def test_builder_without_jujuignore(tmp_path):
     """Without a .jujuignore we still have a default set of ignores"""
     metadata = tmp_path / CHARM_METADATA
@@ -788,6 +2138,54 @@ def test_builder_with_jujuignore(tmp_path):
     assert not ignore.match("myfile.c", is_dir=False)
 
 
+def test_builder_jujuignore_cached(tmp_path):
+    """The translated ignore rules are cached if a cache dir is given."""
+    metadata = tmp_path / CHARM_METADATA
+    metadata.write_text("name: crazycharm")
+    (tmp_path / ".jujuignore").write_text("*.py\n")
+    build_dir = tmp_path / BUILD_DIRNAME
+    build_dir.mkdir()
+    cache_dir = tmp_path / "cache"
+
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=pathlib.Path("whatever"),
+        cache_dir=cache_dir,
+    )
+    assert builder.ignore_rules.match("myfile.py", is_dir=False)
+    # one for the default rules, other for the project's ones
+    assert len(list((cache_dir / charm_builder.IGNORE_CACHE_DIRNAME).iterdir())) == 2
+
+
+def test_builder_explain_ignores(tmp_path, caplog):
+    """The ignore rules stats are reported after linking the files."""
+    caplog.set_level(logging.INFO)
+    metadata = tmp_path / CHARM_METADATA
+    metadata.write_text("name: crazycharm")
+    (tmp_path / ".jujuignore").write_text("*.txt\n")
+    (tmp_path / "foo.txt").touch()
+    build_dir = tmp_path / BUILD_DIRNAME
+    build_dir.mkdir()
+    entrypoint = tmp_path / "crazycharm.py"
+    entrypoint.touch()
+
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=build_dir,
+        entrypoint=entrypoint,
+        explain_ignores=True,
+    )
+    builder.handle_generic_paths()
+    builder.show_ignores_report()
+
+    assert not (build_dir / "foo.txt").exists()
+    messages = [r.message for r in caplog.records]
+    assert messages[0] == "Ignore rules, by time spent matching:"
+    assert len(messages) == 10  # header and the rules
+    assert any(msg.startswith("- line 1 '*.txt': 5 evaluations, 1 matches, ") for msg in messages)
+
+
 def test_builder_arguments_defaults(tmp_path):
     """The arguments passed to the cli must be correctly parsed."""
 
@@ -796,6 +2194,26 @@ def test_builder_arguments_defaults(tmp_path):
         assert self.buildpath == pathlib.Path("builddir")
         assert self.entrypoint == pathlib.Path("src/charm.py")
         assert self.requirement_paths is None
+        assert self.explain_ignores is False
+        assert self.cache_dir is None
+        assert self.link_workers == 1
+        assert self.venv_cache is False
+        assert self.wheels_cache is False
+        assert self.wheelhouse is None
+        assert self.python_packages is None
+        assert self.allow_pip_binary is True
+        assert self.compile_bytecode is False
+        assert self.zipimport == []
+        assert self.prune_venv is False
+        assert self.prune_patterns == []
+        assert self.tree_shaking is None
+        assert self.keep_packages == []
+        assert self.lock_dir is None
+        assert self.relock is False
+        assert self.dispatch_mode == "classic"
+        assert self.dispatch_skip_site is False
+        assert self.source_date_epoch is None
+        assert self.concurrent_dependencies is False
         sys.exit(42)
 
     with patch.object(sys, "argv", ["cmd", "--charmdir", "charmdir", "--builddir", "builddir"]):
@@ -805,14 +2223,35 @@ def test_builder_arguments_defaults(tmp_path):
         assert raised.value.code == 42
 
 
-def test_builder_arguments_full(tmp_path):
+def test_builder_arguments_full(tmp_path, monkeypatch):
     """The arguments passed to the cli must be correctly parsed."""
+    monkeypatch.chdir(tmp_path)
 
     def mock_build_charm(self):
         assert self.charmdir == pathlib.Path("charmdir")
         assert self.buildpath == pathlib.Path("builddir")
         assert self.entrypoint == pathlib.Path("src/charm.py")
         assert self.requirement_paths == ["reqs1.txt", "reqs2.txt"]
+        assert self.explain_ignores is True
+        assert self.cache_dir == pathlib.Path("cache")
+        assert self.link_workers == 8
+        assert self.venv_cache is True
+        assert self.wheels_cache is True
+        assert self.wheelhouse == pathlib.Path("wheels")
+        assert self.python_packages == ["ops", "pyyaml"]
+        assert self.allow_pip_binary is False
+        assert self.compile_bytecode is True
+        assert self.zipimport == ["venv", "lib"]
+        assert self.prune_venv is True
+        assert self.prune_patterns == ["*.md", "!foo/tests/"]
+        assert self.tree_shaking == "remove"
+        assert self.keep_packages == ["plugins"]
+        assert self.lock_dir == pathlib.Path("locks")
+        assert self.relock is True
+        assert self.dispatch_mode == "fast"
+        assert self.dispatch_skip_site is True
+        assert self.source_date_epoch == 315532800
+        assert self.concurrent_dependencies is True
         sys.exit(42)
 
     with patch.object(
@@ -827,9 +2266,239 @@ def test_builder_arguments_full(tmp_path):
             "-r" "reqs1.txt",
             "--requirement",
             "reqs2.txt",
+            "--explain-ignores",
+            "--cache-dir",
+            "cache",
+            "--link-workers",
+            "8",
+            "--venv-cache",
+            "--wheels-cache",
+            "--wheelhouse",
+            "wheels",
+            "-p",
+            "ops",
+            "--python-package",
+            "pyyaml",
+            "--disallow-pip-binary",
+            "--compile-bytecode",
+            "--zipimport",
+            "venv",
+            "--zipimport",
+            "lib",
+            "--prune-venv",
+            "--prune-pattern",
+            "*.md",
+            "--prune-pattern",
+            "!foo/tests/",
+            "--tree-shaking",
+            "remove",
+            "--keep-package",
+            "plugins",
+            "--lock-dir",
+            "locks",
+            "--relock",
+            "--dispatch-mode",
+            "fast",
+            "--dispatch-skip-site",
+            "--source-date-epoch",
+            "315532800",
+            "--concurrent-dependencies",
         ],
     ):
         with patch("charmcraft.charm_builder.CharmBuilder.build_charm", new=mock_build_charm):
             with pytest.raises(SystemExit) as raised:
                 charm_builder.main()
         assert raised.value.code == 42
+
+
+def test_builder_timings(tmp_path):
+    """How long each phase of the build took is kept, in order."""
+    (tmp_path / CHARM_METADATA).write_text("name: crazycharm")
+    entrypoint = tmp_path / "charm.py"
+    entrypoint.touch()
+    builder = CharmBuilder(
+        charmdir=tmp_path,
+        builddir=tmp_path / BUILD_DIRNAME,
+        entrypoint=entrypoint,
+        compile_bytecode=True,
+    )
+    with patch.object(CharmBuilder, "handle_bytecode"):
+        builder.build_charm()
+
+    assert list(builder.timings) == [
+        "setup",
+        "generic_paths",
+        "dependencies",
+        "dispatcher",
+        "bytecode",
+        "zipimport",
+    ]
+    assert all(secs >= 0 for secs in builder.timings.values())
+
+
+def test_build_in_process(tmp_path, monkeypatch):
+    """The charm is built in-process from the arguments, isolated for its subprocesses."""
+    monkeypatch.setenv("SOMETHING", "not for the builder")
+    monkeypatch.chdir(tmp_path)
+    work_dir = tmp_path / "workdir"
+    work_dir.mkdir()
+
+    def mock_build_charm(self):
+        assert self.charmdir == work_dir / "charmdir"
+        assert self.buildpath == pathlib.Path("/abs/builddir")
+        assert self.entrypoint == work_dir / "src" / "charm.py"
+        assert self.requirement_paths == [str(work_dir / "reqs.txt")]
+        assert self.tree_shaking == "report"
+        self.timings["setup"] = 1.5
+
+    arguments = [
+        "--charmdir",
+        "charmdir",
+        "--builddir",
+        "/abs/builddir",
+        "-r",
+        "reqs.txt",
+        "--tree-shaking",
+        "report",
+    ]
+    with patch("charmcraft.charm_builder.CharmBuilder.build_charm", new=mock_build_charm):
+        timings = charm_builder.build_in_process(arguments, {"PATH": "/some/path"}, work_dir)
+    assert timings == {"setup": 1.5}
+
+    # the process environment and working directory are never changed
+    assert os.environ["SOMETHING"] == "not for the builder"
+    assert pathlib.Path.cwd() == tmp_path
+
+
+def test_build_in_process_subprocesses(tmp_path, monkeypatch):
+    """The builder subprocesses get the given environment and work dir."""
+    monkeypatch.chdir(tmp_path)
+    work_dir = tmp_path / "workdir"
+    work_dir.mkdir()
+    environment = {"PATH": "/some/path"}
+
+    arguments = ["--charmdir", "charmdir", "--builddir", "builddir", "-p", "ops"]
+    with patch.object(CharmBuilder, "build_charm", new=CharmBuilder.handle_dependencies):
+        with patch("charmcraft.charm_builder.subprocess.run") as mock_run:
+            with patch("charmcraft.charm_builder._process_run", return_value=0) as mock:
+                charm_builder.build_in_process(arguments, environment, work_dir)
+
+    assert mock.mock_calls == [
+        call(["pip3", "--version"], env=environment, cwd=str(work_dir)),
+        call(
+            [
+                "pip3",
+                "install",
+                "--target={}".format(work_dir / "builddir" / VENV_DIRNAME),
+                "ops",
+            ],
+            env=environment,
+            cwd=str(work_dir),
+        ),
+    ]
+    mock_run.assert_called_once()
+    assert mock_run.call_args[1]["env"] == environment
+    assert mock_run.call_args[1]["cwd"] == str(work_dir)
+
+
+def test_build_in_process_error(tmp_path, monkeypatch):
+    """The process environment and working directory are untouched if the build fails."""
+    monkeypatch.setenv("SOMETHING", "not for the builder")
+    monkeypatch.chdir(tmp_path)
+    work_dir = tmp_path / "workdir"
+    work_dir.mkdir()
+
+    arguments = ["--charmdir", "charmdir", "--builddir", "builddir"]
+    with patch.object(CharmBuilder, "build_charm", side_effect=CommandError("boom")):
+        with pytest.raises(CommandError):
+            charm_builder.build_in_process(arguments, {}, work_dir)
+    assert os.environ["SOMETHING"] == "not for the builder"
+    assert pathlib.Path.cwd() == tmp_path
+
+
+def _concurrent_builder(tmp_path):
+    """Return a builder for a simple charm, installing its dependencies concurrently."""
+    charm_dir = tmp_path / "charm"
+    (charm_dir / "src").mkdir(parents=True)
+    (charm_dir / CHARM_METADATA).write_text("name: crazycharm")
+    entrypoint = charm_dir / "src" / "charm.py"
+    entrypoint.touch()
+    return CharmBuilder(
+        charmdir=charm_dir,
+        builddir=tmp_path / BUILD_DIRNAME,
+        entrypoint=entrypoint,
+        requirements=["reqs.txt"],
+        concurrent_dependencies=True,
+    )
+
+
+def test_build_concurrent_dependencies(tmp_path):
+    """The dependencies are installed in the background while the charm files are linked."""
+    builder = _concurrent_builder(tmp_path)
+    linking = threading.Event()
+
+    original_handle_generic_paths = CharmBuilder.handle_generic_paths
+
+    def fake_handle_generic_paths(self):
+        linking.set()
+        return original_handle_generic_paths(self)
+
+    def fake_handle_dependencies(self):
+        # only finishes if the charm files are linked meanwhile
+        assert threading.current_thread() is not threading.main_thread()
+        assert linking.wait(timeout=10)
+        (self.buildpath / "venv").mkdir()
+
+    with patch.object(CharmBuilder, "handle_generic_paths", fake_handle_generic_paths):
+        with patch.object(CharmBuilder, "handle_dependencies", fake_handle_dependencies):
+            builder.build_charm()
+
+    assert (builder.buildpath / "src" / "charm.py").exists()
+    assert (builder.buildpath / "venv").is_dir()
+    assert (builder.buildpath / DISPATCH_FILENAME).exists()
+    assert {"generic_paths", "dependencies"} <= builder.timings.keys()
+
+
+def test_build_concurrent_dependencies_project_venv(tmp_path):
+    """The dependencies are installed after linking if the project has its own venv."""
+    builder = _concurrent_builder(tmp_path)
+    (builder.charmdir / "venv").mkdir()
+
+    def fake_handle_dependencies(self):
+        assert threading.current_thread() is threading.main_thread()
+        assert (self.buildpath / "src" / "charm.py").exists()
+
+    with patch.object(CharmBuilder, "handle_dependencies", fake_handle_dependencies):
+        builder.build_charm()
+
+
+@pytest.mark.parametrize("failing", ["linking", "dependencies"])
+def test_build_concurrent_dependencies_error(tmp_path, failing):
+    """If only one side fails its error is raised as is."""
+    builder = _concurrent_builder(tmp_path)
+    error = CommandError("boom")
+    target = "handle_generic_paths" if failing == "linking" else "handle_dependencies"
+
+    with patch.object(CharmBuilder, "handle_dependencies"):
+        with patch.object(CharmBuilder, target, side_effect=error):
+            with pytest.raises(CommandError) as raised:
+                builder.build_charm()
+    assert raised.value is error
+
+
+def test_build_concurrent_dependencies_errors_merged(tmp_path):
+    """If both sides fail the errors are reported together."""
+    builder = _concurrent_builder(tmp_path)
+
+    with patch.object(CharmBuilder, "handle_generic_paths", side_effect=OSError("disk full")):
+        with patch.object(
+            CharmBuilder,
+            "handle_dependencies",
+            side_effect=CommandError("problems installing dependencies"),
+        ):
+            with pytest.raises(CommandError) as raised:
+                builder.build_charm()
+    assert str(raised.value) == (
+        "Problems building the charm: linking the charm files (disk full); "
+        "installing the dependencies (problems installing dependencies)"
+    )
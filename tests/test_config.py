@@ -62,6 +62,21 @@ def test_load_current_directory(create_config, monkeypatch):
     assert config.project.started_at == fake_utcnow
 
 
+def test_load_source_date_epoch_not_used(create_config, monkeypatch):
+    """SOURCE_DATE_EPOCH is not used (nor validated) when loading, but where it's needed."""
+    tmp_path = create_config(
+        """
+        type: charm
+    """
+    )
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "yesterday")
+    fake_utcnow = datetime.datetime(1970, 1, 1, 0, 0, 2, tzinfo=datetime.timezone.utc)
+    with patch("datetime.datetime") as mock:
+        mock.utcnow.return_value = fake_utcnow
+        config = load(tmp_path)
+    assert config.project.started_at == fake_utcnow
+
+
 def test_load_managed_mode_directory(create_config, monkeypatch, tmp_path):
     """Validate managed-mode default directory is /root/project."""
     monkeypatch.chdir(tmp_path)
@@ -1030,3 +1045,78 @@ def test_schema_analysis_ignore_linter_missing(
             - Bad lint name 'check_missing' in field 'analysis.ignore.linters[1]'"""
         )
     )
+
+
+# -- tests for packing
+
+
+def test_schema_packing_missing(create_config, tmp_path):
+    """No packing configuration leads to some defaults in place."""
+    create_config(
+        """
+        type: charm  # mandatory
+    """
+    )
+    config = load(tmp_path)
+    assert config.packing.compression_level == 6
+    assert "*.whl" in config.packing.store
+    assert config.packing.store_incompressible is True
+    assert config.packing.reproducible is False
+    assert config.packing.incremental is False
+
+
+def test_schema_packing_full(create_config, tmp_path):
+    """Complete packing structure."""
+    create_config(
+        """
+        type: charm  # mandatory
+        packing:
+            compression-level: 9
+            store: ["*.so", "data/*"]
+            store-incompressible: false
+            reproducible: true
+            incremental: true
+    """
+    )
+    config = load(tmp_path)
+    assert config.packing.compression_level == 9
+    assert config.packing.store == ["*.so", "data/*"]
+    assert config.packing.store_incompressible is False
+    assert config.packing.reproducible is True
+    assert config.packing.incremental is True
+
+
+def test_schema_packing_bad_level(create_config, check_schema_error):
+    """The compression level must be one that zlib supports."""
+    create_config(
+        """
+        type: charm  # mandatory
+        packing:
+            compression-level: 10
+    """
+    )
+    check_schema_error(
+        dedent(
+            """\
+            Bad charmcraft.yaml content:
+            - ensure this value is less than or equal to 9 in field 'packing.compression-level'"""
+        )
+    )
+
+
+def test_schema_packing_bad_store(create_config, check_schema_error):
+    """The patterns of the files to store must be strings."""
+    create_config(
+        """
+        type: charm  # mandatory
+        packing:
+            store: "*.so"
+    """
+    )
+    check_schema_error(
+        dedent(
+            """\
+            Bad charmcraft.yaml content:
+            - value is not a valid list in field 'packing.store'"""
+        )
+    )
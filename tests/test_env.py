@@ -14,6 +14,7 @@
 #
 # For further info, check https://github.com/canonical/charmcraft
 
+import datetime
 import pathlib
 import sys
 
@@ -112,6 +113,32 @@ def test_is_charmcraft_running_in_managed_mode(monkeypatch, managed, result):
     assert env.is_charmcraft_running_in_managed_mode() == result
 
 
+@pytest.mark.parametrize("value", [None, ""])
+def test_get_source_date_epoch_missing(monkeypatch, value):
+    if value is None:
+        monkeypatch.delenv("SOURCE_DATE_EPOCH", raising=False)
+    else:
+        monkeypatch.setenv("SOURCE_DATE_EPOCH", value)
+
+    assert env.get_source_date_epoch() is None
+
+
+def test_get_source_date_epoch_ok(monkeypatch):
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1600000000")
+
+    assert env.get_source_date_epoch() == datetime.datetime(2020, 9, 13, 12, 26, 40)
+
+
+def test_get_source_date_epoch_invalid(monkeypatch):
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "yesterday")
+
+    with pytest.raises(CommandError) as cm:
+        env.get_source_date_epoch()
+    assert str(cm.value) == (
+        "Invalid SOURCE_DATE_EPOCH 'yesterday', it must be a number of seconds since the epoch."
+    )
+
+
 @pytest.mark.parametrize(
     "as_snap",
     [False, True],
@@ -15,10 +15,15 @@
 # For further info, check https://github.com/canonical/charmcraft
 
 import io
+import json
+import logging
 import pathlib
 import subprocess
 import textwrap
 import tempfile
+from unittest.mock import patch
+
+import pytest
 
 from charmcraft import jujuignore
 
@@ -439,3 +444,317 @@ def test_extend_patterns():
     ignore.extend_patterns(["bar"])
     assert ignore.match("foo", is_dir=False)
     assert ignore.match("bar", is_dir=False)
+
+
+def _match_per_rule(ignore, path, is_dir):
+    """Check the path against each rule separately, as the original implementation did."""
+    if not path.startswith("/"):
+        path = "/" + path
+    keep = True
+    for matcher in ignore._matchers:
+        result = matcher.match(path, is_dir)
+        if result == jujuignore.SKIP:
+            keep = False
+        elif result == jujuignore.FORCEKEEP:
+            keep = True
+            break
+    return not keep
+
+
+def test_compiled_rules_same_as_per_rule():
+    ignore = jujuignore.JujuIgnore(jujuignore.default_juju_ignore)
+    ignore.extend_patterns(
+        [
+            "*.py[cod]",
+            "!keep.pyc",
+            "__pycache__/",
+            "!/src/__pycache__/",
+            "/venv/**/tests/",
+            "docs/*.md",
+            "!docs/README.md",
+            "foo?.txt",
+            "bar[!a].txt",
+            "apps/**/logs/",
+            r"\#notes",
+            "/top",
+        ]
+    )
+    paths = [
+        ".git",
+        "src/.git",
+        "build",
+        "src/build",
+        "revision",
+        ".jujuignore",
+        "src/charm.py",
+        "src/charm.pyc",
+        "lib/keep.pyc",
+        "__pycache__",
+        "src/__pycache__",
+        "lib/__pycache__",
+        "venv/ops/tests",
+        "venv/tests",
+        "tests",
+        "docs/index.md",
+        "docs/README.md",
+        "docs/sub/index.md",
+        "foo1.txt",
+        "foo12.txt",
+        "barb.txt",
+        "bara.txt",
+        "apps/logs",
+        "apps/x/y/logs",
+        "#notes",
+        "top",
+        "sub/top",
+    ]
+    for path in paths:
+        for is_dir in (True, False):
+            expected = _match_per_rule(ignore, path, is_dir)
+            assert ignore.match(path, is_dir) == expected, (path, is_dir)
+
+
+def test_compiled_rules_no_rules():
+    ignore = jujuignore.JujuIgnore([])
+    assert not ignore.match("foo", is_dir=True)
+    assert not ignore.match("foo", is_dir=False)
+
+
+def test_subtree_anchored_rules():
+    ignore = jujuignore.JujuIgnore(["/build/", "/foo/*.py", "/venv/**/tests/"])
+    assert ignore.subtree(".").can_skip
+    assert ignore.subtree("/foo").can_skip
+    assert ignore.subtree("venv").can_skip
+    assert ignore.subtree("venv/ops/sub").can_skip
+
+    # nothing can be ignored in these subtrees, at any depth
+    assert not ignore.subtree("src").can_skip
+    assert not ignore.subtree("src/sub").can_skip
+    assert not ignore.subtree("build").can_skip
+    assert not ignore.subtree("foo/sub").can_skip
+
+
+def test_subtree_unanchored_rules():
+    ignore = jujuignore.JujuIgnore(["/build/", "*.pyc"])
+    assert ignore.subtree("src").can_skip
+    assert ignore.subtree("src").match("src/foo.pyc", is_dir=False)
+    assert not ignore.subtree("src").match("src/build", is_dir=True)
+    assert ignore.subtree(".").match("build", is_dir=True)
+
+
+def test_subtree_only_inverted_rules():
+    ignore = jujuignore.JujuIgnore(["/foo/*.py", "!bar.py"])
+    assert ignore.subtree("foo").can_skip
+    assert not ignore.subtree("src").can_skip
+
+
+def test_subtree_brackets_with_slash():
+    ignore = jujuignore.JujuIgnore(["/foo[/]bar/baz"])
+    assert ignore.subtree("foo[").can_skip
+
+
+def test_subtree_prefix_before_double_star():
+    """The component before a '/**/' only needs to match at the start of the directory."""
+    ignore = jujuignore.JujuIgnore(["/src/**/tests/"])
+    assert ignore.match("srcfoo/x/tests", is_dir=True)
+    assert ignore.subtree("srcfoo").match("srcfoo/x/tests", is_dir=True)
+    assert ignore.subtree("srcfoo/x").match("srcfoo/x/tests", is_dir=True)
+    assert not ignore.subtree("lib").can_skip
+
+
+def test_subtree_same_as_full_match():
+    ignore = jujuignore.JujuIgnore(jujuignore.default_juju_ignore)
+    ignore.extend_patterns(
+        ["/lib/*.txt", "!/lib/keep.txt", "/src/**/*.pyc", "/a/b/", "/d?t*/**/tests/"]
+    )
+    paths = [
+        "lib/foo.txt",
+        "lib/keep.txt",
+        "lib/sub/foo.txt",
+        "src/foo.pyc",
+        "src/x/y/foo.pyc",
+        "src/.git",
+        "a/b",
+        "a/b/c",
+        "other/foo.txt",
+        "other/.tox",
+        "srcfoo/x/y.pyc",
+        "srcfoo/x/z/y.pyc",
+        "data/x/tests",
+        "dataset/tests",
+        "dot/x/y/tests",
+        "d/x/tests",
+    ]
+    for path in paths:
+        parts = path.split("/")
+        for is_dir in (True, False):
+            expected = ignore.match(path, is_dir)
+            # the subtree of every directory the path is in gives the same result
+            for depth in range(1, len(parts)):
+                dirpath = "/".join(parts[:depth])
+                result = ignore.subtree(dirpath).match(path, is_dir)
+                assert result == expected, (path, dirpath, is_dir)
+
+
+def test_subtree_updated_after_extending():
+    ignore = jujuignore.JujuIgnore(["/build/"])
+    assert not ignore.subtree("src").can_skip
+    ignore.extend_patterns(["*.pyc"])
+    assert ignore.subtree("src").can_skip
+
+
+def test_index_stats():
+    ignore = jujuignore.JujuIgnore(jujuignore.default_juju_ignore)
+    assert ignore.index_stats() == {"basenames": 6, "paths": 2, "globs": 0}
+    ignore.extend_patterns(["*.pyc", "!foo.txt", "/src/lib/", "apps/logs", "/foo/**"])
+    assert ignore.index_stats() == {"basenames": 7, "paths": 3, "globs": 3}
+
+
+def test_literal_rules():
+    ignore = jujuignore.JujuIgnore(["foo.txt", "/bar/baz", r"\#notes", "!/sub/foo.txt"])
+    assert ignore.index_stats() == {"basenames": 2, "paths": 2, "globs": 0}
+    assert ignore.match("foo.txt", is_dir=False)
+    assert ignore.match("/a/b/foo.txt", is_dir=True)
+    assert not ignore.match("/a/b/fooxtxt", is_dir=False)
+    assert not ignore.match("/a/b/foo.txt2", is_dir=False)
+    assert not ignore.match("/sub/foo.txt", is_dir=False)
+    assert ignore.match("bar/baz", is_dir=False)
+    assert not ignore.match("/x/bar/baz", is_dir=False)
+    assert ignore.match("/x/#notes", is_dir=False)
+
+
+def test_match_many():
+    ignore = jujuignore.JujuIgnore(["*.pyc", "/build/", "!keep.pyc", "logs/"])
+    paths = ["foo.pyc", "/src/foo.pyc", "build", "build", "keep.pyc", "logs", "logs", "foo.py"]
+    is_dir_flags = [False, False, True, False, False, True, False, False]
+    expected = [True, True, True, False, False, True, False, False]
+    assert ignore.match_many(paths, is_dir_flags) == expected
+    assert [ignore.match(p, d) for p, d in zip(paths, is_dir_flags)] == expected
+
+
+def test_match_many_empty():
+    ignore = jujuignore.JujuIgnore(["*.pyc"])
+    assert ignore.match_many([], []) == []
+    assert jujuignore.JujuIgnore([]).match_many(["foo.pyc", "bar"], [False, True]) == [
+        False,
+        False,
+    ]
+
+
+def test_explain_same_results():
+    rules = ["*.py[cod]", "!keep.pyc", "/build/", "docs/*.md", "!docs/README.md", "logs/"]
+    paths = ["a.pyc", "keep.pyc", "build", "docs/x.md", "docs/README.md", "logs", "a.py"]
+    normal = jujuignore.JujuIgnore(rules)
+    explained = jujuignore.JujuIgnore(rules, explain=True)
+    for is_dir in (True, False):
+        is_dir_flags = [is_dir] * len(paths)
+        assert explained.match_many(paths, is_dir_flags) == normal.match_many(paths, is_dir_flags)
+        for path in paths:
+            assert explained.match(path, is_dir) == normal.match(path, is_dir)
+
+
+def test_explain_stats(caplog):
+    caplog.set_level(logging.DEBUG, logger="charmcraft.jujuignore")
+    ignore = jujuignore.JujuIgnore(["*.pyc", "!keep.pyc", "/build/"], explain=True)
+    assert ignore.match_many(["a.pyc", "keep.pyc", "build"], [False, False, True]) == [
+        True,
+        False,
+        True,
+    ]
+    pyc, keep, build = ignore._matchers
+    assert (pyc.evaluations, pyc.matches) == (3, 2)
+    # stops evaluating after the inverted rule matched
+    assert (keep.evaluations, keep.matches) == (3, 1)
+    assert (build.evaluations, build.matches) == (2, 1)
+    assert "Path '/a.pyc' ignored because of .jujuignore line 1: '*.pyc'" in caplog.messages
+    assert "Path '/build' ignored because of .jujuignore line 3: '/build/'" in caplog.messages
+
+
+def test_explain_report():
+    ignore = jujuignore.JujuIgnore(["*.pyc", "/build/", "foo\n"], explain=True)
+    ignore.match("a.pyc", is_dir=False)
+    pyc, build, foo = ignore._matchers
+    pyc.elapsed, build.elapsed, foo.elapsed = 0.001, 0.003, 0.002
+    assert ignore.explain_report() == [
+        "line 2 '/build/': 1 evaluations, 0 matches, 3.000 ms",
+        "line 3 'foo': 1 evaluations, 0 matches, 2.000 ms",
+        "line 1 '*.pyc': 1 evaluations, 1 matches, 1.000 ms",
+    ]
+
+
+def test_cache_saved_and_reused(tmp_path):
+    cache_dir = tmp_path / "cache"
+    ignore = jujuignore.JujuIgnore(["*.pyc", "!keep.pyc", "/build/"], cache_dir=cache_dir)
+    (cache_path,) = cache_dir.iterdir()
+    assert cache_path.suffix == ".json"
+
+    with patch("charmcraft.jujuignore._translate") as mock_translate:
+        cached = jujuignore.JujuIgnore(["*.pyc", "!keep.pyc", "/build/"], cache_dir=cache_dir)
+    mock_translate.assert_not_called()
+    assert [vars(m) for m in cached._matchers] == [vars(m) for m in ignore._matchers]
+    assert cached.match("foo.pyc", is_dir=False)
+    assert not cached.match("keep.pyc", is_dir=False)
+    assert cached.match("build", is_dir=True)
+    assert not cached.match("build", is_dir=False)
+
+
+def test_cache_keyed_by_content(tmp_path):
+    cache_dir = tmp_path / "cache"
+    ignore = jujuignore.JujuIgnore(jujuignore.default_juju_ignore, cache_dir=cache_dir)
+    ignore.extend_patterns(["*.pyc"])
+    ignore = jujuignore.JujuIgnore(jujuignore.default_juju_ignore, cache_dir=cache_dir)
+    ignore.extend_patterns(["*.txt"])
+    assert len(list(cache_dir.iterdir())) == 3
+    assert ignore.match("foo.txt", is_dir=False)
+    assert not ignore.match("foo.pyc", is_dir=False)
+
+
+def test_cache_broken(tmp_path):
+    cache_dir = tmp_path / "cache"
+    jujuignore.JujuIgnore(["*.pyc"], cache_dir=cache_dir)
+    (cache_path,) = cache_dir.iterdir()
+    cache_path.write_text("{broken")
+
+    ignore = jujuignore.JujuIgnore(["*.pyc"], cache_dir=cache_dir)
+    assert ignore.match("foo.pyc", is_dir=False)
+    assert json.loads(cache_path.read_text())[0]["orig_rule"] == "*.pyc"
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        {"foo": "bar"},
+        ["*.pyc"],
+        [{"regex": ".*"}],
+        [{"unknown": 1}],
+    ],
+)
+def test_cache_wrong_structure(tmp_path, content):
+    cache_dir = tmp_path / "cache"
+    jujuignore.JujuIgnore(["*.pyc"], cache_dir=cache_dir)
+    (cache_path,) = cache_dir.iterdir()
+    original = json.loads(cache_path.read_text())
+    cache_path.write_text(json.dumps(content))
+
+    ignore = jujuignore.JujuIgnore(["*.pyc"], cache_dir=cache_dir)
+    assert ignore.match("foo.pyc", is_dir=False)
+    assert json.loads(cache_path.read_text()) == original
+
+
+def test_cache_wrong_types(tmp_path):
+    cache_dir = tmp_path / "cache"
+    jujuignore.JujuIgnore(["*.pyc"], cache_dir=cache_dir)
+    (cache_path,) = cache_dir.iterdir()
+    content = json.loads(cache_path.read_text())
+    content[0]["regex"] = None
+    cache_path.write_text(json.dumps(content))
+
+    ignore = jujuignore.JujuIgnore(["*.pyc"], cache_dir=cache_dir)
+    assert ignore.match("foo.pyc", is_dir=False)
+
+
+def test_cache_not_writable(tmp_path):
+    cache_dir = tmp_path / "cache"
+    cache_dir.touch()  # a file, so nothing can be written inside
+    ignore = jujuignore.JujuIgnore(["*.pyc"], cache_dir=cache_dir)
+    assert ignore.match("foo.pyc", is_dir=False)
@@ -17,6 +17,7 @@
 """Tests for analyze and lint code."""
 
 import pathlib
+import zipfile
 from unittest.mock import patch
 
 import pytest
@@ -265,6 +266,57 @@ def test_framework_operator_venv_ops_directory_is_not_a_dir(tmp_path):
     assert result is False
 
 
+def test_framework_operator_venv_ops_in_zipimport(tmp_path):
+    """The charm has the 'ops' package packed in venv.zip."""
+    # an entry point that import ops
+    entrypoint = tmp_path / "charm.py"
+    entrypoint.write_text("import ops")
+
+    # an ops package inside the venv zipimport archive, and an empty venv
+    (tmp_path / "venv").mkdir()
+    with zipfile.ZipFile(str(tmp_path / "venv.zip"), "w") as zf:
+        zf.writestr("ops/", b"")
+        zf.writestr("ops/__init__.py", b"")
+
+    # check
+    with patch("charmcraft.linters.check_dispatch_with_python_entrypoint") as mock_check:
+        mock_check.return_value = pathlib.Path(entrypoint)
+        result = Framework()._check_operator(tmp_path)
+    assert result is True
+
+
+def test_framework_operator_venv_zipimport_without_ops(tmp_path):
+    """The charm has a venv.zip, but without the 'ops' package."""
+    # an entry point that import ops
+    entrypoint = tmp_path / "charm.py"
+    entrypoint.write_text("import ops")
+
+    # other package inside the venv zipimport archive
+    with zipfile.ZipFile(str(tmp_path / "venv.zip"), "w") as zf:
+        zf.writestr("opsother/", b"")
+        zf.writestr("opsother/__init__.py", b"")
+
+    # check
+    with patch("charmcraft.linters.check_dispatch_with_python_entrypoint") as mock_check:
+        mock_check.return_value = pathlib.Path(entrypoint)
+        result = Framework()._check_operator(tmp_path)
+    assert result is False
+
+
+def test_framework_operator_venv_zipimport_corrupted(tmp_path):
+    """The charm has a venv.zip, but it's not a zip file."""
+    # an entry point that import ops
+    entrypoint = tmp_path / "charm.py"
+    entrypoint.write_text("import ops")
+    (tmp_path / "venv.zip").write_text("not a zip")
+
+    # check
+    with patch("charmcraft.linters.check_dispatch_with_python_entrypoint") as mock_check:
+        mock_check.return_value = pathlib.Path(entrypoint)
+        result = Framework()._check_operator(tmp_path)
+    assert result is False
+
+
 def test_framework_operator_corrupted_entrypoint(tmp_path):
     """Cannot parse the Python file."""
     # an entry point that import ops
@@ -0,0 +1,504 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# For further info, check https://github.com/canonical/charmcraft
+
+import datetime
+import logging
+import os
+import struct
+import zipfile
+import zlib
+from unittest.mock import patch
+
+import pytest
+
+from charmcraft import packing
+from charmcraft.packing import CompressionPolicy, Member, build_zip
+
+
+@pytest.fixture
+def build_dir(tmp_path):
+    """A directory with some files to pack, including a subdirectory."""
+    build_dir = tmp_path / "somedir"
+    build_dir.mkdir()
+    (build_dir / "foo.txt").write_bytes(b"123\x00456")
+    (build_dir / "bar").mkdir()
+    (build_dir / "bar" / "baz.txt").write_bytes(b"mo\xc3\xb1o" * 1000)
+    (build_dir / "empty").write_bytes(b"")
+    (build_dir / "random.bin").write_bytes(os.urandom(100000))
+    return build_dir
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_build_zip_content(tmp_path, build_dir, workers):
+    """All the files are in the zip, with their content."""
+    zip_filepath = tmp_path / "testresult.zip"
+    build_zip(zip_filepath, build_dir, workers=workers)
+
+    zf = zipfile.ZipFile(str(zip_filepath))
+    assert zf.testzip() is None
+    assert sorted(zf.namelist()) == ["bar/baz.txt", "empty", "foo.txt", "random.bin"]
+    for info in zf.infolist():
+        assert zf.read(info) == (build_dir / info.filename).read_bytes()
+    assert zf.getinfo("bar/baz.txt").compress_type == zipfile.ZIP_DEFLATED
+    assert zf.getinfo("random.bin").compress_type == zipfile.ZIP_STORED
+
+
+def test_build_zip_same_for_any_workers(tmp_path, build_dir):
+    """The members are written in the same order whatever the number of workers."""
+    build_zip(tmp_path / "serial.zip", build_dir, workers=1)
+    with patch.object(packing, "PENDING_PER_WORKER", 1):
+        build_zip(tmp_path / "concurrent.zip", build_dir, workers=2)
+    assert (tmp_path / "serial.zip").read_bytes() == (tmp_path / "concurrent.zip").read_bytes()
+
+
+def test_build_zip_default_workers(tmp_path, build_dir, caplog):
+    """By default as many workers as CPUs are used."""
+    caplog.set_level(logging.DEBUG, logger="charmcraft.packing")
+    with patch("os.cpu_count", return_value=7):
+        build_zip(tmp_path / "testresult.zip", build_dir)
+    assert "Packing 4 files using 7 workers" in [rec.message for rec in caplog.records]
+
+
+def test_build_zip_attributes(tmp_path, build_dir):
+    """The permissions and modification times of the files are kept."""
+    (build_dir / "foo.txt").chmod(0o755)
+    os.utime(str(build_dir / "foo.txt"), (1600000000, 1600000000))
+
+    zip_filepath = tmp_path / "testresult.zip"
+    build_zip(zip_filepath, build_dir)
+
+    zf = zipfile.ZipFile(str(zip_filepath))
+    info = zf.getinfo("foo.txt")
+    assert info.external_attr >> 16 == (build_dir / "foo.txt").stat().st_mode
+    assert info.create_system == 3
+    assert info.date_time == zipfile.ZipInfo.from_file(str(build_dir / "foo.txt")).date_time
+
+
+def test_build_zip_old_timestamp(tmp_path, build_dir):
+    """Files older than what the zip format supports are stored with its minimum time."""
+    os.utime(str(build_dir / "foo.txt"), (0, 0))
+
+    zip_filepath = tmp_path / "testresult.zip"
+    build_zip(zip_filepath, build_dir)
+
+    zf = zipfile.ZipFile(str(zip_filepath))
+    assert zf.getinfo("foo.txt").date_time[0] == 1980
+
+
+def test_build_zip_non_ascii_names(tmp_path):
+    """Member names are encoded in UTF-8."""
+    build_dir = tmp_path / "somedir"
+    build_dir.mkdir()
+    (build_dir / "ñandú.txt").write_bytes(b"123")
+
+    zip_filepath = tmp_path / "testresult.zip"
+    build_zip(zip_filepath, build_dir)
+
+    zf = zipfile.ZipFile(str(zip_filepath))
+    assert zf.namelist() == ["ñandú.txt"]
+    assert zf.read("ñandú.txt") == b"123"
+
+
+def test_build_zip_empty(tmp_path):
+    """An empty directory produces an empty (but valid) zip."""
+    build_dir = tmp_path / "somedir"
+    build_dir.mkdir()
+
+    zip_filepath = tmp_path / "testresult.zip"
+    build_zip(zip_filepath, build_dir)
+
+    zf = zipfile.ZipFile(str(zip_filepath))
+    assert zf.namelist() == []
+
+
+def test_build_zip_order(tmp_path):
+    """The members are written in a stable order, by name in each directory."""
+    build_dir = tmp_path / "somedir"
+    build_dir.mkdir()
+    for name in ["b", "a", "c/z", "c/y", "B/x", "a2/w"]:
+        filepath = build_dir / name
+        filepath.parent.mkdir(exist_ok=True)
+        filepath.write_text(name)
+
+    zip_filepath = tmp_path / "testresult.zip"
+    build_zip(zip_filepath, build_dir)
+
+    zf = zipfile.ZipFile(str(zip_filepath))
+    assert zf.namelist() == ["a", "b", "B/x", "a2/w", "c/y", "c/z"]
+
+
+def test_build_zip_timestamp(tmp_path, build_dir):
+    """With a timestamp, all the members get it and the usual permissions."""
+    (build_dir / "foo.txt").chmod(0o700)
+    (build_dir / "empty").chmod(0o600)
+    timestamp = datetime.datetime(2020, 9, 13, 12, 26, 40)
+
+    zip_filepath = tmp_path / "testresult.zip"
+    build_zip(zip_filepath, build_dir, timestamp=timestamp)
+
+    zf = zipfile.ZipFile(str(zip_filepath))
+    assert {info.date_time for info in zf.infolist()} == {(2020, 9, 13, 12, 26, 40)}
+    assert zf.getinfo("foo.txt").external_attr >> 16 == 0o100755
+    assert zf.getinfo("empty").external_attr >> 16 == 0o100644
+
+
+def test_build_zip_timestamp_old(tmp_path, build_dir):
+    """Timestamps older than what the zip format supports are replaced by its minimum."""
+    zip_filepath = tmp_path / "testresult.zip"
+    build_zip(zip_filepath, build_dir, timestamp=datetime.datetime(1970, 1, 1))
+
+    zf = zipfile.ZipFile(str(zip_filepath))
+    assert {info.date_time for info in zf.infolist()} == {(1980, 1, 1, 0, 0, 0)}
+
+
+def test_build_zip_reproducible(tmp_path, build_dir):
+    """With a timestamp, the zip only depends on the content of the files."""
+    timestamp = datetime.datetime(2020, 9, 13, 12, 26, 40)
+    build_zip(tmp_path / "first.zip", build_dir, timestamp=timestamp)
+
+    # same content in other files, with other times and permissions
+    other_dir = tmp_path / "otherdir"
+    (other_dir / "bar").mkdir(parents=True)
+    for name in ["random.bin", "foo.txt", "empty", "bar/baz.txt"]:
+        (other_dir / name).write_bytes((build_dir / name).read_bytes())
+        (other_dir / name).chmod(0o640)
+        os.utime(str(other_dir / name), (1700000000, 1700000000))
+    build_zip(tmp_path / "second.zip", other_dir, timestamp=timestamp)
+
+    assert (tmp_path / "first.zip").read_bytes() == (tmp_path / "second.zip").read_bytes()
+
+
+def test_build_zip_streamed(tmp_path, build_dir):
+    """Big files are compressed while written, with the same result."""
+    build_zip(tmp_path / "normal.zip", build_dir)
+    with patch.object(packing, "STREAMED_MIN_SIZE", 1000):
+        build_zip(tmp_path / "streamed.zip", build_dir)
+
+    assert (tmp_path / "normal.zip").read_bytes() == (tmp_path / "streamed.zip").read_bytes()
+
+
+@pytest.mark.parametrize("streamed_min_size", [2 ** 30, 1000])
+def test_build_zip_stored(tmp_path, build_dir, streamed_min_size):
+    """Members can be stored without compression, in memory or streamed."""
+    zip_filepath = tmp_path / "testresult.zip"
+    policy = CompressionPolicy(stored_patterns=["*"])
+    with patch.object(packing, "STREAMED_MIN_SIZE", streamed_min_size):
+        build_zip(zip_filepath, build_dir, policy=policy)
+
+    zf = zipfile.ZipFile(str(zip_filepath))
+    assert zf.testzip() is None
+    for info in zf.infolist():
+        assert info.compress_type == zipfile.ZIP_STORED
+        assert zf.read(info) == (build_dir / info.filename).read_bytes()
+
+
+@pytest.mark.parametrize("streamed_min_size", [2 ** 30, 1000])
+def test_build_zip_stored_incompressible(tmp_path, build_dir, streamed_min_size):
+    """Members that barely shrink are stored without compression, in memory or streamed."""
+    zip_filepath = tmp_path / "testresult.zip"
+    with patch.object(packing, "STREAMED_MIN_SIZE", streamed_min_size):
+        build_zip(zip_filepath, build_dir)
+
+    zf = zipfile.ZipFile(str(zip_filepath))
+    assert zf.testzip() is None
+    methods = {info.filename: info.compress_type for info in zf.infolist()}
+    assert methods == {
+        "bar/baz.txt": zipfile.ZIP_DEFLATED,
+        "empty": zipfile.ZIP_STORED,
+        "foo.txt": zipfile.ZIP_STORED,
+        "random.bin": zipfile.ZIP_STORED,
+    }
+
+
+def test_build_zip_deflate_all(tmp_path, build_dir):
+    """All members are deflated if nothing is to be stored."""
+    zip_filepath = tmp_path / "testresult.zip"
+    policy = CompressionPolicy(stored_patterns=[], store_incompressible=False)
+    build_zip(zip_filepath, build_dir, policy=policy)
+
+    zf = zipfile.ZipFile(str(zip_filepath))
+    assert zf.testzip() is None
+    assert {info.compress_type for info in zf.infolist()} == {zipfile.ZIP_DEFLATED}
+
+
+def test_build_zip_compression_level(tmp_path, build_dir):
+    """The members are deflated at the indicated level."""
+    zip_filepath = tmp_path / "testresult.zip"
+    build_zip(zip_filepath, build_dir, policy=CompressionPolicy(level=1))
+
+    compressor = zlib.compressobj(1, zlib.DEFLATED, -15)
+    expected = compressor.compress(b"mo\xc3\xb1o" * 1000) + compressor.flush()
+    zf = zipfile.ZipFile(str(zip_filepath))
+    assert zf.getinfo("bar/baz.txt").compress_size == len(expected)
+    with zip_filepath.open("rb") as fh:
+        assert expected in fh.read()
+
+
+# -- tests for the compression policy
+
+
+@pytest.mark.parametrize(
+    "name, method",
+    [
+        ("venv/foo-1.0-py3-none-any.whl", packing.ZIP_STORED),
+        ("icon.png", packing.ZIP_STORED),
+        ("src/charm.py", packing.ZIP_DEFLATED),
+        ("README.md", packing.ZIP_DEFLATED),
+        ("icon.PNG", packing.ZIP_DEFLATED),
+    ],
+)
+def test_policy_method_default(name, method):
+    """By default the usual compressed formats are stored."""
+    assert CompressionPolicy().get_method(name) == method
+
+
+def test_policy_method_patterns():
+    """The stored patterns are matched against the whole name."""
+    policy = CompressionPolicy(stored_patterns=["lib/*.so", "data/*"])
+    assert policy.get_method("lib/foo.so") == packing.ZIP_STORED
+    assert policy.get_method("lib/sub/foo.so") == packing.ZIP_STORED
+    assert policy.get_method("data/stuff.txt") == packing.ZIP_STORED
+    assert policy.get_method("venv/foo.so") == packing.ZIP_DEFLATED
+    assert policy.get_method("icon.png") == packing.ZIP_DEFLATED
+
+
+def test_policy_deflate_compressible():
+    """Data with redundancy is deflated."""
+    data = b"abc" * 100000
+    deflated = CompressionPolicy().deflate(data)
+    assert zlib.decompress(deflated, -15) == data
+
+
+def test_policy_deflate_incompressible_sampled():
+    """Big data is not deflated if its beginning is incompressible."""
+    data = os.urandom(packing.SAMPLE_SIZE) + b"abc" * 100000
+    policy = CompressionPolicy()
+    with patch.object(policy, "get_compressor") as compressor_mock:
+        assert policy.deflate(data) is None
+    compressor_mock.assert_not_called()
+
+
+def test_policy_deflate_incompressible_small():
+    """Small data is not deflated if it doesn't shrink enough."""
+    assert CompressionPolicy().deflate(os.urandom(1000)) is None
+
+
+def test_policy_deflate_incompressible_disabled():
+    """Incompressible data is deflated anyway if indicated."""
+    data = os.urandom(packing.SAMPLE_SIZE * 2)
+    deflated = CompressionPolicy(store_incompressible=False).deflate(data)
+    assert zlib.decompress(deflated, -15) == data
+
+
+def test_build_zip_many_files(tmp_path, build_dir):
+    """The ZIP64 end records are written when there are too many members."""
+    zip_filepath = tmp_path / "testresult.zip"
+    with patch.object(packing, "ZIP_FILECOUNT_LIMIT", 2):
+        build_zip(zip_filepath, build_dir)
+
+    content = zip_filepath.read_bytes()
+    assert struct.pack("<I", packing._ZIP64_END_RECORD_SIGNATURE) in content
+    zf = zipfile.ZipFile(str(zip_filepath))
+    assert len(zf.namelist()) == 4
+    assert zf.testzip() is None
+
+
+def test_build_zip_unreadable_file(tmp_path, build_dir):
+    """Problems reading the files are raised."""
+    (build_dir / "foo.txt").unlink()
+    (build_dir / "foo.txt").symlink_to(tmp_path / "missing")
+
+    with pytest.raises(FileNotFoundError):
+        build_zip(tmp_path / "testresult.zip", build_dir, workers=2)
+
+
+def test_central_header_zip64():
+    """Only the values beyond the limits are put in the ZIP64 extra field."""
+    member = Member("path", "name", (2020, 1, 1, 0, 0, 0), 0o100644, 2 ** 33)
+    member.compress_size = 1000
+    member.offset = 2 ** 34
+
+    header = packing._central_header(member)
+
+    fields = packing._CENTRAL_HEADER.unpack_from(header)
+    assert fields[8:10] == (1000, packing.ZIP64_LIMIT)  # compressed and file sizes
+    assert fields[-1] == packing.ZIP64_LIMIT  # offset
+    extra = header[packing._CENTRAL_HEADER.size + len(b"name") :]
+    assert struct.unpack("<HHQQ", extra) == (1, 16, 2 ** 33, 2 ** 34)
+
+
+def test_local_header_zip64():
+    """Both sizes are put in the ZIP64 extra field of the local header."""
+    member = Member("path", "name", (2020, 1, 1, 0, 0, 0), 0o100644, 2 ** 33)
+    member.compress_size = 1000
+
+    header = packing._local_header(member, zip64=True)
+
+    fields = packing._LOCAL_HEADER.unpack_from(header)
+    assert fields[1] == 45  # version needed
+    assert fields[7:9] == (packing.ZIP64_LIMIT, packing.ZIP64_LIMIT)
+    extra = header[packing._LOCAL_HEADER.size + len(b"name") :]
+    assert struct.unpack("<HHQQ", extra) == (1, 16, 2 ** 33, 1000)
+
+
+# -- tests for the incremental packing
+
+
+def test_build_zip_comment(tmp_path, build_dir):
+    """The zip identifies the compression settings it was built with."""
+    zip_filepath = tmp_path / "testresult.zip"
+    build_zip(zip_filepath, build_dir)
+
+    zf = zipfile.ZipFile(str(zip_filepath))
+    assert zf.comment == b"charmcraft-packing:" + CompressionPolicy().get_signature()
+
+
+def test_policy_signature():
+    """The signature changes with the compression settings."""
+    signatures = {
+        CompressionPolicy().get_signature(),
+        CompressionPolicy(level=9).get_signature(),
+        CompressionPolicy(stored_patterns=[]).get_signature(),
+        CompressionPolicy(store_incompressible=False).get_signature(),
+    }
+    assert len(signatures) == 4
+    assert CompressionPolicy().get_signature() == CompressionPolicy().get_signature()
+
+
+@pytest.mark.parametrize("streamed_min_size", [2 ** 30, 1000])
+def test_build_zip_incremental(tmp_path, build_dir, caplog, streamed_min_size):
+    """Only the changed files are compressed again, giving the same result."""
+    caplog.set_level(logging.DEBUG, logger="charmcraft.packing")
+    zip_filepath = tmp_path / "testresult.zip"
+    with patch.object(packing, "STREAMED_MIN_SIZE", streamed_min_size):
+        build_zip(zip_filepath, build_dir)
+
+        # same size but different content, and a new file
+        (build_dir / "foo.txt").write_bytes(b"789\x00012")
+        (build_dir / "new.txt").write_bytes(b"new" * 1000)
+        deflated = []
+        original_deflate = CompressionPolicy.deflate
+
+        def recording_deflate(self, data):
+            deflated.append(data)
+            return original_deflate(self, data)
+
+        with patch.object(CompressionPolicy, "deflate", recording_deflate):
+            build_zip(zip_filepath, build_dir, workers=3, incremental=True)
+        build_zip(tmp_path / "fresh.zip", build_dir)
+
+    assert sorted(deflated) == [b"789\x00012", b"new" * 1000]
+    assert zip_filepath.read_bytes() == (tmp_path / "fresh.zip").read_bytes()
+    assert not (tmp_path / "testresult.zip.partial").exists()
+    expected = "Reused the compressed content of 3 files from the previous testresult.zip"
+    assert expected in [rec.message for rec in caplog.records]
+
+
+@pytest.mark.parametrize("streamed_min_size", [2 ** 30, 1000])
+def test_build_zip_incremental_same_crc_changed(tmp_path, build_dir, streamed_min_size):
+    """A changed file is compressed again even if its size and CRC didn't change."""
+    # these have the same CRC, also with the same suffix
+    colliding = build_dir / "colliding.txt"
+    colliding.write_bytes(b"plumless" + b"x" * 2000)
+    os.utime(str(colliding), (1600000000, 1600000000))
+    zip_filepath = tmp_path / "testresult.zip"
+    with patch.object(packing, "STREAMED_MIN_SIZE", streamed_min_size):
+        build_zip(zip_filepath, build_dir)
+        colliding.write_bytes(b"buckeroo" + b"x" * 2000)
+        os.utime(str(colliding), (1700000000, 1700000000))
+        build_zip(zip_filepath, build_dir, incremental=True)
+
+    with zipfile.ZipFile(str(zip_filepath)) as zf:
+        assert zf.read("colliding.txt") == b"buckeroo" + b"x" * 2000
+
+
+@pytest.mark.parametrize("streamed_min_size", [2 ** 30, 1000])
+def test_build_zip_incremental_reproducible(tmp_path, build_dir, caplog, streamed_min_size):
+    """With the same date for all members their content is compared to reuse them."""
+    caplog.set_level(logging.DEBUG, logger="charmcraft.packing")
+    colliding = build_dir / "colliding.txt"
+    colliding.write_bytes(b"plumless" + b"x" * 2000)
+    zip_filepath = tmp_path / "testresult.zip"
+    timestamp = datetime.datetime(2020, 1, 1)
+    with patch.object(packing, "STREAMED_MIN_SIZE", streamed_min_size):
+        build_zip(zip_filepath, build_dir, timestamp=timestamp)
+        colliding.write_bytes(b"buckeroo" + b"x" * 2000)
+        build_zip(zip_filepath, build_dir, timestamp=timestamp, incremental=True)
+        build_zip(tmp_path / "fresh.zip", build_dir, timestamp=timestamp)
+
+    assert zip_filepath.read_bytes() == (tmp_path / "fresh.zip").read_bytes()
+    expected = "Reused the compressed content of 4 files from the previous testresult.zip"
+    assert expected in [rec.message for rec in caplog.records]
+
+
+def test_build_zip_incremental_other_settings(tmp_path, build_dir, caplog):
+    """Nothing is reused from a zip built with other compression settings."""
+    caplog.set_level(logging.DEBUG, logger="charmcraft.packing")
+    zip_filepath = tmp_path / "testresult.zip"
+    build_zip(zip_filepath, build_dir, policy=CompressionPolicy(level=1))
+    build_zip(zip_filepath, build_dir, incremental=True)
+    build_zip(tmp_path / "fresh.zip", build_dir)
+
+    assert zip_filepath.read_bytes() == (tmp_path / "fresh.zip").read_bytes()
+    messages = [rec.message for rec in caplog.records]
+    assert f"Not reusing {zip_filepath}, it was packed with other settings" in messages
+    expected = "Reused the compressed content of 0 files from the previous testresult.zip"
+    assert expected in messages
+
+
+def test_build_zip_incremental_corrupted(tmp_path, build_dir, caplog):
+    """Nothing is reused from a file that isn't a zip."""
+    caplog.set_level(logging.DEBUG, logger="charmcraft.packing")
+    zip_filepath = tmp_path / "testresult.zip"
+    zip_filepath.write_bytes(b"not really a zip")
+    build_zip(zip_filepath, build_dir, incremental=True)
+    build_zip(tmp_path / "fresh.zip", build_dir)
+
+    assert zip_filepath.read_bytes() == (tmp_path / "fresh.zip").read_bytes()
+    messages = [rec.message for rec in caplog.records]
+    assert any(msg.startswith(f"Not reusing {zip_filepath}, it can't be read") for msg in messages)
+
+
+def test_build_zip_incremental_missing(tmp_path, build_dir):
+    """Without a previous zip everything is compressed."""
+    zip_filepath = tmp_path / "testresult.zip"
+    build_zip(zip_filepath, build_dir, incremental=True)
+    build_zip(tmp_path / "fresh.zip", build_dir)
+
+    assert zip_filepath.read_bytes() == (tmp_path / "fresh.zip").read_bytes()
+
+
+def test_build_zip_not_incremental(tmp_path, build_dir):
+    """The previous zip is not used if not incremental."""
+    zip_filepath = tmp_path / "testresult.zip"
+    build_zip(zip_filepath, build_dir)
+    with patch.object(packing, "_PreviousZip") as previous_mock:
+        build_zip(zip_filepath, build_dir)
+    previous_mock.assert_not_called()
+
+
+def test_build_zip_error_keeps_previous(tmp_path, build_dir):
+    """If the packing fails the previous zip is left untouched, without leftovers."""
+    zip_filepath = tmp_path / "testresult.zip"
+    build_zip(zip_filepath, build_dir)
+    previous_content = zip_filepath.read_bytes()
+
+    with patch.object(packing, "_compress", side_effect=OSError("boom")):
+        with pytest.raises(OSError):
+            build_zip(zip_filepath, build_dir, incremental=True)
+
+    assert zip_filepath.read_bytes() == previous_content
+    assert not (tmp_path / "testresult.zip.partial").exists()
@@ -22,6 +22,8 @@ import craft_parts
 import pydantic
 import pytest
 from craft_parts import Step, plugins
+from craft_parts.infos import StepInfo
+from craft_parts.state_manager import states
 
 from charmcraft import charm_builder, parts
 
@@ -87,6 +89,7 @@ class TestCharmPlugin:
             "{charm_builder} "
             "--charmdir {work_dir}/parts/foo/build "
             "--builddir {work_dir}/parts/foo/install "
+            "--cache-dir {work_dir} "
             "--entrypoint {work_dir}/parts/foo/build/entrypoint "
             "-r reqs1.txt "
             "-r reqs2.txt".format(
@@ -96,6 +99,181 @@ class TestCharmPlugin:
             )
         ]
 
+    def test_get_build_commands_in_process(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(update={"charm_in_process": True})
+        monkeypatch.setattr(self._plugin, "_options", options)
+        assert self._plugin.get_build_commands() == []
+
+    def test_get_builder_arguments(self, tmp_path):
+        assert self._plugin.get_builder_arguments() == [
+            "--charmdir",
+            f"{tmp_path}/parts/foo/build",
+            "--builddir",
+            f"{tmp_path}/parts/foo/install",
+            "--cache-dir",
+            str(tmp_path),
+            "--entrypoint",
+            f"{tmp_path}/parts/foo/build/entrypoint",
+            "-r",
+            "reqs1.txt",
+            "-r",
+            "reqs2.txt",
+        ]
+
+    def test_get_builder_environment(self, monkeypatch):
+        monkeypatch.setenv("PATH", "/some/path")
+        monkeypatch.setenv("https_proxy", "https_proxy_value")
+        monkeypatch.setenv("SOURCE_DATE_EPOCH", "1600000000")
+        monkeypatch.setenv("SOMETHING_ELSE", "not passed")
+        monkeypatch.delenv("SNAP", raising=False)
+        assert self._plugin.get_builder_environment() == {
+            "LANG": "C.UTF-8",
+            "LC_ALL": "C.UTF-8",
+            "PATH": "/some/path",
+            "https_proxy": "https_proxy_value",
+            "SOURCE_DATE_EPOCH": "1600000000",
+        }
+
+    def test_get_build_commands_explain_ignores(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(update={"charm_explain_ignores": True})
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith("-r reqs1.txt -r reqs2.txt --explain-ignores")
+
+    def test_get_build_commands_venv_cache(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(update={"charm_venv_cache": True})
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith("-r reqs1.txt -r reqs2.txt --venv-cache")
+
+    def test_get_build_commands_wheels_cache(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(update={"charm_wheels_cache": True})
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith("-r reqs1.txt -r reqs2.txt --wheels-cache")
+
+    def test_get_build_commands_wheelhouse(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(update={"charm_wheelhouse": "/project/wheels"})
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith("-r reqs1.txt -r reqs2.txt --wheelhouse /project/wheels")
+
+    def test_get_build_commands_lock_dir(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(update={"charm_lock_dir": "locks"})
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith(
+            "-r reqs1.txt -r reqs2.txt --lock-dir {}/parts/foo/build/locks".format(tmp_path)
+        )
+
+    def test_get_build_commands_python_packages(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(
+            update={"charm_python_packages": ["ops", "pyyaml"], "charm_allow_pip_binary": False}
+        )
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith("-r reqs2.txt -p ops -p pyyaml --disallow-pip-binary")
+
+    def test_get_build_commands_compile_bytecode(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(update={"charm_compile_bytecode": True})
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith("-r reqs1.txt -r reqs2.txt --compile-bytecode")
+
+    def test_get_build_commands_link_workers(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(update={"charm_link_workers": 4})
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith("-r reqs1.txt -r reqs2.txt --link-workers 4")
+
+    def test_invalid_link_workers(self):
+        with pytest.raises(pydantic.ValidationError) as raised:
+            parts.CharmPlugin.properties_class.unmarshal({"source": ".", "charm-link-workers": 0})
+        err = raised.value.errors()
+        assert len(err) == 1
+        assert err[0]["loc"] == ("charm-link-workers",)
+        assert err[0]["msg"] == "must be a positive integer"
+
+    def test_get_build_commands_zipimport(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(update={"charm_zipimport": ["venv", "lib"]})
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith("-r reqs2.txt --zipimport venv --zipimport lib")
+
+    def test_get_build_commands_prune_venv(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(
+            update={"charm_prune_venv": True, "charm_prune_patterns": ["*.md", "!foo/tests/"]}
+        )
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith(
+            "-r reqs2.txt --prune-venv --prune-pattern '*.md' --prune-pattern '!foo/tests/'"
+        )
+
+    def test_get_build_commands_tree_shaking(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(
+            update={"charm_tree_shaking": "report", "charm_keep_packages": ["plugins"]}
+        )
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith("-r reqs2.txt --tree-shaking report --keep-package plugins")
+
+    def test_invalid_tree_shaking(self):
+        with pytest.raises(pydantic.ValidationError) as raised:
+            parts.CharmPlugin.properties_class.unmarshal(
+                {"source": ".", "charm-tree-shaking": "everything"}
+            )
+        err = raised.value.errors()
+        assert len(err) == 1
+        assert err[0]["loc"] == ("charm-tree-shaking",)
+        assert err[0]["msg"] == "must be one of: report, remove"
+
+    def test_get_build_commands_concurrent_dependencies(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(update={"charm_concurrent_dependencies": True})
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith("-r reqs1.txt -r reqs2.txt --concurrent-dependencies")
+
+    def test_get_build_commands_dispatch_mode(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(update={"charm_dispatch_mode": "fast"})
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith("-r reqs1.txt -r reqs2.txt --dispatch-mode fast")
+
+    def test_get_build_commands_dispatch_skip_site(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(
+            update={"charm_dispatch_mode": "fast", "charm_dispatch_skip_site": True}
+        )
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith("--dispatch-mode fast --dispatch-skip-site")
+
+    def test_get_build_commands_source_date_epoch(self, tmp_path, monkeypatch):
+        options = self._plugin._options.copy(update={"charm_source_date_epoch": 315532800})
+        monkeypatch.setattr(self._plugin, "_options", options)
+        (command,) = self._plugin.get_build_commands()
+        assert command.endswith("-r reqs1.txt -r reqs2.txt --source-date-epoch 315532800")
+
+    def test_invalid_dispatch_mode(self):
+        with pytest.raises(pydantic.ValidationError) as raised:
+            parts.CharmPlugin.properties_class.unmarshal(
+                {"source": ".", "charm-dispatch-mode": "fastest"}
+            )
+        err = raised.value.errors()
+        assert len(err) == 1
+        assert err[0]["loc"] == ("charm-dispatch-mode",)
+        assert err[0]["msg"] == "must be one of: classic, fast"
+
+    def test_invalid_zipimport(self):
+        with pytest.raises(pydantic.ValidationError) as raised:
+            parts.CharmPlugin.properties_class.unmarshal(
+                {"source": ".", "charm-zipimport": ["venv", "src"]}
+            )
+        err = raised.value.errors()
+        assert len(err) == 1
+        assert err[0]["loc"] == ("charm-zipimport", 1)
+        assert err[0]["msg"] == "must be one of: lib, venv"
+
     def test_invalid_properties(self):
         with pytest.raises(pydantic.ValidationError) as raised:
             parts.CharmPlugin.properties_class.unmarshal({"source": ".", "charm-invalid": True})
@@ -205,6 +383,136 @@ class TestPartsLifecycle:
         mock_clean.assert_called_once_with(Step.BUILD, part_names=["charm"])
 
 
+def _charm_build_step_info(tmp_path, part_name="charm"):
+    """Return the information of the build step of a charm part."""
+    project_dirs = craft_parts.ProjectDirs(work_dir=tmp_path)
+    spec = {"plugin": "charm", "charm-entrypoint": "src/charm.py"}
+    plugin_properties = parts.CharmPluginProperties.unmarshal(spec)
+    part_spec = plugins.extract_part_properties(spec, plugin_name="charm")
+    part = craft_parts.Part(
+        part_name, part_spec, project_dirs=project_dirs, plugin_properties=plugin_properties
+    )
+    project_info = craft_parts.ProjectInfo(
+        application_name="test", project_dirs=project_dirs, cache_dir=tmp_path
+    )
+    part_info = craft_parts.PartInfo(project_info=project_info, part=part)
+    return StepInfo(part_info, Step.BUILD)
+
+
+class TestPartsLifecycleInProcess:
+    """Ensure the charm builder is run in-process when requested."""
+
+    @pytest.fixture
+    def lifecycle(self, tmp_path):
+        data = {
+            "plugin": "charm",
+            "source": ".",
+            "charm-entrypoint": "src/charm.py",
+            "charm-in-process": True,
+        }
+        with patch("craft_parts.LifecycleManager.refresh_packages_list"):
+            return parts.PartsLifecycle(
+                all_parts={"charm": data},
+                work_dir=tmp_path,
+                ignore_local_sources=["*.charm"],
+            )
+
+    def test_build(self, tmp_path, lifecycle, monkeypatch):
+        monkeypatch.setenv("PATH", "/some/path")
+        step_info = _charm_build_step_info(tmp_path)
+
+        timings = {"setup": 0.1, "dependencies": 2.5}
+        with patch("charmcraft.charm_builder.build_in_process", return_value=timings) as mock:
+            assert lifecycle._build_charm_in_process(step_info) is True
+
+        build_dir = tmp_path / "parts" / "charm" / "build"
+        mock.assert_called_once_with(
+            [
+                "--charmdir",
+                str(build_dir),
+                "--builddir",
+                str(tmp_path / "parts" / "charm" / "install"),
+                "--cache-dir",
+                str(tmp_path),
+                "--entrypoint",
+                str(build_dir / "src" / "charm.py"),
+            ],
+            {"LANG": "C.UTF-8", "LC_ALL": "C.UTF-8", "PATH": "/some/path"},
+            build_dir,
+        )
+        assert lifecycle.charm_build_timings == timings
+
+    def test_run(self, tmp_path, lifecycle):
+        step_info = _charm_build_step_info(tmp_path)
+
+        def fake_execute(actions):
+            craft_parts.callbacks.run_post_step(step_info)
+
+        with patch("craft_parts.LifecycleManager.clean"), patch(
+            "craft_parts.LifecycleManager.reload_state"
+        ), patch("craft_parts.LifecycleManager.plan", return_value=[]):
+            with patch("craft_parts.LifecycleManager.action_executor") as mock_executor:
+                mock_executor.return_value.__enter__.return_value.execute = fake_execute
+                with patch("charmcraft.charm_builder.build_in_process") as mock_build:
+                    mock_build.return_value = {"setup": 1.0}
+                    lifecycle.run(Step.PRIME)
+        assert lifecycle.charm_build_timings == {"setup": 1.0}
+
+        # the callback is not kept for other lifecycles
+        with patch("charmcraft.charm_builder.build_in_process") as mock_build:
+            craft_parts.callbacks.run_post_step(step_info)
+        mock_build.assert_not_called()
+
+    def test_run_keeps_other_callbacks(self, tmp_path, lifecycle):
+        step_info = _charm_build_step_info(tmp_path)
+        called = []
+
+        def other_callback(info):
+            called.append(info)
+            return True
+
+        craft_parts.callbacks.register_post_step(other_callback)
+        try:
+            with patch("craft_parts.LifecycleManager.clean"), patch(
+                "craft_parts.LifecycleManager.reload_state"
+            ), patch("craft_parts.LifecycleManager.plan", return_value=[]), patch(
+                "craft_parts.LifecycleManager.action_executor"
+            ):
+                lifecycle.run(Step.PRIME)
+
+            # only the charm callback was removed
+            with patch("charmcraft.charm_builder.build_in_process") as mock_build:
+                craft_parts.callbacks.run_post_step(step_info)
+            mock_build.assert_not_called()
+            assert called == [step_info]
+        finally:
+            craft_parts.callbacks.unregister_all()
+
+    def test_build_other_part(self, tmp_path, lifecycle):
+        step_info = _charm_build_step_info(tmp_path, part_name="other")
+        with patch("charmcraft.charm_builder.build_in_process") as mock:
+            lifecycle._build_charm_in_process(step_info)
+        mock.assert_not_called()
+
+    def test_build_error(self, tmp_path, lifecycle):
+        step_info = _charm_build_step_info(tmp_path)
+        # where craft-parts keeps the state, fails if its layout changes
+        part = craft_parts.Part(
+            "charm", {}, project_dirs=craft_parts.ProjectDirs(work_dir=tmp_path)
+        )
+        state_path = states.state_file_path(part, Step.BUILD)
+        state_path.parent.mkdir(parents=True)
+        state_path.touch()
+
+        with patch("charmcraft.charm_builder.build_in_process", side_effect=ValueError("boom")):
+            with pytest.raises(ValueError):
+                lifecycle._build_charm_in_process(step_info)
+
+        # the build will be run again
+        assert not state_path.exists()
+        assert lifecycle.charm_build_timings == {}
+
+
 class TestPartHelpers:
     """Verify helper functions."""
 